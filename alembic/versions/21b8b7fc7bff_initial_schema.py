@@ -0,0 +1,97 @@
+"""Initial schema
+
+Revision ID: 21b8b7fc7bff
+Revises:
+Create Date: 2026-10-18 12:30:00.000000
+
+Databases created before this migration existed (with `create_all`)
+already have these tables, so `app/migrate_db.py` marks them as up to
+date with `alembic stamp 21b8b7fc7bff` instead of running it.
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "21b8b7fc7bff"
+down_revision = None
+branch_labels = None
+depends_on = None
+
+job_status_values = (
+    "PENDING",
+    "IMPORTING",
+    "IMPORTING_ERROR_AUTHORIZATION_REQUIRED",
+    "IMPORTING_ERROR_DATA_UNREACHABLE",
+    "IMPORTING_SUCCESSFULLY",
+    "EXPORTING",
+    "EXPORTING_ERROR_AUTHORIZATION_REQUIRED",
+    "EXPORTING_ERROR_DATA_UNREACHABLE",
+    "EXPORTING_SUCCESSFULLY",
+    "FINISHED_SUCCESSFULLY",
+    "CANCELLING",
+    "CANCELLED",
+)
+
+
+def upgrade() -> None:
+    job_status = postgresql.ENUM(*job_status_values, name="jobstatus")
+    job_status.create(op.get_bind())
+
+    # The type is created above, so the columns must not create it again
+    job_status_column = postgresql.ENUM(
+        *job_status_values, name="jobstatus", create_type=False
+    )
+
+    op.create_table(
+        "job",
+        sa.Column("id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("import_service", sa.String(), nullable=False),
+        sa.Column("import_url", sa.String(), nullable=False),
+        sa.Column("import_token", sa.String(), nullable=True),
+        sa.Column("export_service", sa.String(), nullable=False),
+        sa.Column("export_url", sa.String(), nullable=False),
+        sa.Column("export_token", sa.String(), nullable=True),
+        sa.Column("status", job_status_column, nullable=False),
+        sa.Column("total_items", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("imported_items", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("exported_items", sa.Integer(), server_default="0", nullable=False),
+        sa.Column("path", sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+    op.create_table(
+        "job_log",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("job_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column(
+            "timestamp", sa.DateTime(), server_default=sa.text("now()"), nullable=True
+        ),
+        sa.Column("from_status", job_status_column, nullable=True),
+        sa.Column("to_status", job_status_column, nullable=False),
+        sa.ForeignKeyConstraint(["job_id"], ["job.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+    )
+
+    op.create_table(
+        "manifest",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("job_id", postgresql.UUID(as_uuid=True), nullable=True),
+        sa.Column("project_name", sa.String(), server_default="", nullable=False),
+        sa.Column(
+            "project_description", sa.String(), server_default="", nullable=False
+        ),
+        sa.Column("source_url", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(["job_id"], ["job.id"]),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("job_id"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("manifest")
+    op.drop_table("job_log")
+    op.drop_table("job")
+    postgresql.ENUM(name="jobstatus").drop(op.get_bind())
@@ -0,0 +1,34 @@
+"""Add exported files of each job
+
+Revision ID: 7c3f2a91d6b4
+Revises: bd9e4450d5fa
+Create Date: 2026-10-18 16:10:00.000000
+
+"""
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7c3f2a91d6b4"
+down_revision = "bd9e4450d5fa"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        "exported_file",
+        sa.Column("id", sa.Integer(), nullable=False),
+        sa.Column("job_id", postgresql.UUID(as_uuid=True), nullable=False),
+        sa.Column("path", sa.String(), nullable=False),
+        sa.Column("content_hash", sa.String(), nullable=False),
+        sa.ForeignKeyConstraint(["job_id"], ["job.id"], ondelete="CASCADE"),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("job_id", "path"),
+    )
+
+
+def downgrade() -> None:
+    op.drop_table("exported_file")
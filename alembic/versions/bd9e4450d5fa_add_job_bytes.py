@@ -0,0 +1,29 @@
+"""Add byte counters to job
+
+Revision ID: bd9e4450d5fa
+Revises: 21b8b7fc7bff
+Create Date: 2026-10-18 12:35:00.000000
+
+"""
+import sqlalchemy as sa
+
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "bd9e4450d5fa"
+down_revision = "21b8b7fc7bff"
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    for column_name in ("total_bytes", "imported_bytes", "exported_bytes"):
+        op.add_column(
+            "job",
+            sa.Column(column_name, sa.BigInteger(), server_default="0", nullable=False),
+        )
+
+
+def downgrade() -> None:
+    for column_name in ("exported_bytes", "imported_bytes", "total_bytes"):
+        op.drop_column("job", column_name)
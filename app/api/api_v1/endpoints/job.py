@@ -39,7 +39,10 @@ def get_job(*, db: Session = Depends(deps.get_db), job_id: uuid.UUID) -> Any:
             detail=f"Job with id {job_id} not found",
         )
 
-    return job
+    job_out = schemas.Job.from_orm(job)
+    job_out.metrics = crud.job.get_metrics(db, db_obj=job)
+
+    return job_out
 
 
 @router.post("/{job_id}/retry", response_model=schemas.Job)
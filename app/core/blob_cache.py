@@ -0,0 +1,117 @@
+import os
+import shutil
+import uuid
+from typing import List, Optional, Tuple
+
+from app.core.config import settings
+
+
+def is_enabled() -> bool:
+    return settings.BLOB_CACHE_MAX_SIZE > 0
+
+
+def get_blob_path(service: str, content_hash: str) -> str:
+    assert settings.BLOB_CACHE_PATH
+    return os.path.join(
+        settings.BLOB_CACHE_PATH, service, content_hash[:2], content_hash
+    )
+
+
+def link_or_copy(source_path: str, target_path: str) -> None:
+    if os.path.lexists(target_path):
+        os.remove(target_path)
+
+    try:
+        os.link(source_path, target_path)
+    except OSError:
+        # Another filesystem, or one without hard links
+        shutil.copyfile(source_path, target_path)
+
+
+def release(path: str) -> None:
+    # A file fetched from the cache shares its content with the cached blob,
+    # and the downloads write in place, so it is removed before being
+    # downloaded again
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def fetch(service: str, content_hash: Optional[str], target_path: str) -> bool:
+    """
+    Link the cached file with the given hash to `target_path`.
+    Returns False if it is not in the cache
+    """
+
+    if not is_enabled() or not content_hash:
+        return False
+
+    blob_path = get_blob_path(service, content_hash)
+
+    try:
+        # The modification time is used as the last access by the eviction
+        os.utime(blob_path)
+        link_or_copy(blob_path, target_path)
+    except FileNotFoundError:
+        # Not cached, or evicted in the meantime
+        return False
+
+    return True
+
+
+def store(service: str, content_hash: Optional[str], source_path: str) -> None:
+    if not is_enabled() or not content_hash:
+        return
+
+    blob_path = get_blob_path(service, content_hash)
+
+    if os.path.exists(blob_path):
+        return
+
+    os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+
+    # Linked with a temporary name first, so other jobs never
+    # find a file that is being copied
+    temporary_path = f"{blob_path}.{uuid.uuid4().hex}.tmp"
+    link_or_copy(source_path, temporary_path)
+    os.replace(temporary_path, blob_path)
+
+
+def evict() -> None:
+    """
+    Remove the least recently used files until the cache
+    is not bigger than `BLOB_CACHE_MAX_SIZE`
+    """
+
+    if not is_enabled():
+        return
+
+    assert settings.BLOB_CACHE_PATH
+
+    blobs: List[Tuple[float, int, str]] = []
+
+    for (dirpath, _, filenames) in os.walk(settings.BLOB_CACHE_PATH):
+        for name in filenames:
+            blob_path = os.path.join(dirpath, name)
+
+            try:
+                blob_stat = os.stat(blob_path)
+            except FileNotFoundError:
+                continue
+
+            blobs.append((blob_stat.st_mtime, blob_stat.st_size, blob_path))
+
+    cache_size = sum(size for (_, size, _) in blobs)
+
+    for (_, size, blob_path) in sorted(blobs):
+        if cache_size <= settings.BLOB_CACHE_MAX_SIZE:
+            break
+
+        # The jobs using the file keep their own link to it
+        try:
+            os.remove(blob_path)
+        except FileNotFoundError:
+            pass
+
+        cache_size -= size
@@ -108,6 +108,84 @@ class Settings(BaseSettings):
 
     BROKER_URL: Optional[AnyUrl]
 
+    # Maximum number of jobs running at the same time against a service with the
+    # same token, across all the workers. Services not listed are not limited
+    SERVICE_CONCURRENCY_LIMITS: Dict[str, int] = {
+        "dropbox": 4,
+        "google_drive": 4,
+        "wikifactory": 8,
+    }
+    # Seconds before a job waiting for a busy service is retried
+    SERVICE_LIMIT_RETRY_DELAY: int = 30
+    # Seconds after which the slot of a job that never released it is freed
+    SERVICE_LIMIT_LEASE_TIMEOUT: int = 6 * 60 * 60
+
+    # Maximum number of concurrent Wikifactory requests per job
+    WIKIFACTORY_MAX_WORKERS: int = 8
+    # Maximum number of files sent in the same GraphQL request
+    WIKIFACTORY_BATCH_SIZE: int = 50
+    # Maximum number of batches of files exported at the same time per job
+    WIKIFACTORY_MAX_BATCHES: int = 4
+    # Maximum number of keep-alive connections kept per Wikifactory session
+    WIKIFACTORY_HTTP_POOL_SIZE: int = 10
+
+    # Size of a downloaded zip archive kept in memory before it goes to disk
+    ZIP_SPOOL_MAX_SIZE: int = 64 * 1024 * 1024
+    # The download progress of a zip archive is logged, and kept in the job
+    # until its files are extracted, every N bytes
+    ZIP_PROGRESS_LOG_STEP: int = 10 * 1024 * 1024
+
+    # Job progress increments are buffered and written every N items or seconds
+    PROGRESS_FLUSH_COUNT: int = 50
+    PROGRESS_FLUSH_INTERVAL: float = 2.0
+
+    # Downloaded files are kept in a cache, by their hash in the service, and
+    # linked into the job folders. It must be in the same filesystem as the jobs
+    BLOB_CACHE_PATH: Optional[str] = None
+
+    @validator("BLOB_CACHE_PATH", pre=True, always=True)
+    def default_blob_cache_path(cls, v: Optional[str], values: Dict[str, Any]) -> str:
+        if v:
+            return v
+
+        return os.path.join(values.get("JOBS_BASE_PATH") or "", ".blob-cache")
+
+    # Least recently used files are removed from the cache over this size,
+    # 0 disables the cache
+    BLOB_CACHE_MAX_SIZE: int = 10 * 1024 * 1024 * 1024
+
+    @validator("BLOB_CACHE_MAX_SIZE", pre=True, always=True)
+    def disable_blob_cache_in_tests(cls, v: int) -> int:
+        if "pytest" in sys.modules:
+            return 0
+
+        return v
+
+    # Maximum number of concurrent requests against Google Drive per job
+    GOOGLE_DRIVE_MAX_WORKERS: int = 8
+    # Several folders are listed with the same query, as long as
+    # it is not longer than this, since it is sent in the url
+    GOOGLE_DRIVE_QUERY_MAX_LENGTH: int = 2000
+
+    # Maximum number of concurrent downloads against Dropbox per job
+    DROPBOX_MAX_WORKERS: int = 8
+    # Maximum number of listed files waiting to be downloaded
+    DROPBOX_DOWNLOAD_QUEUE_SIZE: int = 64
+    # Shared folders with at least this many files, and files of this average
+    # size or smaller, are downloaded as a single zip archive
+    DROPBOX_ZIP_MIN_FILES: int = 50
+    DROPBOX_ZIP_MAX_AVERAGE_SIZE: int = 1024 * 1024
+    # Dropbox doesn't build the archive of folders with more files
+    DROPBOX_ZIP_MAX_FILES: int = 10000
+
+    # Stream the files from the importer to the exporter, without writing
+    # them to the job folder, when both services support it
+    STREAM_JOBS: bool = False
+    # Maximum number of downloaded files waiting to be exported
+    STREAM_QUEUE_SIZE: int = 16
+    # Bigger streamed files are kept in a temporary file instead of memory
+    STREAM_SPOOL_MAX_SIZE: int = 8 * 1024 * 1024
+
     class Config:
         case_sensitive = True
 
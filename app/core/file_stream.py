@@ -0,0 +1,76 @@
+import io
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import IO, Callable, Generator, Iterable, Set, TypeVar
+
+from app.core.config import settings
+
+T = TypeVar("T")
+
+
+class SourceUnreachable(Exception):
+    """
+    Raised by a file stream when a file can't be downloaded
+    """
+
+    pass
+
+
+class StreamedFile:
+    """
+    File handed from an importer to an exporter without going through
+    the job folder. Its content is positioned at the start of the file
+    """
+
+    def __init__(self, path: str, content: IO[bytes], size: int):
+        # Relative to the root of the project
+        self.path = path
+        self.content = content
+        self.size = size
+
+    def close(self) -> None:
+        self.content.close()
+
+
+def temporary_content(size: int) -> IO[bytes]:
+    # Small files are kept in memory, bigger ones in an anonymous
+    # temporary file, outside of the jobs volume
+    if size <= settings.STREAM_SPOOL_MAX_SIZE:
+        return io.BytesIO()
+
+    return tempfile.TemporaryFile()
+
+
+def download_ahead(
+    download: Callable[[T], StreamedFile],
+    items: Iterable[T],
+    max_workers: int,
+) -> Generator[StreamedFile, None, None]:
+    """
+    Download the items in threads, yielding the files as they are completed.
+    At most `STREAM_QUEUE_SIZE` files are downloaded ahead of the one
+    being exported, so the memory and disk used stay bounded
+    """
+
+    pending: Set[Future] = set()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for item in items:
+                if len(pending) >= settings.STREAM_QUEUE_SIZE:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        yield future.result()
+
+                pending.add(executor.submit(download, item))
+
+            while pending:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    yield future.result()
+        finally:
+            # Stop downloading when the exporter fails or stops early
+            for future in pending:
+                future.cancel()
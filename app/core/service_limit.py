@@ -0,0 +1,130 @@
+import hashlib
+import threading
+import uuid
+from collections import Counter
+from contextlib import contextmanager
+from typing import Iterator, Optional, Union
+
+import redis
+
+from app.core.config import settings
+
+# Drops the holders whose lease expired, then takes a slot if there is one left.
+# The Redis clock is used, so the workers don't need synchronised clocks
+ACQUIRE_SCRIPT = """
+local now = tonumber(redis.call("TIME")[1])
+local lease_timeout = tonumber(ARGV[3])
+
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now - lease_timeout)
+
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[1]) then
+    return 0
+end
+
+redis.call("ZADD", KEYS[1], now, ARGV[2])
+redis.call("EXPIRE", KEYS[1], lease_timeout)
+return 1
+"""
+
+
+class ServiceLimitReached(Exception):
+    pass
+
+
+class RedisLimiter:
+    """
+    Counts the jobs running against a service across every worker
+    """
+
+    def __init__(self, url: str):
+        self.redis = redis.Redis.from_url(url)
+        self.acquire_script = self.redis.register_script(ACQUIRE_SCRIPT)
+
+    def acquire(self, key: str, holder: str, limit: int) -> bool:
+        return bool(
+            self.acquire_script(
+                keys=[key],
+                args=[limit, holder, settings.SERVICE_LIMIT_LEASE_TIMEOUT],
+            )
+        )
+
+    def release(self, key: str, holder: str) -> None:
+        self.redis.zrem(key, holder)
+
+
+class InProcessLimiter:
+    """
+    Counts the jobs running against a service in this process only.
+    Used when the broker is not Redis
+    """
+
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.holders: Counter = Counter()
+
+    def acquire(self, key: str, holder: str, limit: int) -> bool:
+        with self.lock:
+            if self.holders[key] >= limit:
+                return False
+
+            self.holders[key] += 1
+            return True
+
+    def release(self, key: str, holder: str) -> None:
+        with self.lock:
+            self.holders[key] -= 1
+
+            if self.holders[key] <= 0:
+                del self.holders[key]
+
+
+limiter: Optional[Union[RedisLimiter, InProcessLimiter]] = None
+limiter_lock = threading.Lock()
+
+
+def get_limiter() -> Union[RedisLimiter, InProcessLimiter]:
+    global limiter
+
+    with limiter_lock:
+        if not limiter:
+            broker_url = str(settings.BROKER_URL or "")
+
+            if broker_url.startswith(("redis://", "rediss://")):
+                limiter = RedisLimiter(broker_url)
+            else:
+                limiter = InProcessLimiter()
+
+        return limiter
+
+
+def get_limit_key(service: str, token: Optional[str]) -> str:
+    # The token is hashed, so it is not stored in Redis
+    token_hash = hashlib.sha256((token or "").encode()).hexdigest()
+    return f"service-limit:{service}:{token_hash}"
+
+
+@contextmanager
+def service_limit(service: str, token: Optional[str]) -> Iterator[None]:
+    """
+    Hold one of the `SERVICE_CONCURRENCY_LIMITS[service]` slots of the service
+    for the given token, or raise ServiceLimitReached if all of them are taken.
+    Services without a limit are not counted
+    """
+
+    limit = settings.SERVICE_CONCURRENCY_LIMITS.get(service)
+
+    if not limit:
+        yield
+        return
+
+    key = get_limit_key(service, token)
+    holder = uuid.uuid4().hex
+    service_limiter = get_limiter()
+
+    if not service_limiter.acquire(key, holder, limit):
+        raise ServiceLimitReached(service)
+
+    try:
+        yield
+    finally:
+        service_limiter.release(key, holder)
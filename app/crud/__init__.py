@@ -1,2 +1,3 @@
+from .crud_exported_file import exported_file
 from .crud_job import job
 from .crud_manifest import manifest
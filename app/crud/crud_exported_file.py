@@ -0,0 +1,38 @@
+from typing import Dict
+
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm import Session
+
+from app.crud.base import CRUDBase
+from app.models.exported_file import ExportedFile
+from app.schemas import ExportedFileInput
+
+
+class CRUDExportedFile(CRUDBase[ExportedFile, ExportedFileInput, ExportedFileInput]):
+    def get_content_hashes(self, db: Session, *, job_id: str) -> Dict[str, str]:
+        # Content hash of each exported file, by path
+        return dict(
+            db.query(ExportedFile.path, ExportedFile.content_hash).filter(
+                ExportedFile.job_id == job_id
+            )
+        )
+
+    def update_or_create_many(
+        self, db: Session, *, job_id: str, content_hashes: Dict[str, str]
+    ) -> None:
+        statement = insert(ExportedFile).values(
+            [
+                {"job_id": job_id, "path": path, "content_hash": content_hash}
+                for (path, content_hash) in content_hashes.items()
+            ]
+        )
+        db.execute(
+            statement.on_conflict_do_update(
+                index_elements=[ExportedFile.job_id, ExportedFile.path],
+                set_={"content_hash": statement.excluded.content_hash},
+            )
+        )
+        db.commit()
+
+
+exported_file = CRUDExportedFile(ExportedFile)
@@ -1,11 +1,16 @@
 import os
-from typing import Optional
+import time
+from datetime import datetime
+from types import TracebackType
+from typing import Dict, List, Optional, Type
 
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
 from sqlalchemy.sql.expression import not_
 
 from app.core.config import settings
 from app.crud.base import CRUDBase
+from app.crud.crud_exported_file import exported_file as crud_exported_file
 from app.models.job import (
     Job,
     JobDuplicated,
@@ -18,7 +23,28 @@ from app.models.job import (
     terminated_job_statuses,
 )
 from app.models.job_log import JobLog
-from app.schemas.job import JobCreate, JobUpdate
+from app.schemas.job import JobCreate, JobMetrics, JobUpdate
+
+
+def get_phase_elapsed(
+    logs: List[JobLog], phase_status: JobStatus, now: datetime
+) -> Optional[float]:
+    # A phase starts with the last change to its status
+    # and finishes with the next change from it
+    started_at = None
+    finished_at = None
+
+    for log in logs:
+        if log.to_status is phase_status:
+            started_at = log.timestamp
+            finished_at = None
+        elif started_at and not finished_at and log.from_status is phase_status:
+            finished_at = log.timestamp
+
+    if not started_at:
+        return None
+
+    return ((finished_at or now) - started_at).total_seconds()
 
 
 class CRUDJob(CRUDBase[Job, JobCreate, JobUpdate]):
@@ -58,6 +84,10 @@ class CRUDJob(CRUDBase[Job, JobCreate, JobUpdate]):
         db.query(Job).filter(Job.id == job_id).update({Job.total_items: total_items})
         db.commit()
 
+    def update_total_bytes(self, db: Session, *, job_id: str, total_bytes: int) -> None:
+        db.query(Job).filter(Job.id == job_id).update({Job.total_bytes: total_bytes})
+        db.commit()
+
     def update_imported_items(
         self, db: Session, *, job_id: str, imported_items: int
     ) -> None:
@@ -66,18 +96,112 @@ class CRUDJob(CRUDBase[Job, JobCreate, JobUpdate]):
         )
         db.commit()
 
-    def increment_imported_items(self, db: Session, *, job_id: str) -> None:
+    def update_imported_bytes(
+        self, db: Session, *, job_id: str, imported_bytes: int
+    ) -> None:
+        db.query(Job).filter(Job.id == job_id).update(
+            {Job.imported_bytes: imported_bytes}
+        )
+        db.commit()
+
+    def reset_imported_items(self, db: Session, *, job_id: str) -> None:
+        # The files are counted again when the import is retried
+        db.query(Job).filter(Job.id == job_id).update(
+            {Job.imported_items: 0, Job.imported_bytes: 0}
+        )
+        db.commit()
+
+    def reset_exported_items(self, db: Session, *, job_id: str) -> None:
+        # The files exported by a previous attempt are counted again when skipped
+        db.query(Job).filter(Job.id == job_id).update(
+            {Job.exported_items: 0, Job.exported_bytes: 0}
+        )
+        db.commit()
+
+    def increment_imported_items(
+        self, db: Session, *, job_id: str, amount: int = 1
+    ) -> None:
         db.query(Job).filter(Job.id == job_id).update(
-            {Job.imported_items: Job.imported_items + 1}
+            {Job.imported_items: Job.imported_items + amount}
         )
         db.commit()
 
-    def increment_exported_items(self, db: Session, *, job_id: str) -> None:
+    def increment_exported_items(
+        self, db: Session, *, job_id: str, amount: int = 1
+    ) -> None:
         db.query(Job).filter(Job.id == job_id).update(
-            {Job.exported_items: Job.exported_items + 1}
+            {Job.exported_items: Job.exported_items + amount}
         )
         db.commit()
 
+    def increment_items(
+        self,
+        db: Session,
+        *,
+        job_id: str,
+        imported_items: int = 0,
+        exported_items: int = 0,
+        imported_bytes: int = 0,
+        exported_bytes: int = 0,
+    ) -> None:
+        db.query(Job).filter(Job.id == job_id).update(
+            {
+                Job.imported_items: Job.imported_items + imported_items,
+                Job.exported_items: Job.exported_items + exported_items,
+                Job.imported_bytes: Job.imported_bytes + imported_bytes,
+                Job.exported_bytes: Job.exported_bytes + exported_bytes,
+            }
+        )
+        db.commit()
+
+    def progress(self, db: Session, *, job_id: str) -> "JobProgress":
+        return JobProgress(self, db, job_id=job_id)
+
+    def get_metrics(self, db: Session, *, db_obj: Job) -> JobMetrics:
+        logs = (
+            db.query(JobLog)
+            .filter(JobLog.job_id == db_obj.id)
+            .order_by(JobLog.timestamp, JobLog.id)
+            .all()
+        )
+
+        # Same clock as the one used for the log timestamps
+        now = db.query(func.localtimestamp()).scalar()
+
+        metrics = JobMetrics(
+            importing_elapsed=get_phase_elapsed(logs, JobStatus.IMPORTING, now),
+            exporting_elapsed=get_phase_elapsed(logs, JobStatus.EXPORTING, now),
+        )
+
+        if db_obj.status is JobStatus.IMPORTING:
+            elapsed = metrics.importing_elapsed
+            done_items = db_obj.imported_items
+            done_bytes = db_obj.imported_bytes
+        elif db_obj.status is JobStatus.EXPORTING:
+            elapsed = metrics.exporting_elapsed
+            done_items = db_obj.exported_items
+            done_bytes = db_obj.exported_bytes
+        else:
+            return metrics
+
+        if not elapsed:
+            return metrics
+
+        metrics.items_per_second = done_items / elapsed
+        metrics.bytes_per_second = done_bytes / elapsed
+
+        # The bytes give a better estimation when the sizes are known
+        if db_obj.total_bytes and metrics.bytes_per_second:
+            metrics.estimated_time_remaining = (
+                max(db_obj.total_bytes - done_bytes, 0) / metrics.bytes_per_second
+            )
+        elif db_obj.total_items and metrics.items_per_second:
+            metrics.estimated_time_remaining = (
+                max(db_obj.total_items - done_items, 0) / metrics.items_per_second
+            )
+
+        return metrics
+
     def cancel(self, db: Session, *, db_obj: Job) -> Job:
         if not self.is_active(job=db_obj):
             raise JobNotCancellable()
@@ -113,4 +237,97 @@ class CRUDJob(CRUDBase[Job, JobCreate, JobUpdate]):
         return job.status in can_export_job_statuses
 
 
+class JobProgress:
+    """
+    Buffers the progress of a job in memory and writes it to the database
+    in a single UPDATE every `PROGRESS_FLUSH_COUNT` items or
+    `PROGRESS_FLUSH_INTERVAL` seconds, and always when leaving the context.
+
+    It is not thread-safe, so it should only be used from the thread
+    that owns the db session.
+    """
+
+    def __init__(self, crud_job: CRUDJob, db: Session, *, job_id: str):
+        self.crud_job = crud_job
+        self.db = db
+        self.job_id = job_id
+        self.imported_items = 0
+        self.exported_items = 0
+        self.imported_bytes = 0
+        self.exported_bytes = 0
+        # Content hash of the exported files, by path
+        self.exported_files: Dict[str, str] = {}
+        self.last_flush = time.monotonic()
+
+    def __enter__(self) -> "JobProgress":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.flush()
+
+    def increment_imported_items(self, amount: int = 1) -> None:
+        self.imported_items += amount
+        self.flush_if_needed()
+
+    def increment_exported_items(self, amount: int = 1) -> None:
+        self.exported_items += amount
+        self.flush_if_needed()
+
+    def increment_imported_bytes(self, amount: int) -> None:
+        self.imported_bytes += amount
+        self.flush_if_needed()
+
+    def increment_exported_bytes(self, amount: int) -> None:
+        self.exported_bytes += amount
+        self.flush_if_needed()
+
+    def add_exported_file(self, path: str, content_hash: str) -> None:
+        # Recorded, so a retry of the export can skip it. Counted separately
+        self.exported_files[path] = content_hash
+        self.flush_if_needed()
+
+    def flush_if_needed(self) -> None:
+        pending_items = self.imported_items + self.exported_items
+        elapsed = time.monotonic() - self.last_flush
+
+        if (
+            pending_items >= settings.PROGRESS_FLUSH_COUNT
+            or elapsed >= settings.PROGRESS_FLUSH_INTERVAL
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if (
+            self.imported_items
+            or self.exported_items
+            or self.imported_bytes
+            or self.exported_bytes
+        ):
+            self.crud_job.increment_items(
+                self.db,
+                job_id=self.job_id,
+                imported_items=self.imported_items,
+                exported_items=self.exported_items,
+                imported_bytes=self.imported_bytes,
+                exported_bytes=self.exported_bytes,
+            )
+            self.imported_items = 0
+            self.exported_items = 0
+            self.imported_bytes = 0
+            self.exported_bytes = 0
+
+        if self.exported_files:
+            crud_exported_file.update_or_create_many(
+                self.db, job_id=self.job_id, content_hashes=self.exported_files
+            )
+            self.exported_files = {}
+
+        self.last_flush = time.monotonic()
+
+
 job = CRUDJob(Job)
@@ -10,7 +10,7 @@ from app.db.session import engine
 
 
 def init_db(db: Session) -> None:
-    # Tables should be created with Alembic migrations
-    # But if you don't want to use migrations, create
-    # the tables un-commenting the next line
+    # Tables are created with Alembic migrations by prestart.sh,
+    # this only creates them in databases without migrations,
+    # like the one of the tests
     Base.metadata.create_all(bind=engine)
@@ -1,18 +1,29 @@
 import shutil
 import traceback
 from types import FunctionType
-from typing import Any, Iterable
+from typing import Any, Iterable, Iterator
 
 from sqlalchemy.orm import Session
 
+from app.core.file_stream import StreamedFile
+
 
 class BaseExporter:
+    # Whether the files can be taken from the importer one by one,
+    # instead of being read from the job folder
+    supports_streaming = False
+
     def __init__(self, db: Session, job_id: str):
         raise NotImplementedError()
 
     def process(self) -> None:
         raise NotImplementedError()
 
+    def process_stream(self, files: Iterator[StreamedFile]) -> None:
+        # Does the export like `process`, with the files of the importer.
+        # Each file is closed once it has been exported
+        raise NotImplementedError()
+
     def clean_download_folder(self, path: str) -> None:
         def onerror(function: FunctionType, path: str, excinfo: Iterable[Any]) -> None:
             print(f"While processing {path}")
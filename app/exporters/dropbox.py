@@ -1,5 +1,5 @@
 import os
-from typing import Optional
+from typing import IO, Callable, Dict, Iterator, Optional
 
 import dropbox
 from dropbox.dropbox_client import BadInputException, Dropbox
@@ -8,7 +8,9 @@ from sqlalchemy.orm import Session
 from stone.backends.python_rsrc.stone_validators import ValidationError
 
 from app import crud
+from app.core.file_stream import SourceUnreachable, StreamedFile
 from app.exporters.base import BaseExporter
+from app.importers.dropbox import dropbox_content_hash_from_file
 from app.models.job import Job, JobStatus
 
 
@@ -24,20 +26,42 @@ CHUNK_SIZE = 5 * 1024 * 1024  # Size in bytes
 
 
 class DropboxExporter(BaseExporter):
+    supports_streaming = True
+
     def __init__(self, db: Session, job_id: str):
         self.db = db
         self.job_id = job_id
         self.dropbox_handler: Optional[Dropbox] = None
+        # Content hash of the files uploaded by previous attempts, by path
+        self.exported_files: Dict[str, str] = {}
 
     def process(self) -> None:
+        job: Job = crud.job.get(self.db, self.job_id)
+        assert job
+
+        if self.export(self.upload_job_folder):
+            # Finally, remove the local files
+            self.clean_download_folder(job.path)
+
+    def process_stream(self, files: Iterator[StreamedFile]) -> None:
+        self.export(lambda: self.upload_streamed_files(files))
+
+    def export(self, upload: Callable[[], None]) -> bool:
         # Note: the Dropbox exporter will only accept endpoints with the following format:
         # https://www.dropbox.com/home/path/to/folder
         # Hence, shared links will not be accepted
 
+        # Returns whether the files were uploaded
+
         job: Job = crud.job.get(self.db, self.job_id)
         assert job
 
         crud.job.update_status(self.db, db_obj=job, status=JobStatus.EXPORTING)
+        crud.job.reset_exported_items(self.db, job_id=self.job_id)
+
+        self.exported_files = crud.exported_file.get_content_hashes(
+            self.db, job_id=self.job_id
+        )
 
         try:
             if len(job.export_token) == 0:
@@ -55,17 +79,17 @@ class DropboxExporter(BaseExporter):
                 db_obj=job,
                 status=JobStatus.EXPORTING_ERROR_AUTHORIZATION_REQUIRED,
             )
-            return
+            return False
 
         try:
-            self.upload_job_folder()
-        except (FileUploadFailed, MalformedDropboxURL):
+            upload()
+        except (FileUploadFailed, MalformedDropboxURL, SourceUnreachable):
             crud.job.update_status(
                 self.db,
                 db_obj=job,
                 status=JobStatus.EXPORTING_ERROR_DATA_UNREACHABLE,
             )
-            return
+            return False
 
         crud.job.update_status(
             self.db, db_obj=job, status=JobStatus.EXPORTING_SUCCESSFULLY
@@ -74,8 +98,7 @@ class DropboxExporter(BaseExporter):
             self.db, db_obj=job, status=JobStatus.FINISHED_SUCCESSFULLY
         )
 
-        # Finally, remove the local files
-        self.clean_download_folder(job.path)
+        return True
 
     def upload_job_folder(self) -> None:
 
@@ -83,70 +106,155 @@ class DropboxExporter(BaseExporter):
 
         path_to_local_files = job.path
 
-        for dir, _, files in os.walk(path_to_local_files):
+        with crud.job.progress(self.db, job_id=self.job_id) as progress:
+
+            for dir, _, files in os.walk(path_to_local_files):
+
+                for file in files:
+
+                    local_file_path = os.path.join(dir, file)
+                    relative_path = os.path.relpath(
+                        local_file_path, path_to_local_files
+                    )
+                    destination_path = os.path.join(
+                        job.export_url.replace("https://www.dropbox.com/home", ""),
+                        relative_path,
+                    )
+
+                    with open(local_file_path, "rb") as f:
+                        exported = self.is_exported(relative_path, f)
+
+                    if not exported:
+                        content_hash = self.upload_file(
+                            local_file_path,
+                            destination_path,
+                            overwrite=relative_path in self.exported_files,
+                        )
+
+                        if content_hash:
+                            progress.add_exported_file(relative_path, content_hash)
+
+                    # Update the exported items
+                    progress.increment_exported_items()
+                    progress.increment_exported_bytes(os.path.getsize(local_file_path))
+
+    def upload_streamed_files(self, files: Iterator[StreamedFile]) -> None:
+
+        job: Job = crud.job.get(self.db, self.job_id)
+
+        with crud.job.progress(self.db, job_id=self.job_id) as progress:
 
-            for file in files:
+            for streamed_file in files:
 
-                local_file_path = os.path.join(dir, file)
                 destination_path = os.path.join(
                     job.export_url.replace("https://www.dropbox.com/home", ""),
-                    os.path.relpath(local_file_path, path_to_local_files),
+                    streamed_file.path,
                 )
 
-                self.upload_file(local_file_path, destination_path)
+                with streamed_file.content:
+                    if not self.is_exported(streamed_file.path, streamed_file.content):
+                        content_hash = self.upload_content(
+                            streamed_file.content,
+                            streamed_file.size,
+                            destination_path,
+                            overwrite=streamed_file.path in self.exported_files,
+                        )
+
+                        if content_hash:
+                            progress.add_exported_file(streamed_file.path, content_hash)
 
                 # Update the exported items
-                crud.job.increment_exported_items(self.db, job_id=self.job_id)
+                progress.increment_exported_items()
+                progress.increment_exported_bytes(streamed_file.size)
 
-    def upload_file(self, local_path: str, remote_path: str) -> None:
+    def is_exported(self, relative_path: str, f: IO[bytes]) -> bool:
+        # Whether a previous attempt already uploaded the same content
+        content_hash = self.exported_files.get(relative_path)
 
-        assert self.dropbox_handler
+        if not content_hash:
+            return False
 
-        # IMPORTANT: The dropbox application must have the files.content.write permission
-        try:
+        exported = dropbox_content_hash_from_file(f) == content_hash
+        f.seek(0)
 
-            with open(local_path, "rb") as f:
+        return exported
 
-                file_size = os.path.getsize(local_path)
+    def upload_file(
+        self, local_path: str, remote_path: str, overwrite: bool = False
+    ) -> Optional[str]:
+        # Returns the content hash of the uploaded file
 
-                if (
-                    file_size <= CHUNK_SIZE
-                ):  # Use the direct upload approach for small files
+        try:
 
-                    self.dropbox_handler.files_upload(f.read(), remote_path)
-                else:  # Otherwise, use the session aproach
+            with open(local_path, "rb") as f:
 
-                    upload_session_start_result = (
-                        self.dropbox_handler.files_upload_session_start(
-                            f.read(CHUNK_SIZE)
-                        )
-                    )
-                    cursor = dropbox.files.UploadSessionCursor(
-                        session_id=upload_session_start_result.session_id,
-                        offset=f.tell(),
-                    )
-                    commit = dropbox.files.CommitInfo(path=remote_path)
-
-                    while f.tell() < file_size:
-                        if (file_size - f.tell()) <= CHUNK_SIZE:
-                            self.dropbox_handler.files_upload_session_finish(
-                                f.read(CHUNK_SIZE), cursor, commit
-                            )
-                        else:
-                            self.dropbox_handler.files_upload_session_append(
-                                f.read(CHUNK_SIZE), cursor.session_id, cursor.offset
-                            )
-                            cursor.offset = f.tell()
+                return self.upload_content(
+                    f, os.path.getsize(local_path), remote_path, overwrite
+                )
 
         except OSError as e:
             print("Error opening the local file")
             raise e
 
+    def upload_content(
+        self, f: IO[bytes], file_size: int, remote_path: str, overwrite: bool = False
+    ) -> Optional[str]:
+        # Returns the content hash of the uploaded file
+
+        assert self.dropbox_handler
+
+        metadata = None
+
+        # A file uploaded by a previous attempt with a different content
+        # is replaced, instead of being added next to it with a new name
+        mode = (
+            dropbox.files.WriteMode.overwrite
+            if overwrite
+            else dropbox.files.WriteMode.add
+        )
+
+        # IMPORTANT: The dropbox application must have the files.content.write permission
+        try:
+
+            if (
+                file_size <= CHUNK_SIZE
+            ):  # Use the direct upload approach for small files
+
+                metadata = self.dropbox_handler.files_upload(
+                    f.read(), remote_path, mode=mode
+                )
+            else:  # Otherwise, use the session aproach
+
+                upload_session_start_result = (
+                    self.dropbox_handler.files_upload_session_start(f.read(CHUNK_SIZE))
+                )
+                cursor = dropbox.files.UploadSessionCursor(
+                    session_id=upload_session_start_result.session_id,
+                    offset=f.tell(),
+                )
+                commit = dropbox.files.CommitInfo(path=remote_path, mode=mode)
+
+                while f.tell() < file_size:
+                    if (file_size - f.tell()) <= CHUNK_SIZE:
+                        metadata = self.dropbox_handler.files_upload_session_finish(
+                            f.read(CHUNK_SIZE), cursor, commit
+                        )
+                    else:
+                        self.dropbox_handler.files_upload_session_append(
+                            f.read(CHUNK_SIZE), cursor.session_id, cursor.offset
+                        )
+                        cursor.offset = f.tell()
+
         except ApiError as e:
             print("Error uploading the file")
-            raise FileUploadFailed(f"Error uploading file: {local_path}") from e
+            raise FileUploadFailed(f"Error uploading file: {remote_path}") from e
 
         except ValidationError as e:
             raise MalformedDropboxURL(
                 "Maybe you are trying to import from a shared link?"
             ) from e
+
+        if isinstance(metadata, dropbox.files.FileMetadata):
+            return metadata.content_hash
+
+        return None
@@ -1,6 +1,7 @@
+import os
 import subprocess
 from re import search
-from typing import Dict
+from typing import Dict, List
 
 from sqlalchemy.orm import Session
 
@@ -17,6 +18,19 @@ def user_project_service_from_url(url: str) -> Dict:
     return match.groupdict()
 
 
+def list_project_files(path: str) -> List[str]:
+    # Files of the job folder, without the ones of the git repository
+    project_files: List[str] = []
+
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        if ".git" in dirnames:
+            dirnames.remove(".git")
+
+        project_files.extend(os.path.join(dirpath, name) for name in filenames)
+
+    return project_files
+
+
 class GitServiceNotSupported(Exception):
     pass
 
@@ -44,9 +58,20 @@ class GitExporter(BaseExporter):
         assert job
 
         crud.job.update_status(self.db, db_obj=job, status=JobStatus.EXPORTING)
+        crud.job.reset_exported_items(self.db, job_id=self.job_id)
 
         try:
             self.push_to_repo_url()
+
+            # A push is all or nothing, so the files are counted once it is done
+            project_files = list_project_files(job.path)
+            crud.job.increment_items(
+                self.db,
+                job_id=self.job_id,
+                exported_items=len(project_files),
+                exported_bytes=sum(os.lstat(path).st_size for path in project_files),
+            )
+
             crud.job.update_status(
                 self.db, db_obj=job, status=JobStatus.EXPORTING_SUCCESSFULLY
             )
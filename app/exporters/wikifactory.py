@@ -1,30 +1,57 @@
+import asyncio
+import hashlib
 import os
+import threading
 import traceback
+from contextlib import contextmanager
+from itertools import islice
 from re import search
-from typing import IO, Dict, Optional
+from types import TracebackType
+from typing import (
+    IO,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NoReturn,
+    Optional,
+    Tuple,
+    Type,
+    Union,
+)
 
+import aiohttp
 import magic
-import pygit2
 import requests
 from gql import Client
 from gql.transport.requests import RequestsHTTPTransport
+from graphql.language.ast import Document
+from graphql.language.printer import print_ast
+from requests.adapters import HTTPAdapter
 from requests.models import HTTPError
 from sqlalchemy.orm import Session
 
 from app import crud
 from app.core.config import settings
+from app.core.file_stream import SourceUnreachable, StreamedFile
+from app.crud.crud_job import JobProgress
 from app.exporters.base import AuthRequired, BaseExporter, NotReachable
 from app.models.job import JobStatus
 from app.service_validators.services import wikifactory_validator
 
 from .wikifactory_gql import (
+    batch_mutation,
     commit_contribution_mutation,
-    complete_file_mutation,
-    file_mutation,
-    operation_mutation,
+    complete_file_field,
+    file_field,
+    operation_field,
     project_query,
 )
 
+# Size of the chunks read while scanning a file. The first chunk
+# is also used to guess the content type of the file
+SCAN_CHUNK_SIZE = 1024 * 1024  # Size in bytes
+
 
 class FileUploadFailed(Exception):
     pass
@@ -38,38 +65,150 @@ class UserErrors(Exception):
     pass
 
 
-def wikifactory_api_request(
-    graphql_document: str,
+class WikifactorySession:
+    """
+    Keep-alive HTTP connections and GraphQL client shared by every request
+    made with the same token, including the transfers of the files
+    """
+
+    def __init__(self, auth_token: Optional[str]):
+        self.http = requests.Session()
+
+        adapter = HTTPAdapter(pool_maxsize=settings.WIKIFACTORY_HTTP_POOL_SIZE)
+        for prefix in ("http://", "https://"):
+            self.http.mount(prefix, adapter)
+
+        # The token is only sent to the API, not set on the shared HTTP session
+        headers = {"Authorization": f"Bearer {auth_token}"} if auth_token else None
+        transport = RequestsHTTPTransport(
+            url=f"{settings.WIKIFACTORY_API_BASE_URL}/api/graphql",
+            headers=headers,
+        )
+        transport.session = self.http
+
+        self.client = Client(transport=transport, fetch_schema_from_transport=False)
+
+    def close(self) -> None:
+        self.http.close()
+
+
+wikifactory_sessions: Dict[Tuple[str, Optional[str]], WikifactorySession] = {}
+wikifactory_sessions_lock = threading.Lock()
+
+
+def get_wikifactory_session(auth_token: Optional[str]) -> WikifactorySession:
+    key = (str(settings.WIKIFACTORY_API_BASE_URL), auth_token)
+
+    with wikifactory_sessions_lock:
+        if key not in wikifactory_sessions:
+            wikifactory_sessions[key] = WikifactorySession(auth_token)
+
+        return wikifactory_sessions[key]
+
+
+def close_wikifactory_session(auth_token: Optional[str]) -> None:
+    key = (str(settings.WIKIFACTORY_API_BASE_URL), auth_token)
+
+    with wikifactory_sessions_lock:
+        session = wikifactory_sessions.pop(key, None)
+
+    if session:
+        session.close()
+
+
+class AsyncWikifactorySession:
+    """
+    Connections and concurrency limit shared by the requests made
+    with the same token from a single event loop.
+    It has to be created inside the loop that will use it
+    """
+
+    def __init__(self, auth_token: Optional[str]):
+        self.auth_token = auth_token
+        self.http = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=settings.WIKIFACTORY_HTTP_POOL_SIZE)
+        )
+        self.semaphore = asyncio.Semaphore(settings.WIKIFACTORY_MAX_WORKERS)
+
+    async def __aenter__(self) -> "AsyncWikifactorySession":
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: Optional[Type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        await self.http.close()
+
+
+def is_unauthorized_error(error_message: str) -> bool:
+    unauthorized_messages = ["unauthorized", "token is invalid"]
+
+    return any(message in error_message for message in unauthorized_messages)
+
+
+def raise_request_error(error_message: str) -> NoReturn:
+    if is_unauthorized_error(error_message):
+        raise AuthRequired
+
+    raise NotReachable(error_message)
+
+
+def execute_wikifactory_request(
+    graphql_document: Document,
     auth_token: str,
     variables: object,
-    result_path: str,
 ) -> Dict:
-    headers = {"Authorization": f"Bearer {auth_token}"} if auth_token else None
-    transport = RequestsHTTPTransport(
-        url=f"{settings.WIKIFACTORY_API_BASE_URL}/api/graphql",
-        headers=headers,
-    )
-
-    session = Client(transport=transport, fetch_schema_from_transport=False)
+    session = get_wikifactory_session(auth_token)
 
     try:
-        # FIXME - this seems to be a sync request. In the future,
-        # we should look into making requests async
-        execution_result = session.execute(graphql_document, variable_values=variables)
+        return session.client.execute(graphql_document, variable_values=variables)
     except HTTPError as http_error:
         if http_error.response.status_code is requests.codes["unauthorized"]:
             raise AuthRequired
         raise NotReachable(http_error)
     except Exception as gql_error:
-        error_message = str(gql_error)
-        unauthorized_messages = ["unauthorized", "token is invalid"]
+        raise_request_error(str(gql_error))
 
-        for message in unauthorized_messages:
-            if message in error_message:
-                raise AuthRequired
 
-        raise NotReachable(error_message)
+async def execute_wikifactory_request_async(
+    session: AsyncWikifactorySession,
+    graphql_document: Document,
+    variables: object,
+) -> Dict:
+    headers = (
+        {"Authorization": f"Bearer {session.auth_token}"} if session.auth_token else {}
+    )
+    payload = {"query": print_ast(graphql_document), "variables": variables}
 
+    try:
+        async with session.semaphore, session.http.post(
+            f"{settings.WIKIFACTORY_API_BASE_URL}/api/graphql",
+            json=payload,
+            headers=headers,
+        ) as response:
+            try:
+                result = await response.json(content_type=None)
+            except ValueError:
+                result = None
+
+            if not isinstance(result, dict) or (
+                "errors" not in result and "data" not in result
+            ):
+                if response.status == requests.codes["unauthorized"]:
+                    raise AuthRequired
+                raise NotReachable(
+                    f"Server did not return a GraphQL result. Status code: {response.status}"
+                )
+    except aiohttp.ClientError as client_error:
+        raise NotReachable(client_error)
+
+    # The GraphQL errors are left to the caller, along with the data
+    return result
+
+
+def get_execution_result_path(execution_result: Dict, result_path: str) -> Dict:
     result_path_root, *result_path_rest = result_path.split(".")
 
     try:
@@ -100,90 +239,394 @@ def wikifactory_api_request(
     return result
 
 
+def wikifactory_api_request(
+    graphql_document: Document,
+    auth_token: str,
+    variables: object,
+    result_path: str,
+) -> Dict:
+    execution_result = execute_wikifactory_request(
+        graphql_document, auth_token, variables
+    )
+
+    return get_execution_result_path(execution_result, result_path)
+
+
+async def wikifactory_api_batch_request(
+    session: AsyncWikifactorySession,
+    graphql_document: Document,
+    variables_list: List[object],
+    result_path: str,
+) -> List[Union[Dict, Exception]]:
+    # The document must be built with `batch_mutation`, so the result of the
+    # N-th element of `variables_list` is found under the `itemN` alias.
+    # Errors of a single element are returned in its position instead of raised
+    variables = {
+        f"item{index}": item_variables
+        for (index, item_variables) in enumerate(variables_list)
+    }
+
+    result = await execute_wikifactory_request_async(
+        session, graphql_document, variables
+    )
+
+    execution_result = result.get("data")
+
+    # GraphQL errors of a single element have the alias of the element
+    # as the first item of their path
+    item_errors: Dict[str, Dict] = {}
+
+    for error in result.get("errors") or []:
+        error_path = error.get("path")
+
+        # Same error handling as the gql client for the rest of the errors
+        if (
+            execution_result is None
+            or not error_path
+            or is_unauthorized_error(str(error))
+        ):
+            raise_request_error(str(error))
+
+        item_errors.setdefault(error_path[0], error)
+
+    _, *result_path_rest = result_path.split(".")
+
+    results: List[Union[Dict, Exception]] = []
+
+    for index in range(len(variables_list)):
+        alias = f"item{index}"
+
+        if alias in item_errors:
+            results.append(NotReachable(str(item_errors[alias])))
+            continue
+
+        item_result_path = ".".join([alias, *result_path_rest])
+
+        try:
+            results.append(
+                get_execution_result_path(execution_result or {}, item_result_path)
+            )
+        except (AuthRequired, NoResult, UserErrors) as error:
+            results.append(error)
+
+    return results
+
+
 def space_slug_from_url(url: str) -> Dict:
     match = search(wikifactory_validator.keywords["regexes"][0], url)
     assert match
     return match.groupdict()
 
 
+class LocalFile:
+    """
+    File to be exported. Its size, git hash and content type are computed
+    together the first time any of them is needed, reading the file only once.
+    Streamed files are given their content, their path in the job folder
+    is only used to name them
+    """
+
+    def __init__(self, path: str, content: Optional[IO[bytes]] = None):
+        self.path = path
+        self.content = content
+        self._size: Optional[int] = None
+        self._git_hash: Optional[str] = None
+        self._content_type: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        self.scan()
+        assert self._size is not None
+        return self._size
+
+    @property
+    def git_hash(self) -> str:
+        self.scan()
+        assert self._git_hash
+        return self._git_hash
+
+    @property
+    def content_type(self) -> str:
+        self.scan()
+        assert self._content_type
+        return self._content_type
+
+    @contextmanager
+    def open(self) -> Iterator[IO[bytes]]:
+        if self.content is None:
+            with open(self.path, "rb") as file_handle:
+                yield file_handle
+        else:
+            self.content.seek(0)
+            yield self.content
+
+    def scan(self) -> None:
+        if self._size is not None:
+            return
+
+        with self.open() as file_handle:
+            size = file_handle.seek(0, os.SEEK_END)
+            file_handle.seek(0)
+
+            # Same hash as `git hash-object`
+            git_hash = hashlib.sha1(f"blob {size}\0".encode())
+
+            first_chunk = file_handle.read(SCAN_CHUNK_SIZE)
+            git_hash.update(first_chunk)
+
+            for chunk in iter(lambda: file_handle.read(SCAN_CHUNK_SIZE), b""):
+                git_hash.update(chunk)
+
+        self._content_type = magic.from_buffer(first_chunk, mime=True)
+        self._git_hash = git_hash.hexdigest()
+        self._size = size
+
+
+def raise_batch_errors(
+    local_files: List[LocalFile], results: List[Union[Dict, Exception]], message: str
+) -> None:
+    for (local_file, result) in zip(local_files, results):
+        if isinstance(result, AuthRequired):
+            raise result
+
+        if isinstance(result, Exception):
+            raise FileUploadFailed(f"{message}: {local_file.path}") from result
+
+
 class WikifactoryExporter(BaseExporter):
+    supports_streaming = True
+
     def __init__(self, db: Session, job_id: str):
         self.db = db
         self.job_id = job_id
         self.project_details: Optional[Dict] = None
 
-    def process(self) -> None:
+        # Files are exported from several threads, which can't share the db
+        # session, so keep what they need from the job
         job = crud.job.get(self.db, self.job_id)
         assert job
+        self.job_path = job.path
+        self.export_token = job.export_token
+        # Git hash of the files added by previous attempts, by project path
+        self.exported_files: Dict[str, str] = {}
 
-        crud.job.update_status(self.db, db_obj=job, status=JobStatus.EXPORTING)
-
-        self.project_details = self.get_project_details()
-        assert self.project_details
-
-        try:
-            for (dirpath, _, filenames) in os.walk(job.path):
-                for name in filenames:
-                    file_path = os.path.join(dirpath, name)
-                    self.on_file_cb(file_path)
+    def process(self) -> None:
+        job = crud.job.get(self.db, self.job_id)
+        assert job
 
-            self.on_finished_cb()
-
-            crud.job.update_status(
-                self.db, db_obj=job, status=JobStatus.EXPORTING_SUCCESSFULLY
-            )
-            crud.job.update_status(
-                self.db, db_obj=job, status=JobStatus.FINISHED_SUCCESSFULLY
-            )
+        local_files = [
+            LocalFile(os.path.join(dirpath, name))
+            for (dirpath, _, filenames) in os.walk(job.path)
+            for name in filenames
+        ]
 
+        if self.export(lambda: asyncio.run(self.export_files(local_files))):
             # Finally, remove the local files
             self.clean_download_folder(job.path)
-        except (FileUploadFailed, UserErrors, NotReachable):
-            traceback.print_exc()
 
-            # FIXME - improve error handling
-            crud.job.update_status(
-                self.db, db_obj=job, status=JobStatus.EXPORTING_ERROR_DATA_UNREACHABLE
-            )
+    def process_stream(self, files: Iterator[StreamedFile]) -> None:
+        self.export(lambda: asyncio.run(self.export_stream(files)))
 
-    def on_file_cb(self, file_path: str) -> None:
+    def export(self, export_files: Callable[[], None]) -> bool:
+        # Returns whether the files were exported
+        job = crud.job.get(self.db, self.job_id)
+        assert job
 
         try:
-            file_result = self.process_file(file_path)
-        except UserErrors:
-            raise FileUploadFailed("Wikifactory file couldn't be created")
-
-        wikifactory_file_id = file_result.get("id")
+            crud.job.update_status(self.db, db_obj=job, status=JobStatus.EXPORTING)
+            crud.job.reset_exported_items(self.db, job_id=self.job_id)
 
-        if not wikifactory_file_id:
-            raise FileUploadFailed(
-                "Wikifactory file couldn't be created. Missing File ID"
+            self.exported_files = crud.exported_file.get_content_hashes(
+                self.db, job_id=self.job_id
             )
 
-        s3_upload_url = file_result["uploadUrl"]
+            self.project_details = self.get_project_details()
+            assert self.project_details
+
+            try:
+                export_files()
+
+                # The commit is only done once every file has been added
+                self.on_finished_cb()
+
+                crud.job.update_status(
+                    self.db, db_obj=job, status=JobStatus.EXPORTING_SUCCESSFULLY
+                )
+                crud.job.update_status(
+                    self.db, db_obj=job, status=JobStatus.FINISHED_SUCCESSFULLY
+                )
+
+                return True
+            except (FileUploadFailed, UserErrors, NotReachable, SourceUnreachable):
+                traceback.print_exc()
+
+                # FIXME - improve error handling
+                crud.job.update_status(
+                    self.db,
+                    db_obj=job,
+                    status=JobStatus.EXPORTING_ERROR_DATA_UNREACHABLE,
+                )
+                return False
+        finally:
+            close_wikifactory_session(self.export_token)
+
+    async def export_files(self, local_files: List[LocalFile]) -> None:
+        batch_size = settings.WIKIFACTORY_BATCH_SIZE
+        batches = iter(
+            [
+                local_files[start : start + batch_size]
+                for start in range(0, len(local_files), batch_size)
+            ]
+        )
 
-        if not s3_upload_url:
-            # FIXME - this mean the file already exists on Wikifactory.
-            # We should probably query the "completed" status or raise an exception.
-            print(
-                "WARNING: There is no S3 url. This probably means a file with the same hash has already been uploaded"
+        async with AsyncWikifactorySession(self.export_token) as session:
+            with crud.job.progress(self.db, job_id=self.job_id) as progress:
+
+                # A few workers take the batches one after the other, so the
+                # pending tasks don't grow with the size of the project.
+                # The session limits how many requests are in flight
+                async def export_batches() -> None:
+                    for batch in batches:
+                        await self.export_and_record(session, progress, batch)
+
+                await asyncio.gather(
+                    *[export_batches() for _ in range(settings.WIKIFACTORY_MAX_BATCHES)]
+                )
+
+    async def export_stream(self, files: Iterator[StreamedFile]) -> None:
+        # The batches are exported one after the other, while the importer
+        # keeps downloading the next files in its threads. The files are
+        # taken from this thread, which is the only one using the db session
+        async with AsyncWikifactorySession(self.export_token) as session:
+            with crud.job.progress(self.db, job_id=self.job_id) as progress:
+                while True:
+                    batch = list(islice(files, settings.WIKIFACTORY_BATCH_SIZE))
+
+                    if not batch:
+                        break
+
+                    try:
+                        await self.export_and_record(
+                            session,
+                            progress,
+                            [
+                                LocalFile(
+                                    os.path.join(self.job_path, streamed_file.path),
+                                    streamed_file.content,
+                                )
+                                for streamed_file in batch
+                            ],
+                        )
+                    finally:
+                        for streamed_file in batch:
+                            streamed_file.close()
+
+    async def export_and_record(
+        self,
+        session: AsyncWikifactorySession,
+        progress: JobProgress,
+        local_files: List[LocalFile],
+    ) -> None:
+        pending_files = await self.skip_exported(local_files)
+
+        if pending_files:
+            await self.export_batch(session, pending_files)
+
+        for local_file in pending_files:
+            progress.add_exported_file(
+                self.get_project_path(local_file), local_file.git_hash
             )
-        else:
-            # Upload to S3
-            with open(file_path, "rb") as data:
-                self.upload_file(data, s3_upload_url)
 
-            # Mark the file as completed
-            self.complete_file(wikifactory_file_id)
+        # Update the exported items
+        progress.increment_exported_items(len(local_files))
+        progress.increment_exported_bytes(
+            sum(local_file.size for local_file in local_files)
+        )
 
-        # Once finished do the ADD operation
-        self.perform_mutation_operation(
-            file_path,
-            wikifactory_file_id,
+    async def skip_exported(self, local_files: List[LocalFile]) -> List[LocalFile]:
+        # Leave out the files added to the project by a previous attempt,
+        # unless they changed since
+        previous_files = [
+            local_file
+            for local_file in local_files
+            if self.get_project_path(local_file) in self.exported_files
+        ]
+
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[
+                loop.run_in_executor(None, local_file.scan)
+                for local_file in previous_files
+            ]
         )
 
-        # Update the exported items
-        crud.job.increment_exported_items(self.db, job_id=self.job_id)
+        return [
+            local_file
+            for local_file in local_files
+            if local_file not in previous_files
+            or self.exported_files[self.get_project_path(local_file)]
+            != local_file.git_hash
+        ]
+
+    def get_project_path(self, local_file: LocalFile) -> str:
+        return os.path.relpath(local_file.path, self.job_path)
+
+    async def export_batch(
+        self, session: AsyncWikifactorySession, local_files: List[LocalFile]
+    ) -> None:
+        file_results = await self.process_files(session, local_files)
+
+        file_ids = []
+        uploads = []
+
+        for (local_file, file_result) in zip(local_files, file_results):
+            if isinstance(file_result, AuthRequired):
+                raise file_result
+
+            if isinstance(file_result, Exception):
+                raise FileUploadFailed(
+                    f"Wikifactory file couldn't be created: {local_file.path}"
+                ) from file_result
+
+            wikifactory_file_id = file_result.get("id")
+
+            if not wikifactory_file_id:
+                raise FileUploadFailed(
+                    "Wikifactory file couldn't be created. Missing File ID"
+                )
+
+            file_ids.append(wikifactory_file_id)
+
+            s3_upload_url = file_result["uploadUrl"]
+
+            if not s3_upload_url:
+                # FIXME - this mean the file already exists on Wikifactory.
+                # We should probably query the "completed" status or raise an exception.
+                print(
+                    "WARNING: There is no S3 url. This probably means a file with the same hash has already been uploaded"
+                )
+            else:
+                uploads.append((local_file, s3_upload_url, wikifactory_file_id))
+
+        # Upload to S3
+        await asyncio.gather(
+            *[
+                self.upload_file(session, local_file, s3_upload_url)
+                for (local_file, s3_upload_url, _) in uploads
+            ]
+        )
+
+        # Mark the uploaded files as completed
+        if uploads:
+            await self.complete_files(
+                session,
+                [(local_file, file_id) for (local_file, _, file_id) in uploads],
+            )
+
+        # Once finished do the ADD operations
+        await self.perform_mutation_operations(
+            session, list(zip(local_files, file_ids))
+        )
 
     def on_finished_cb(self) -> None:
         # In order to finish, I need to perform the commit
@@ -206,28 +649,35 @@ class WikifactoryExporter(BaseExporter):
             "commit.project",
         )
 
-    def process_file(self, path: str) -> Dict:
-        job = crud.job.get(self.db, self.job_id)
-        assert job
+    async def process_files(
+        self, session: AsyncWikifactorySession, local_files: List[LocalFile]
+    ) -> List[Union[Dict, Exception]]:
         assert self.project_details
 
-        with open(path) as file_handle:
-            content_type = magic.from_descriptor(file_handle.fileno(), mime=True)
+        # Scan the files in threads, so reading them doesn't block the loop
+        loop = asyncio.get_running_loop()
+        await asyncio.gather(
+            *[loop.run_in_executor(None, local_file.scan) for local_file in local_files]
+        )
 
-        variables = {
-            "fileInput": {
-                "filename": os.path.basename(path),
+        variables_list: List[object] = [
+            {
+                "filename": os.path.basename(local_file.path),
                 "spaceId": self.project_details["space_id"],
-                "size": os.path.getsize(path),
-                "projectPath": os.path.relpath(path, job.path),
-                "gitHash": str(pygit2.hashfile(path)),
+                "size": local_file.size,
+                "projectPath": self.get_project_path(local_file),
+                "gitHash": local_file.git_hash,
                 "completed": False,
-                "contentType": content_type,
+                "contentType": local_file.content_type,
             }
-        }
+            for local_file in local_files
+        ]
 
-        return wikifactory_api_request(
-            file_mutation, job.export_token, variables, "file.file"
+        return await wikifactory_api_batch_request(
+            session,
+            batch_mutation("File", "FileInput", file_field, len(variables_list)),
+            variables_list,
+            "file.file",
         )
 
     def get_project_details(self) -> Dict:
@@ -249,74 +699,100 @@ class WikifactoryExporter(BaseExporter):
             "private": project["private"],
         }
 
-    def perform_mutation_operation(self, file_path: str, file_id: str) -> None:
-        job = crud.job.get(self.db, self.job_id)
-        assert job
+    async def perform_mutation_operations(
+        self, session: AsyncWikifactorySession, files: List[Tuple[LocalFile, str]]
+    ) -> None:
         assert self.project_details
 
-        variables = {
-            "operationData": {
+        variables_list: List[object] = [
+            {
                 "fileId": file_id,
                 "opType": "ADD",
-                "path": os.path.relpath(file_path, job.path),
+                "path": self.get_project_path(local_file),
                 "projectId": self.project_details["project_id"],
             }
-        }
-
-        wikifactory_api_request(
-            operation_mutation,
-            job.export_token,
-            variables,
+            for (local_file, file_id) in files
+        ]
+
+        results = await wikifactory_api_batch_request(
+            session,
+            batch_mutation(
+                "Operation", "OperationInput", operation_field, len(variables_list)
+            ),
+            variables_list,
             "operation.project",
         )
 
-    def upload_file(self, file_handle: IO, file_url: str) -> None:
-        assert self.project_details
+        raise_batch_errors(
+            [local_file for (local_file, _) in files],
+            results,
+            "Couldn't add the file to the project",
+        )
 
-        content_type = magic.from_descriptor(file_handle.fileno(), mime=True)
+    async def upload_file(
+        self, session: AsyncWikifactorySession, local_file: LocalFile, file_url: str
+    ) -> None:
+        assert self.project_details
 
         headers = {
             "x-amz-acl": "private"
             if self.project_details["private"]
             else "public-read",
-            "Content-Type": content_type,
+            "Content-Type": local_file.content_type,
         }
 
-        # This is weird but requests handles an empty file object
-        # differently than None, with empty file
-        # it appends Content-Length: 0 header which triggers 501 on S3
-        if not file_handle.read(1):
-            data = None
-        else:
-            data = file_handle
-            file_handle.seek(0)
-
-        try:
-            response = requests.put(file_url, data=data, headers=headers)
-            response.raise_for_status()
-        except HTTPError as e:
-            raise FileUploadFailed(
-                f"There was an error uploading the file. Error code: {response.status_code}"
-            ) from e
-
-        file_name = os.path.basename(file_handle.name)
+        # The file is only opened once the upload can start, so the open
+        # files are limited like the requests
+        async with session.semaphore:
+            with local_file.open() as file_handle:
+                # An empty file object would be sent chunked,
+                # which triggers 501 on S3, so send no body instead.
+                # aiohttp would add a Content-Disposition header for the files
+                # opened from disk, which S3 stores with the object
+                data = (
+                    aiohttp.payload.get_payload(file_handle, disposition=None)
+                    if local_file.size
+                    else None
+                )
+
+                try:
+                    async with session.http.put(
+                        file_url, data=data, headers=headers
+                    ) as response:
+                        response.raise_for_status()
+                except aiohttp.ClientResponseError as e:
+                    raise FileUploadFailed(
+                        f"There was an error uploading the file. Error code: {e.status}"
+                    ) from e
+
+        file_name = os.path.basename(local_file.path)
         print(f"File {file_name} uploaded to s3")
 
-    def complete_file(self, file_id: str) -> None:
-        job = crud.job.get(self.db, self.job_id)
-        assert job
+    async def complete_files(
+        self, session: AsyncWikifactorySession, files: List[Tuple[LocalFile, str]]
+    ) -> None:
         assert self.project_details
 
-        variables = {
-            "fileInput": {
+        variables_list: List[object] = [
+            {
                 "id": file_id,
                 "spaceId": self.project_details["space_id"],
                 "completed": True,
             }
-        }
-        wikifactory_api_request(
-            complete_file_mutation,
-            job.export_token,
-            variables,
+            for (_, file_id) in files
+        ]
+
+        results = await wikifactory_api_batch_request(
+            session,
+            batch_mutation(
+                "CompleteFile", "FileInput", complete_file_field, len(variables_list)
+            ),
+            variables_list,
             "file.file",
         )
+
+        raise_batch_errors(
+            [local_file for (local_file, _) in files],
+            results,
+            "Couldn't mark the file as completed",
+        )
@@ -1,52 +1,58 @@
-from gql import gql
+from functools import lru_cache
 
-file_mutation = gql(
-    """
-    mutation File($fileInput: FileInput) {
-        file (fileData: $fileInput) {
-            file {
-                id
-                uploadUrl
-            }
-            userErrors {
-                message
-                key
-                code
-            }
+from gql import gql
+from graphql.language.ast import Document
 
+# Fields to be repeated in a mutation built with `batch_mutation`,
+# where `$input` is replaced by the variable of each element
+file_field = """
+    file(fileData: $input) {
+        file {
+            id
+            uploadUrl
+        }
+        userErrors {
+            message
+            key
+            code
         }
     }
-    """
-)
+"""
 
-operation_mutation = gql(
-    """
-    mutation Operation($operationData: OperationInput) {
-        operation(operationData: $operationData) {
-            project {
-                id
-            }
+operation_field = """
+    operation(operationData: $input) {
+        project {
+            id
         }
     }
-    """
-)
+"""
 
-complete_file_mutation = gql(
-    """
-    mutation CompleteFile($fileInput: FileInput) {
-        file(fileData: $fileInput) {
-            file {
-                id
-            }
-            userErrors {
-                message
-                key
-                code
-            }
+complete_file_field = """
+    file(fileData: $input) {
+        file {
+            id
+        }
+        userErrors {
+            message
+            key
+            code
         }
     }
-    """
-)
+"""
+
+
+@lru_cache(maxsize=None)
+def batch_mutation(name: str, input_type: str, field: str, size: int) -> Document:
+    # Repeat the field `size` times, aliased as `itemN` and reading its input
+    # from the `$itemN` variable, so all of them are sent in a single request
+    variables = ", ".join(f"$item{index}: {input_type}" for index in range(size))
+    fields = "\n".join(
+        f"item{index}: " + field.replace("$input", f"$item{index}")
+        for index in range(size)
+    )
+
+    return gql(f"mutation {name}({variables}) {{ {fields} }}")
+
 
 commit_contribution_mutation = gql(
     """
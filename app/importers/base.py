@@ -1,18 +1,44 @@
+import os
+from typing import Callable, Generator, Optional
+
 from sqlalchemy.orm import Session
 
+from app.core.file_stream import StreamedFile
 from app.schemas.manifest import ManifestInput
 
 
 class BaseImporter:
+    # Whether the files can be handed to the exporter one by one,
+    # instead of being written to the job folder
+    supports_streaming = False
+
     def __init__(self, db: Session, job_id: str):
         raise NotImplementedError()
 
     def process(self) -> None:
         raise NotImplementedError()
 
+    def stream_files(self) -> Generator[StreamedFile, None, None]:
+        # Does the import like `process`, except that the files are only
+        # downloaded while the returned iterator is being consumed
+        raise NotImplementedError()
+
     def populate_project_description(self, manifest_input: ManifestInput) -> None:
         raise NotImplementedError()
 
 
+def is_downloaded(
+    path: str,
+    size: Optional[int],
+    content_hash: Optional[str],
+    hash_file: Callable[[str], str],
+) -> bool:
+    # Whether a previous attempt of the import already downloaded the file
+    if not content_hash or not os.path.isfile(path) or os.path.getsize(path) != size:
+        return False
+
+    return hash_file(path) == content_hash
+
+
 class NotReachable(Exception):
     pass
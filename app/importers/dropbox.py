@@ -1,20 +1,51 @@
+import hashlib
 import os
+import traceback
+import zipfile
+from collections import defaultdict
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
+from contextlib import contextmanager
 from pathlib import Path
 from re import search
-from typing import Dict, List, Optional
+from typing import IO, Dict, Generator, Iterable, Iterator, List, Optional, Set, Tuple
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 import dropbox
+import requests
 from dropbox.dropbox_client import BadInputException, Dropbox
 from dropbox.exceptions import ApiError, AuthError, BadInputError, HttpError
 from dropbox.files import FolderMetadata
 from sqlalchemy.orm import Session
 
 from app import crud
-from app.importers.base import BaseImporter
+from app.core import blob_cache
+from app.core.config import settings
+from app.core.file_stream import (
+    SourceUnreachable,
+    StreamedFile,
+    download_ahead,
+    temporary_content,
+)
+from app.crud.crud_job import JobProgress
+from app.importers.base import BaseImporter, is_downloaded
+from app.importers.file_tree import TreeNode, flatten_tree
+from app.importers.zip_archive import extract_zip, open_remote_zip
 from app.models.job import Job, JobStatus
 from app.schemas import ManifestInput
 from app.service_validators.services import dropbox_validator
 
+# Size of the blocks hashed for the content hash of Dropbox
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024  # Size in bytes
+
+# Same chunk size as the downloads to a file of the Dropbox SDK
+DOWNLOAD_CHUNK_SIZE = 64 * 1024  # Size in bytes
+
 dropbox_shared_folder_regex = dropbox_validator.keywords["regexes"][0]
 dropbox_user_folder_regex = dropbox_validator.keywords["regexes"][1]
 
@@ -27,6 +58,46 @@ def validate_url_user_folder(url: str) -> bool:
     return bool(search(dropbox_user_folder_regex, url))
 
 
+def dropbox_content_hash(path: str) -> str:
+    with open(path, "rb") as file_handle:
+        return dropbox_content_hash_from_file(file_handle)
+
+
+def dropbox_content_hash_from_file(file_handle: IO[bytes]) -> str:
+    # https://www.dropbox.com/developers/reference/content-hash
+    block_hashes = hashlib.sha256()
+
+    for block in iter(lambda: file_handle.read(CONTENT_HASH_BLOCK_SIZE), b""):
+        block_hashes.update(hashlib.sha256(block).digest())
+
+    return block_hashes.hexdigest()
+
+
+def get_zip_url(url: str) -> str:
+    # With dl=1 the shared folder is downloaded as a zip archive
+    url_parts = urlsplit(url)
+    query = dict(parse_qsl(url_parts.query))
+    query["dl"] = "1"
+
+    return urlunsplit(url_parts._replace(query=urlencode(query)))
+
+
+def use_zip_download(files: List[TreeNode]) -> bool:
+    # Many small files are faster to get in one archive than one by one
+    file_count = len(files)
+
+    if (
+        not settings.DROPBOX_ZIP_MIN_FILES
+        <= file_count
+        <= settings.DROPBOX_ZIP_MAX_FILES
+    ):
+        return False
+
+    average_size = sum(node.size for node in files) / file_count
+
+    return average_size <= settings.DROPBOX_ZIP_MAX_AVERAGE_SIZE
+
+
 def get_url_details(url: str) -> Dict[str, str]:
 
     url_details = {}
@@ -44,15 +115,27 @@ def get_url_details(url: str) -> Dict[str, str]:
     return url_details
 
 
+def node_from_entry(entry: dropbox.files.Metadata, path: Optional[str]) -> TreeNode:
+    if isinstance(entry, FolderMetadata):
+        return TreeNode(entry.name, id=entry.id, path=path, is_folder=True)
+
+    return TreeNode(
+        entry.name,
+        id=entry.id,
+        size=entry.size,
+        content_hash=entry.content_hash,
+        path=path,
+    )
+
+
 class DropboxImporter(BaseImporter):
+    supports_streaming = True
+
     def __init__(self, db: Session, job_id: str):
         self.db = db
         self.job_id = job_id
         self.dropbox_handler: Optional[Dropbox] = None
-        self.tree_root: Dict = {
-            "entry": FolderMetadata(id="root-folder", name="root-folder"),
-            "children": {},
-        }
+        self.tree_root = TreeNode("root-folder", id="root-folder", is_folder=True)
         self.shared_link = None
         self.original_url = ""
 
@@ -60,16 +143,81 @@ class DropboxImporter(BaseImporter):
 
         job: Job = crud.job.get(self.db, self.job_id)
         crud.job.update_status(self.db, db_obj=job, status=JobStatus.IMPORTING)
+        crud.job.reset_imported_items(self.db, job_id=self.job_id)
+
+        url_path = self.connect(job)
+
+        with self.import_errors(job):
+            if self.url_type == "shared":
+                self.download_shared_folder(url_path, job.path)
+            else:
+                assert self.tree_root.children is not None
+                self.download_tree_pipelined(
+                    self.tree_root.children, url_path, job.path
+                )
+
+        blob_cache.evict()
+
+        # Set the number of total_items
+        crud.job.update_total_items(
+            self.db, job_id=self.job_id, total_items=job.imported_items
+        )
+        crud.job.update_total_bytes(
+            self.db, job_id=self.job_id, total_bytes=job.imported_bytes
+        )
+
+        self.finish_import(job)
+
+    def stream_files(self) -> Generator[StreamedFile, None, None]:
+
+        job: Job = crud.job.get(self.db, self.job_id)
+        crud.job.update_status(self.db, db_obj=job, status=JobStatus.IMPORTING)
+        crud.job.reset_imported_items(self.db, job_id=self.job_id)
+
+        url_path = self.connect(job)
+
+        # The whole tree is listed first, so the totals are known
+        # before the files are exported
+        assert self.tree_root.children is not None
+
+        with self.import_errors(job):
+            files: List[Tuple[TreeNode, str]] = [
+                (node, relative_path)
+                for (node, relative_path) in self.walk(
+                    self.tree_root.children, url_path
+                )
+                if not node.is_folder
+            ]
+
+        self.update_totals([node for (node, _) in files])
+
+        self.finish_import(job)
+
+        return self.download_stream(files)
+
+    def update_totals(self, files: List[TreeNode]) -> None:
+        crud.job.update_total_items(self.db, job_id=self.job_id, total_items=len(files))
+        crud.job.update_total_bytes(
+            self.db, job_id=self.job_id, total_bytes=sum(node.size for node in files)
+        )
+
+    def connect(self, job: Job) -> str:
+        # Returns the path to be listed
 
         try:
+            # Share a connection pool big enough for all the download workers
+            session = dropbox.create_session(
+                max_connections=settings.DROPBOX_MAX_WORKERS
+            )
+
             if len(job.import_token) == 0:
                 # Use a default, not valid token
                 self.dropbox_handler = dropbox.Dropbox(
-                    oauth2_access_token="R2D2c3p0p4dm34n4k1n3Ia"
+                    oauth2_access_token="R2D2c3p0p4dm34n4k1n3Ia", session=session
                 )
             else:
                 self.dropbox_handler = dropbox.Dropbox(
-                    oauth2_access_token=job.import_token
+                    oauth2_access_token=job.import_token, session=session
                 )
         except (BadInputException, HttpError):
             crud.job.update_status(
@@ -85,12 +233,13 @@ class DropboxImporter(BaseImporter):
 
         self.url_type = url_details["type"]
 
+        return url_details["path"]
+
+    @contextmanager
+    def import_errors(self, job: Job) -> Iterator[None]:
+        # Set the status of the job and let the error go on
         try:
-            self.build_tree_recursively(
-                self.tree_root["children"],
-                url_details["path"],
-            )
-            self.download_tree_recursively(self.tree_root["children"], job.path)
+            yield
         except (AuthError, HttpError, BadInputError):
             crud.job.update_status(
                 self.db,
@@ -106,18 +255,10 @@ class DropboxImporter(BaseImporter):
             )
             raise
 
+    def finish_import(self, job: Job) -> None:
         manifest_input = ManifestInput(job_id=job.id, source_url=job.import_url)
 
-        root_entry = self.tree_root.get("entry")
-        assert root_entry
-
-        self.root_entry = root_entry
-        manifest_input.project_name = root_entry.name
-
-        # Set the number of total_items
-        crud.job.update_total_items(
-            self.db, job_id=self.job_id, total_items=job.imported_items
-        )
+        manifest_input.project_name = self.tree_root.name
 
         crud.manifest.update_or_create(self.db, obj_in=manifest_input)
 
@@ -163,67 +304,318 @@ class DropboxImporter(BaseImporter):
 
         return entries
 
-    def build_tree_recursively(self, current_level: Dict, folder_url: str) -> None:
+    def walk(
+        self, current_level: Dict[str, TreeNode], folder_url: str
+    ) -> Iterator[Tuple[TreeNode, str]]:
+        # Builds the tree, yielding every node (with its path
+        # relative to the root) as soon as its folder is listed
+        if self.url_type == "user_folder":
+            return self.walk_user_folder(current_level, folder_url)
+
+        return self.walk_tree(current_level, folder_url)
 
+    def walk_user_folder(
+        self, current_level: Dict[str, TreeNode], folder_path: str
+    ) -> Iterator[Tuple[TreeNode, str]]:
+        # The whole folder is listed at once, with paginated requests instead of
+        # one listing per folder. The tree is built from the flat list of entries
+        # as they come
+
+        assert self.dropbox_handler
+
+        root_path = folder_path.rstrip("/").lower()
+
+        # Children and relative path of the folders already in the tree
+        levels: Dict[str, Tuple[Dict[str, TreeNode], str]] = {
+            root_path: (current_level, "")
+        }
+        # Entries listed before their folder, by the path of the folder
+        pending_entries: Dict[str, List[dropbox.files.Metadata]] = defaultdict(list)
+
+        def add_entry(entry: dropbox.files.Metadata) -> Iterator[Tuple[TreeNode, str]]:
+            parent_path = entry.path_lower.rpartition("/")[0]
+
+            if parent_path not in levels:
+                pending_entries[parent_path].append(entry)
+                return
+
+            (level, parent_relative_path) = levels[parent_path]
+            relative_path = os.path.join(parent_relative_path, entry.name)
+
+            node = node_from_entry(entry, entry.path_lower)
+            level[entry.name] = node
+
+            yield (node, relative_path)
+
+            if node.children is not None:
+                levels[entry.path_lower] = (node.children, relative_path)
+
+                for child_entry in pending_entries.pop(entry.path_lower, []):
+                    yield from add_entry(child_entry)
+
+        result = self.dropbox_handler.files_list_folder(
+            path=folder_path, recursive=True
+        )
+
+        while True:
+            for entry in result.entries:
+                # The listed folder is included in the entries
+                if entry.path_lower != root_path:
+                    yield from add_entry(entry)
+
+            if not result.has_more:
+                break
+
+            result = self.dropbox_handler.files_list_folder_continue(result.cursor)
+
+    def walk_tree(
+        self,
+        current_level: Dict[str, TreeNode],
+        folder_url: str,
+        relative_path: str = "",
+    ) -> Iterator[Tuple[TreeNode, str]]:
+        # One listing per folder
         entries = self.get_entries_from_folder(folder_url)
 
         for entry in entries:
-            name = entry.name
+            if isinstance(entry, FolderMetadata):
+                # Shared folders are listed by their path inside the link
+                path = os.path.join(folder_url, entry.name).replace(
+                    self.original_url, ""
+                )
+            else:
+                path = entry.path_lower
 
-            entry_full_path = os.path.join(folder_url, name)
+            current_level[entry.name] = node_from_entry(entry, path)
 
-            current_level[name] = {
-                "entry": entry,
-                "children": {},
-                "path": entry_full_path.replace(self.original_url, ""),
-            }
+        for (name, node) in current_level.items():
+            node_relative_path = os.path.join(relative_path, name)
 
-        for node in current_level.values():
-            entry = node.get("entry")
+            yield (node, node_relative_path)
 
-            if isinstance(entry, dropbox.files.FileMetadata):
-                pass
-            elif isinstance(entry, dropbox.files.FolderMetadata):
+            if node.children is not None:
 
                 if self.url_type == "id":
-                    path = node.get("path")
-                    self.build_tree_recursively(node.get("children"), path)
-
+                    folder_path = node.path
                 else:
-                    self.build_tree_recursively(node.get("children"), entry.id)
+                    folder_path = node.id
+
+                assert folder_path
+                yield from self.walk_tree(
+                    node.children, folder_path, node_relative_path
+                )
 
-    def download_tree_recursively(
-        self, current_level: Dict, accumulated_path: str
+    def download_tree_pipelined(
+        self, current_level: Dict[str, TreeNode], folder_url: str, accumulated_path: str
     ) -> None:
+        # Files are downloaded while the rest of the folders are still being listed
+        Path(accumulated_path).mkdir(parents=True, exist_ok=True)
+
+        pending: Set[Future] = set()
+
+        with crud.job.progress(self.db, job_id=self.job_id) as progress:
+            with ThreadPoolExecutor(
+                max_workers=settings.DROPBOX_MAX_WORKERS
+            ) as executor:
+                try:
+                    for (node, relative_path) in self.walk(current_level, folder_url):
+                        node_full_path = os.path.join(accumulated_path, relative_path)
+
+                        if node.is_folder:
+                            Path(node_full_path).mkdir(parents=True, exist_ok=True)
+                            continue
+
+                        # Stop listing until there is room in the download queue
+                        if len(pending) >= settings.DROPBOX_DOWNLOAD_QUEUE_SIZE:
+                            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                            self.on_downloads_done(done, progress)
+
+                        pending.add(
+                            executor.submit(
+                                self.download_file,
+                                node,
+                                node_full_path,
+                                relative_path,
+                            )
+                        )
+
+                    done, pending = wait(pending)
+                    self.on_downloads_done(done, progress)
+                except Exception:
+                    for future in pending:
+                        future.cancel()
+                    raise
+
+    def download_shared_folder(self, url: str, download_path: str) -> None:
+        # The whole folder is listed first, to choose between
+        # a single zip archive and downloading the files one by one
+        assert self.tree_root.children is not None
+
+        files = [
+            node
+            for (node, _) in self.walk(self.tree_root.children, url)
+            if not node.is_folder
+        ]
+
+        # The totals are known from the listing, so the progress
+        # of the download can be followed
+        self.update_totals(files)
+
+        if use_zip_download(files):
+            try:
+                self.download_zip(url, download_path)
+                return
+            except (requests.RequestException, zipfile.error):
+                traceback.print_exc()
+
+                # The files already extracted are found in the folder
+                # and not downloaded again
+                crud.job.reset_imported_items(self.db, job_id=self.job_id)
+
+        self.download_tree_in_parallel(self.tree_root.children, download_path)
+
+    def download_zip(self, url: str, download_path: str) -> None:
+        # The entries are extracted into the job folder while the archive is read
 
         assert self.dropbox_handler
 
-        Path(accumulated_path).mkdir(parents=True, exist_ok=True)
+        # The archive can have the shared folder itself at its root,
+        # which isn't part of the paths of the files
+        link_metadata = self.dropbox_handler.sharing_get_shared_link_metadata(url)
+        root_folder = f"{link_metadata.name}/"
 
-        for (name, node) in current_level.items():
-            entry = node.get("entry")
-            entry_full_path = os.path.join(accumulated_path, name)
+        with requests.Session() as session, open_remote_zip(
+            session, get_zip_url(url)
+        ) as zip_file:
+            with crud.job.progress(self.db, job_id=self.job_id) as progress:
 
-            if isinstance(entry, dropbox.files.FolderMetadata):
-                self.download_tree_recursively(node.get("children"), entry_full_path)
-            else:
+                def on_file_extracted(entry: zipfile.ZipInfo) -> None:
+                    progress.increment_imported_items()
+                    progress.increment_imported_bytes(entry.file_size)
 
-                if entry.path_lower is None and self.url_type == "id":
+                extract_zip(zip_file, download_path, on_file_extracted, root_folder)
 
-                    assert self.shared_link
+        print("Downloaded zip archive: {}".format(url))
 
-                    job = crud.job.get(self.db, self.job_id)
-                    shared_path = f"/{os.path.relpath(entry_full_path, job.path)}"
+    def on_downloads_done(self, done: Iterable[Future], progress: JobProgress) -> None:
+        # The db session can't be shared between threads,
+        # so the progress is updated from the calling thread
+        for future in done:
+            downloaded_bytes = future.result()
+            progress.increment_imported_items()
+            progress.increment_imported_bytes(downloaded_bytes)
 
-                    self.dropbox_handler.sharing_get_shared_link_file_to_file(
-                        download_path=entry_full_path,
-                        url=self.shared_link.url,
-                        path=shared_path,
-                    )
+    def download_file(
+        self,
+        node: TreeNode,
+        download_path: str,
+        relative_path: str,
+    ) -> int:
+        # Returns the size of the downloaded file
 
-                else:
-                    self.dropbox_handler.files_download_to_file(
-                        download_path=entry_full_path, path=entry.path_lower
-                    )
-                print("Downloaded file: {}".format(entry.name))
-                crud.job.increment_imported_items(self.db, job_id=self.job_id)
+        assert self.dropbox_handler
+
+        if is_downloaded(
+            download_path, node.size, node.content_hash, dropbox_content_hash
+        ):
+            print("Already downloaded file: {}".format(node.name))
+            return node.size
+
+        if blob_cache.fetch("dropbox", node.content_hash, download_path):
+            return os.path.getsize(download_path)
+
+        blob_cache.release(download_path)
+
+        if node.path is None and self.url_type == "id":
+
+            assert self.shared_link
+
+            self.dropbox_handler.sharing_get_shared_link_file_to_file(
+                download_path=download_path,
+                url=self.shared_link.url,
+                path=f"/{relative_path}",
+            )
+
+            # The metadata of shared links has no hash
+            content_hash = (
+                dropbox_content_hash(download_path) if blob_cache.is_enabled() else None
+            )
+
+        else:
+            metadata = self.dropbox_handler.files_download_to_file(
+                download_path=download_path, path=node.path
+            )
+            content_hash = metadata.content_hash
+        print("Downloaded file: {}".format(node.name))
+
+        # The file is cached by the hash of what was downloaded, since it
+        # could have changed after the listing
+        blob_cache.store("dropbox", content_hash, download_path)
+
+        return os.path.getsize(download_path)
+
+    def download_stream(
+        self, files: List[Tuple[TreeNode, str]]
+    ) -> Generator[StreamedFile, None, None]:
+        with crud.job.progress(self.db, job_id=self.job_id) as progress:
+            try:
+                for streamed_file in download_ahead(
+                    self.download_content, files, settings.DROPBOX_MAX_WORKERS
+                ):
+                    progress.increment_imported_items()
+                    progress.increment_imported_bytes(streamed_file.size)
+
+                    yield streamed_file
+            except (ApiError, AuthError, HttpError, BadInputError) as error:
+                raise SourceUnreachable(
+                    "Dropbox file couldn't be downloaded"
+                ) from error
+
+    def download_content(self, file: Tuple[TreeNode, str]) -> StreamedFile:
+
+        assert self.dropbox_handler
+
+        (node, relative_path) = file
+
+        if node.path is None and self.url_type == "id":
+
+            assert self.shared_link
+
+            _, response = self.dropbox_handler.sharing_get_shared_link_file(
+                url=self.shared_link.url, path=f"/{relative_path}"
+            )
+
+        else:
+            _, response = self.dropbox_handler.files_download(path=node.path)
+
+        content = temporary_content(node.size)
+
+        with response:
+            for chunk in response.iter_content(DOWNLOAD_CHUNK_SIZE):
+                content.write(chunk)
+
+        size = content.tell()
+        content.seek(0)
+
+        return StreamedFile(relative_path, content, size)
+
+    def download_tree_in_parallel(
+        self, current_level: Dict[str, TreeNode], accumulated_path: str
+    ) -> None:
+        download_jobs = flatten_tree(current_level, accumulated_path)
+
+        with crud.job.progress(self.db, job_id=self.job_id) as progress:
+            with ThreadPoolExecutor(
+                max_workers=settings.DROPBOX_MAX_WORKERS
+            ) as executor:
+                futures = [
+                    executor.submit(self.download_file, *download_job)
+                    for download_job in download_jobs
+                ]
+
+                try:
+                    self.on_downloads_done(as_completed(futures), progress)
+                except Exception:
+                    for future in futures:
+                        future.cancel()
+                    raise
@@ -0,0 +1,95 @@
+import os
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+class TreeNode:
+    """
+    File or folder listed by an importer, with only what is needed to download it.
+    The metadata objects of the services are not kept in the tree, so big trees
+    don't take gigabytes of memory
+    """
+
+    __slots__ = (
+        "name",
+        "id",
+        "size",
+        "content_hash",
+        "path",
+        "download_url",
+        "children",
+    )
+
+    def __init__(
+        self,
+        name: str,
+        id: Optional[str] = None,
+        size: int = 0,
+        content_hash: Optional[str] = None,
+        path: Optional[str] = None,
+        download_url: Optional[str] = None,
+        is_folder: bool = False,
+    ):
+        self.name = name
+        self.id = id
+        self.size = size
+        # Hash of the content as given by the service, to skip known files
+        self.content_hash = content_hash
+        # Path of the node in the service, if it is downloaded by its path
+        self.path = path
+        self.download_url = download_url
+        # Only folders have children
+        self.children: Optional[Dict[str, TreeNode]] = {} if is_folder else None
+
+    @property
+    def is_folder(self) -> bool:
+        return self.children is not None
+
+    def __eq__(self, other: object) -> bool:
+        if not isinstance(other, TreeNode):
+            return NotImplemented
+
+        return all(
+            getattr(self, attribute) == getattr(other, attribute)
+            for attribute in self.__slots__
+        )
+
+    def __repr__(self) -> str:
+        kind = "folder" if self.is_folder else "file"
+        return f"<TreeNode {kind} {self.name!r}>"
+
+
+def walk_files(
+    current_level: Dict[str, TreeNode], relative_path: str = ""
+) -> Iterator[Tuple[TreeNode, str]]:
+    # Files of the tree, with their path relative to the root
+    for (name, node) in current_level.items():
+        node_relative_path = os.path.join(relative_path, name)
+
+        if node.children is not None:
+            yield from walk_files(node.children, node_relative_path)
+        else:
+            yield (node, node_relative_path)
+
+
+def flatten_tree(
+    current_level: Dict[str, TreeNode], accumulated_path: str, relative_path: str = ""
+) -> List[Tuple[TreeNode, str, str]]:
+    # Create the folder structure and collect the files to be downloaded,
+    # with their full and relative paths
+    Path(accumulated_path).mkdir(parents=True, exist_ok=True)
+
+    download_jobs = []
+
+    for (name, node) in current_level.items():
+        node_full_path = os.path.join(accumulated_path, name)
+        node_relative_path = os.path.join(relative_path, name)
+
+        if node.children is not None:
+            download_jobs.extend(
+                flatten_tree(node.children, node_full_path, node_relative_path)
+            )
+        else:
+            download_jobs.append((node, node_full_path, node_relative_path))
+
+    return download_jobs
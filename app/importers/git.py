@@ -78,15 +78,28 @@ class GitImporter(BaseImporter):
                 manifest_input.project_description = file_handle.read()
 
         # Set the number of total_items
-        downloaded_files = sum([len(files) for _, _, files in os.walk(job.path)])
+        downloaded_files = [
+            os.path.join(dirpath, name)
+            for (dirpath, _, filenames) in os.walk(job.path)
+            for name in filenames
+        ]
+        # The size of the links themselves, since getsize follows them
+        # and fails for the dangling ones
+        downloaded_bytes = sum(os.lstat(path).st_size for path in downloaded_files)
 
         crud.job.update_total_items(
-            self.db, job_id=self.job_id, total_items=downloaded_files
+            self.db, job_id=self.job_id, total_items=len(downloaded_files)
+        )
+        crud.job.update_total_bytes(
+            self.db, job_id=self.job_id, total_bytes=downloaded_bytes
         )
 
         # Since we cannot process the files one by one
         crud.job.update_imported_items(
-            self.db, job_id=self.job_id, imported_items=downloaded_files
+            self.db, job_id=self.job_id, imported_items=len(downloaded_files)
+        )
+        crud.job.update_imported_bytes(
+            self.db, job_id=self.job_id, imported_bytes=downloaded_bytes
         )
 
         crud.manifest.update_or_create(self.db, obj_in=manifest_input)
@@ -1,11 +1,15 @@
+import hashlib
 import os
 import traceback
-from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from re import search
-from typing import Dict
+from typing import Dict, Generator, List, Optional, Tuple
 
 import httplib2
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
 from oauth2client.client import AccessTokenCredentials, AccessTokenCredentialsError
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
@@ -13,18 +17,82 @@ from pydrive.files import ApiRequestError, FileNotDownloadableError, GoogleDrive
 from sqlalchemy.orm import Session
 
 from app import crud
-from app.importers.base import BaseImporter
-from app.models.job import JobStatus
+from app.core import blob_cache
+from app.core.config import settings
+from app.core.file_stream import (
+    SourceUnreachable,
+    StreamedFile,
+    download_ahead,
+    temporary_content,
+)
+from app.importers.base import BaseImporter, is_downloaded
+from app.importers.file_tree import TreeNode, flatten_tree, walk_files
+from app.models.job import Job, JobStatus
 from app.schemas import ManifestInput
 from app.service_validators.services import google_drive_validator
 
 folder_mimetype = "application/vnd.google-apps.folder"
 
+# Only the fields used by the importer are requested, instead of the whole
+# file resources with their permissions, owners, thumbnails, etc.
+FILE_FIELDS = "id,title,mimeType,fileSize,md5Checksum,parents(id),downloadUrl"
+LIST_FIELDS = f"items({FILE_FIELDS}),nextPageToken"
+ROOT_FIELDS = "id,title,mimeType,description"
+
+DOWNLOAD_CHUNK_SIZE = 8 * 1024 * 1024  # Size in bytes
+
 
 def is_folder(item: GoogleDriveFile) -> bool:
     return item.get("mimeType") == folder_mimetype
 
 
+def node_from_item(item: GoogleDriveFile) -> TreeNode:
+    if is_folder(item):
+        return TreeNode(item.get("title"), id=item.get("id"), is_folder=True)
+
+    file_size = item.get("fileSize")
+
+    return TreeNode(
+        item.get("title"),
+        id=item.get("id"),
+        size=int(file_size) if file_size else 0,
+        content_hash=item.get("md5Checksum"),
+        download_url=item.get("downloadUrl"),
+    )
+
+
+def parents_query(folder_ids: List[str]) -> str:
+    in_parents = " or ".join(f"'{folder_id}' in parents" for folder_id in folder_ids)
+    return f"({in_parents}) and trashed=false"
+
+
+def batch_folder_ids(folder_ids: List[str]) -> List[List[str]]:
+    # Group the folders to be listed together,
+    # keeping every query under the maximum length
+    batches: List[List[str]] = []
+
+    for folder_id in folder_ids:
+        if not batches or (
+            len(parents_query(batches[-1] + [folder_id]))
+            > settings.GOOGLE_DRIVE_QUERY_MAX_LENGTH
+        ):
+            batches.append([])
+
+        batches[-1].append(folder_id)
+
+    return batches
+
+
+def md5_checksum(path: str) -> str:
+    md5 = hashlib.md5()
+
+    with open(path, "rb") as file_handle:
+        for chunk in iter(lambda: file_handle.read(1024 * 1024), b""):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
 def folder_id_from_url(url: str) -> str:
     match = search(google_drive_validator.keywords["regexes"][0], url)
     assert match
@@ -32,12 +100,15 @@ def folder_id_from_url(url: str) -> str:
 
 
 class GoogleDriveImporter(BaseImporter):
+    supports_streaming = True
+
     def __init__(self, db: Session, job_id: str):
         self.db = db
         self.job_id = job_id
 
         self.drive: GoogleDrive = None
-        self.tree_root: Dict = {"item": None, "children": {}}
+        self.tree_root = TreeNode("", is_folder=True)
+        self.root_item: Optional[GoogleDriveFile] = None
 
     def authenticate(self, token: str) -> GoogleAuth:
         if not token:
@@ -63,40 +134,161 @@ class GoogleDriveImporter(BaseImporter):
 
         return gauth
 
-    def build_tree_recursively(self, current_level: Dict, folder_id: str) -> None:
-        item_list = self.drive.ListFile(
-            {"q": f"'{folder_id}' in parents and trashed=false"}
+    def list_folders(self, folder_ids: List[str]) -> List[GoogleDriveFile]:
+        # Without maxResults, pydrive asks for the biggest pages and goes
+        # through all of them
+        return self.drive.ListFile(
+            {"q": parents_query(folder_ids), "fields": LIST_FIELDS}
         ).GetList()
 
-        for item in item_list:
-            name = item.get("title")
-            current_level[name] = {"item": item, "children": {}}
+    def build_tree_concurrently(
+        self, root_level: Dict[str, TreeNode], folder_id: str
+    ) -> None:
+        # Breadth-first traversal, listing all the folders of a level at once,
+        # with several folders in the same query
+        frontier: List[Tuple[Dict[str, TreeNode], str]] = [(root_level, folder_id)]
+
+        with ThreadPoolExecutor(
+            max_workers=settings.GOOGLE_DRIVE_MAX_WORKERS
+        ) as executor:
+            while frontier:
+                # A folder can be in more than one of the listed folders
+                levels: Dict[str, List[Dict[str, TreeNode]]] = defaultdict(list)
+
+                for (current_level, level_id) in frontier:
+                    levels[level_id].append(current_level)
+
+                item_lists = executor.map(
+                    self.list_folders, batch_folder_ids(list(levels))
+                )
+
+                for item_list in item_lists:
+                    for item in item_list:
+                        # Sort the items back into the folders they were listed for
+                        for parent in item.get("parents", []):
+                            for current_level in levels.get(parent["id"], []):
+                                name = item.get("title")
+                                current_level[name] = node_from_item(item)
+
+                next_frontier = []
+
+                for (current_level, _) in frontier:
+                    for node in current_level.values():
+                        if node.children is not None:
+                            assert node.id
+                            next_frontier.append((node.children, node.id))
+
+                frontier = next_frontier
+
+    def get_drive_file(self, node: TreeNode) -> GoogleDriveFile:
+        # The content of a file is downloaded from its url,
+        # without fetching the rest of the metadata again
+        return GoogleDriveFile(
+            auth=self.drive.auth,
+            metadata={"id": node.id, "downloadUrl": node.download_url},
+            uploaded=True,
+        )
 
-        for node in current_level.values():
-            item = node.get("item")
-            if is_folder(item):
-                self.build_tree_recursively(node.get("children"), item.get("id"))
+    def download_file(self, node: TreeNode, item_full_path: str) -> None:
+        if is_downloaded(item_full_path, node.size, node.content_hash, md5_checksum):
+            return
+
+        if blob_cache.fetch("google_drive", node.content_hash, item_full_path):
+            return
 
-    def download_tree_recursively(
-        self, current_level: Dict, accumulated_path: str
+        blob_cache.release(item_full_path)
+        self.get_drive_file(node).GetContentFile(item_full_path)
+
+        # The file could have changed after the listing,
+        # so it is only cached if it has the listed hash
+        if (
+            blob_cache.is_enabled()
+            and node.content_hash
+            and md5_checksum(item_full_path) == node.content_hash
+        ):
+            blob_cache.store("google_drive", node.content_hash, item_full_path)
+
+    def download_tree_in_parallel(
+        self, current_level: Dict[str, TreeNode], accumulated_path: str
     ) -> None:
-        Path(accumulated_path).mkdir(parents=True, exist_ok=True)
+        download_jobs = flatten_tree(current_level, accumulated_path)
+
+        with ThreadPoolExecutor(
+            max_workers=settings.GOOGLE_DRIVE_MAX_WORKERS
+        ) as executor:
+            futures = {
+                executor.submit(
+                    self.download_file, node, item_full_path
+                ): item_full_path
+                for (node, item_full_path, _) in download_jobs
+            }
+
+            try:
+                # The db session can't be shared between threads,
+                # so the progress is updated from here
+                with crud.job.progress(self.db, job_id=self.job_id) as progress:
+                    for future in as_completed(futures):
+                        future.result()
+                        progress.increment_imported_items()
+                        progress.increment_imported_bytes(
+                            os.path.getsize(futures[future])
+                        )
+            except Exception:
+                for future in futures:
+                    future.cancel()
+                raise
+
+    def download_stream(
+        self, files: List[Tuple[TreeNode, str]]
+    ) -> Generator[StreamedFile, None, None]:
+        with crud.job.progress(self.db, job_id=self.job_id) as progress:
+            try:
+                for streamed_file in download_ahead(
+                    self.download_content, files, settings.GOOGLE_DRIVE_MAX_WORKERS
+                ):
+                    progress.increment_imported_items()
+                    progress.increment_imported_bytes(streamed_file.size)
+
+                    yield streamed_file
+            except (ApiRequestError, FileNotDownloadableError) as error:
+                raise SourceUnreachable(
+                    "Google Drive file couldn't be downloaded"
+                ) from error
+
+    def download_content(self, file: Tuple[TreeNode, str]) -> StreamedFile:
+        (node, relative_path) = file
+
+        # Downloaded in chunks straight into the temporary content, instead of
+        # in memory with pydrive, so big files don't have to fit there
+        content = temporary_content(node.size)
+
+        request = self.drive.auth.service.files().get_media(fileId=node.id)
+        # Like pydrive, a new http object is used for each download,
+        # since they can't be shared between threads
+        request.http = self.drive.auth.Get_Http_Object()
+
+        downloader = MediaIoBaseDownload(
+            content, request, chunksize=DOWNLOAD_CHUNK_SIZE
+        )
 
-        for (name, node) in current_level.items():
-            item = node.get("item")
-            item_full_path = os.path.join(accumulated_path, name)
+        try:
+            done = False
+            while not done:
+                (_, done) = downloader.next_chunk()
+        except HttpError as error:
+            raise ApiRequestError(error) from error
 
-            if is_folder(item):
-                self.download_tree_recursively(node.get("children"), item_full_path)
-            else:
-                item.GetContentFile(item_full_path)
-                crud.job.increment_imported_items(self.db, job_id=self.job_id)
+        size = content.tell()
+        content.seek(0)
 
-    def process(self) -> None:
-        job = crud.job.get(self.db, self.job_id)
-        assert job
+        return StreamedFile(relative_path, content, size)
+
+    def list_tree(self, job: Job) -> bool:
+        # Returns False if the tree couldn't be listed,
+        # after updating the status of the job
 
         crud.job.update_status(self.db, db_obj=job, status=JobStatus.IMPORTING)
+        crud.job.reset_imported_items(self.db, job_id=self.job_id)
 
         try:
             gauth = self.authenticate(job.import_token)
@@ -108,23 +300,23 @@ class GoogleDriveImporter(BaseImporter):
                 db_obj=job,
                 status=JobStatus.IMPORTING_ERROR_AUTHORIZATION_REQUIRED,
             )
-            return
+            return False
 
         self.drive = GoogleDrive(gauth)
         folder_id = folder_id_from_url(url=job.import_url)
 
         try:
             root_folder = self.drive.CreateFile({"id": folder_id})
-            root_folder.FetchMetadata()
+            root_folder.FetchMetadata(fields=ROOT_FIELDS)
             assert root_folder.get("title")
             assert is_folder(root_folder)
 
-            self.tree_root["item"] = root_folder
+            # Only the root keeps its metadata, for the description of the project
+            self.root_item = root_folder
+            self.tree_root = node_from_item(root_folder)
+            assert self.tree_root.children is not None
 
-            self.build_tree_recursively(self.tree_root["children"], folder_id)
-            # FIXME - this can probably be improved by flattening the tree first
-            # and then starting downloads in parallel
-            self.download_tree_recursively(self.tree_root["children"], job.path)
+            self.build_tree_concurrently(self.tree_root.children, folder_id)
         except (ApiRequestError, FileNotDownloadableError, AssertionError):
             traceback.print_exc()
 
@@ -133,21 +325,77 @@ class GoogleDriveImporter(BaseImporter):
                 db_obj=job,
                 status=JobStatus.IMPORTING_ERROR_DATA_UNREACHABLE,
             )
+            return False
+
+        return True
+
+    def process(self) -> None:
+        job = crud.job.get(self.db, self.job_id)
+        assert job
+
+        if not self.list_tree(job):
             return
 
-        manifest_input = ManifestInput(job_id=job.id, source_url=job.import_url)
-        root_item = self.tree_root.get("item")
-        assert root_item
-        self.root_item = root_item
-        manifest_input.project_name = root_item.get("title")
-        # TODO - add project_description to manifest
+        assert self.tree_root.children is not None
 
-        self.populate_project_description(manifest_input)
+        # The totals are known from the listing, so the progress
+        # of the download can be followed
+        self.update_totals([node for (node, _) in walk_files(self.tree_root.children)])
+
+        try:
+            self.download_tree_in_parallel(self.tree_root.children, job.path)
+        except (ApiRequestError, FileNotDownloadableError, AssertionError):
+            traceback.print_exc()
+
+            crud.job.update_status(
+                self.db,
+                db_obj=job,
+                status=JobStatus.IMPORTING_ERROR_DATA_UNREACHABLE,
+            )
+            return
 
-        # Set the number of total_items
+        blob_cache.evict()
+
+        # Set the number of total_items, as they were downloaded
         crud.job.update_total_items(
             self.db, job_id=self.job_id, total_items=job.imported_items
         )
+        crud.job.update_total_bytes(
+            self.db, job_id=self.job_id, total_bytes=job.imported_bytes
+        )
+
+        self.finish_import(job)
+
+    def stream_files(self) -> Generator[StreamedFile, None, None]:
+        job = crud.job.get(self.db, self.job_id)
+        assert job
+
+        if not self.list_tree(job):
+            # Nothing to export, the status of the job has been updated
+            return self.download_stream([])
+
+        assert self.tree_root.children is not None
+        files = list(walk_files(self.tree_root.children))
+        self.update_totals([node for (node, _) in files])
+
+        self.finish_import(job)
+
+        return self.download_stream(files)
+
+    def update_totals(self, files: List[TreeNode]) -> None:
+        crud.job.update_total_items(self.db, job_id=self.job_id, total_items=len(files))
+        crud.job.update_total_bytes(
+            self.db,
+            job_id=self.job_id,
+            total_bytes=sum(node.size for node in files),
+        )
+
+    def finish_import(self, job: Job) -> None:
+        manifest_input = ManifestInput(job_id=job.id, source_url=job.import_url)
+        manifest_input.project_name = self.tree_root.name
+        # TODO - add project_description to manifest
+
+        self.populate_project_description(manifest_input)
 
         crud.manifest.update_or_create(self.db, obj_in=manifest_input)
 
@@ -156,6 +404,7 @@ class GoogleDriveImporter(BaseImporter):
         )
 
     def populate_project_description(self, manifest_input: ManifestInput) -> None:
-        self.root_item.FetchMetadata(fields="description")
+        assert self.root_item
+        # The description is fetched with the rest of the root metadata
         manifest_input.project_description = self.root_item.get("description", "")
         crud.manifest.update_or_create(self.db, obj_in=manifest_input)
@@ -1,23 +1,38 @@
+import logging
 import os
-import pathlib
-import shutil
 import traceback
 import zipfile
+import zlib
 from re import search
-from typing import Dict
+from typing import Dict, Optional
 
 import requests
 from sqlalchemy.orm import Session
 
 from app import crud
 from app.core.config import settings
-from app.exporters.wikifactory import NoResult, UserErrors, wikifactory_api_request
+from app.exporters.wikifactory import (
+    NoResult,
+    UserErrors,
+    close_wikifactory_session,
+    get_wikifactory_session,
+    wikifactory_api_request,
+)
 from app.importers.base import BaseImporter, NotReachable
 from app.importers.wikifactory_gql import repository_zip_query
+from app.importers.zip_archive import (
+    count_bytes,
+    count_files,
+    extract_zip,
+    get_root_folder,
+    open_remote_zip,
+)
 from app.models.job import Job, JobStatus
 from app.schemas.manifest import ManifestInput
 from app.service_validators.services import wikifactory_validator
 
+logger = logging.getLogger(__name__)
+
 
 def space_slug_from_url(url: str) -> Dict:
     match = search(wikifactory_validator.keywords["regexes"][0], url)
@@ -31,36 +46,47 @@ class WikifactoryImporter(BaseImporter):
         self.db = db
         self.job_id = job_id
 
+        # Bytes of the project archive downloaded when the progress was last logged
+        self.logged_bytes = 0
+        # Once the files are extracted, the progress is counted by them
+        self.extracting = False
+
     def process(self) -> None:
 
         job: Job = crud.job.get(self.db, self.job_id)
         assert job
 
         crud.job.update_status(self.db, db_obj=job, status=JobStatus.IMPORTING)
-
-        self.project_details = self.get_project_details()
-        assert self.project_details
+        crud.job.reset_imported_items(self.db, job_id=self.job_id)
 
         try:
-            self.download_and_unzip_url(self.project_details["zip_url"])
+            self.project_details = self.get_project_details()
+            assert self.project_details
 
-            manifest_input = ManifestInput(job_id=job.id, source_url=job.import_url)
-            manifest_input.project_name = os.path.basename(
-                os.path.normpath(job.import_url)
-            )
+            try:
+                self.download_and_unzip_url(self.project_details["zip_url"])
 
-            self.populate_project_description(manifest_input)
+                manifest_input = ManifestInput(job_id=job.id, source_url=job.import_url)
+                manifest_input.project_name = os.path.basename(
+                    os.path.normpath(job.import_url)
+                )
 
-            crud.job.update_status(
-                self.db, db_obj=job, status=JobStatus.IMPORTING_SUCCESSFULLY
-            )
+                self.populate_project_description(manifest_input)
 
-        except (UserErrors):
-            traceback.print_exc()
+                crud.job.update_status(
+                    self.db, db_obj=job, status=JobStatus.IMPORTING_SUCCESSFULLY
+                )
 
-            crud.job.update_status(
-                self.db, db_obj=job, status=JobStatus.IMPORTING_ERROR_DATA_UNREACHABLE
-            )
+            except (UserErrors, NotReachable):
+                traceback.print_exc()
+
+                crud.job.update_status(
+                    self.db,
+                    db_obj=job,
+                    status=JobStatus.IMPORTING_ERROR_DATA_UNREACHABLE,
+                )
+        finally:
+            close_wikifactory_session(job.import_token)
 
     def get_project_details(self) -> Dict:
         job = crud.job.get(self.db, self.job_id)
@@ -86,56 +112,82 @@ class WikifactoryImporter(BaseImporter):
 
         assert job
 
-        # Define the temporal destination of the uncompressed folder
-        # This path will contain the real project folder
-        tmp_job_name = "tmp_" + os.path.basename(job.path)
-        tmp_job_path = os.path.join(os.path.dirname(job.path), tmp_job_name)
-        zip_file_path = os.path.join(tmp_job_path, "zipfile.zip")
-
-        self.download_zip_file(zip_url, zip_file_path)
+        session = get_wikifactory_session(job.import_token)
 
+        # The entries are extracted directly into the job folder, while the
+        # archive is read, and the project folder of the archive is skipped
         try:
-            with zipfile.ZipFile(zip_file_path, "r") as zip_content:
-                zip_content.extractall(tmp_job_path)
-        except zipfile.error:
-            traceback.print_exc()
-
-        # Once unzipped, remove the zip file
-        os.remove(zip_file_path)
-
-        # Make sure that the tmp folder only contains the real project folder
-        elements_in_temp_folder = os.listdir(tmp_job_path)
-        assert len(elements_in_temp_folder) == 1
-
-        # Move the real project folder to the real job folder
-        folder_path = os.path.join(tmp_job_path, elements_in_temp_folder[0])
-        shutil.move(folder_path, job.path)
-
-        # Delete the temporal folder, because it is not required anymore
-        shutil.rmtree(tmp_job_path)
-
-    def populate_project_description(self, manifest_input: ManifestInput) -> None:
-        job: Job = crud.job.get(self.db, self.job_id)
+            with open_remote_zip(
+                session.http,
+                zip_url,
+                self.record_download_progress,
+                verify=False,
+            ) as zip_file:
+                # The bytes of the archive downloaded so far are counted again
+                # as the files they belong to are extracted
+                self.extracting = True
+                crud.job.reset_imported_items(self.db, job_id=self.job_id)
+
+                # The central directory is already read, so the number
+                # of files is known before extracting any of them
+                crud.job.update_total_items(
+                    self.db, job_id=self.job_id, total_items=count_files(zip_file)
+                )
+                crud.job.update_total_bytes(
+                    self.db, job_id=self.job_id, total_bytes=count_bytes(zip_file)
+                )
+
+                # The project is archived inside a single folder
+                root_folder = get_root_folder(zip_file.infolist())
+
+                if not root_folder:
+                    raise zipfile.BadZipFile("The project folder is not in the archive")
+
+                with crud.job.progress(self.db, job_id=self.job_id) as progress:
+
+                    def on_file_extracted(entry: zipfile.ZipInfo) -> None:
+                        progress.increment_imported_items()
+                        progress.increment_imported_bytes(entry.file_size)
+
+                    extract_zip(zip_file, job.path, on_file_extracted, root_folder)
+        except (
+            zipfile.error,
+            zlib.error,
+            EOFError,
+            requests.RequestException,
+            IOError,
+        ) as error:
+            # A corrupt archive, or one whose download failed while the
+            # files were extracted, would leave a partial project
+            raise NotReachable("Project archive couldn't be downloaded") from error
+
+    def record_download_progress(
+        self, downloaded_bytes: int, total_bytes: Optional[int]
+    ) -> None:
+        if (
+            downloaded_bytes - self.logged_bytes < settings.ZIP_PROGRESS_LOG_STEP
+            and downloaded_bytes != total_bytes
+        ):
+            return
+
+        self.logged_bytes = downloaded_bytes
+        logger.info(
+            f"Job {self.job_id}: downloaded {downloaded_bytes} of {total_bytes or '?'} bytes"
+        )
 
-        # Set the number of total_items
-        downloaded_files = sum([len(files) for _, _, files in os.walk(job.path)])
+        if self.extracting:
+            return
 
-        crud.job.update_total_items(
-            self.db, job_id=self.job_id, total_items=downloaded_files
-        )
+        # Without range requests the whole archive is downloaded before
+        # any file is extracted, so its progress is kept in the job meanwhile
+        if total_bytes:
+            crud.job.update_total_bytes(
+                self.db, job_id=self.job_id, total_bytes=total_bytes
+            )
 
-        # Since we cannot process the files one by one
-        crud.job.update_imported_items(
-            self.db, job_id=self.job_id, imported_items=downloaded_files
+        crud.job.update_imported_bytes(
+            self.db, job_id=self.job_id, imported_bytes=downloaded_bytes
         )
 
+    def populate_project_description(self, manifest_input: ManifestInput) -> None:
         crud.manifest.update_or_create(self.db, obj_in=manifest_input)
-
-    def download_zip_file(self, zip_url: str, target_path: str) -> None:
-
-        # Create the target folder
-        pathlib.Path(os.path.dirname(target_path)).mkdir(parents=True, exist_ok=True)
-
-        with requests.get(zip_url, stream=True, verify=False) as r:
-            with open(target_path, "wb") as file:
-                shutil.copyfileobj(r.raw, file)
@@ -0,0 +1,215 @@
+import io
+import os
+import tempfile
+import zipfile
+from contextlib import contextmanager
+from typing import IO, Any, Callable, Iterator, List, Optional
+
+import requests
+
+from app.core import blob_cache
+from app.core.config import settings
+
+# Size of the blocks requested to the server when the archive is read with
+# range requests. The entries are extracted in the order they are stored,
+# so reading ahead in big blocks keeps the number of requests low
+RANGE_CHUNK_SIZE = 4 * 1024 * 1024  # Size in bytes
+
+# Called with the number of bytes downloaded so far and the size of the
+# archive, if known
+DownloadProgressCallback = Callable[[int, Optional[int]], None]
+
+
+class HTTPRangeReader(io.RawIOBase):
+    """
+    Read-only remote file, read with HTTP range requests
+    """
+
+    def __init__(
+        self,
+        session: requests.Session,
+        url: str,
+        size: int,
+        on_download_progress: Optional[DownloadProgressCallback] = None,
+        **request_kwargs: Any,
+    ):
+        self.session = session
+        self.url = url
+        self.size = size
+        self.position = 0
+        self.downloaded_bytes = 0
+        self.on_download_progress = on_download_progress
+        self.request_kwargs = request_kwargs
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+
+        if position < 0:
+            raise ValueError(f"Negative seek position: {position}")
+
+        self.position = position
+        return position
+
+    def readinto(self, buffer: Any) -> int:
+        if self.position >= self.size or not len(buffer):
+            return 0
+
+        end = min(self.position + len(buffer), self.size) - 1
+
+        response = self.session.get(
+            self.url,
+            headers={"Range": f"bytes={self.position}-{end}"},
+            **self.request_kwargs,
+        )
+        response.raise_for_status()
+
+        if response.status_code != requests.codes["partial_content"]:
+            raise IOError(f"Range request not supported by {self.url}")
+
+        data = response.content
+        buffer[: len(data)] = data
+        self.position += len(data)
+        self.downloaded_bytes += len(data)
+
+        if self.on_download_progress:
+            self.on_download_progress(self.downloaded_bytes, self.size)
+
+        return len(data)
+
+
+@contextmanager
+def open_remote_zip(
+    session: requests.Session,
+    url: str,
+    on_download_progress: Optional[DownloadProgressCallback] = None,
+    **request_kwargs: Any,
+) -> Iterator[zipfile.ZipFile]:
+    """
+    Open a remote zip archive without writing it to the job folder.
+    It is read with range requests if the server supports them,
+    otherwise it is downloaded to a spooled temporary file
+    """
+
+    archive: IO[bytes]
+
+    # Probe the support for range requests with the first byte
+    with session.get(
+        url, headers={"Range": "bytes=0-0"}, stream=True, **request_kwargs
+    ) as response:
+        response.raise_for_status()
+
+        content_range = response.headers.get("Content-Range", "")
+        total_size = content_range.rpartition("/")[2]
+
+        if (
+            response.status_code == requests.codes["partial_content"]
+            and total_size.isdigit()
+        ):
+            archive = io.BufferedReader(
+                HTTPRangeReader(
+                    session,
+                    response.url,
+                    int(total_size),
+                    on_download_progress,
+                    **request_kwargs,
+                ),
+                buffer_size=RANGE_CHUNK_SIZE,
+            )
+        else:
+            # The whole archive is being sent, keep it in memory until it
+            # gets too big, then let it go to a temporary file
+            archive = tempfile.SpooledTemporaryFile(
+                max_size=settings.ZIP_SPOOL_MAX_SIZE
+            )
+            content_length = response.headers.get("Content-Length")
+            size = int(content_length) if content_length else None
+
+            for chunk in response.iter_content(RANGE_CHUNK_SIZE):
+                archive.write(chunk)
+
+                if on_download_progress:
+                    on_download_progress(archive.tell(), size)
+
+            archive.seek(0)
+
+    with archive, zipfile.ZipFile(archive) as zip_file:
+        yield zip_file
+
+
+def count_files(zip_file: zipfile.ZipFile) -> int:
+    # Only the central directory is read
+    return sum(1 for entry in zip_file.infolist() if not entry.is_dir())
+
+
+def count_bytes(zip_file: zipfile.ZipFile) -> int:
+    # Uncompressed size of the files, only the central directory is read
+    return sum(entry.file_size for entry in zip_file.infolist())
+
+
+def get_root_folder(entries: List[zipfile.ZipInfo]) -> Optional[str]:
+    # The folder every entry is inside of, if there is only one
+    root_folders = {entry.filename.split("/", 1)[0] + "/" for entry in entries}
+
+    if len(root_folders) != 1:
+        return None
+
+    root_folder = root_folders.pop()
+
+    if all(entry.filename.startswith(root_folder) for entry in entries):
+        return root_folder
+
+    return None
+
+
+def extract_zip(
+    zip_file: zipfile.ZipFile,
+    target_path: str,
+    on_file_extracted: Callable[[zipfile.ZipInfo], None],
+    root_folder: Optional[str] = None,
+) -> None:
+    """
+    Extract the entries one by one, in the order they are stored in the archive.
+    The content of `root_folder`, given with its trailing slash, is extracted
+    directly into `target_path`
+    """
+
+    entries = sorted(zip_file.infolist(), key=lambda entry: entry.header_offset)
+
+    for entry in entries:
+        if root_folder and entry.filename.startswith(root_folder):
+            # The local header is checked against `orig_filename`,
+            # so only the extracted path changes
+            entry.filename = entry.filename[len(root_folder) :]
+
+        if not entry.filename:
+            continue
+
+        if not entry.is_dir():
+            # Sanitized like zipfile does, without the drives of Windows
+            parts = [
+                part
+                for part in entry.filename.split("/")
+                if part not in ("", ".", "..")
+            ]
+            blob_cache.release(os.path.join(target_path, *parts))
+
+        zip_file.extract(entry, target_path)
+
+        if not entry.is_dir():
+            on_file_extracted(entry)
@@ -0,0 +1,47 @@
+import logging
+import os
+
+from sqlalchemy import inspect
+
+from alembic.command import stamp, upgrade
+from alembic.config import Config
+from app.db.session import engine
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+base_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Schema of the databases created with `create_all`, before the migrations
+initial_revision = "21b8b7fc7bff"
+
+
+def get_alembic_config() -> Config:
+    alembic_config = Config(os.path.join(base_path, "alembic.ini"))
+    alembic_config.set_main_option(
+        "script_location", os.path.join(base_path, "alembic")
+    )
+    return alembic_config
+
+
+def migrate() -> None:
+    alembic_config = get_alembic_config()
+    table_names = inspect(engine).get_table_names()
+
+    # Those databases are marked with the initial revision once,
+    # so the following migrations add what they are missing
+    if "job" in table_names and "alembic_version" not in table_names:
+        logger.info(f"Stamping the existing database with {initial_revision}")
+        stamp(alembic_config, initial_revision)
+
+    upgrade(alembic_config, "head")
+
+
+def main() -> None:
+    logger.info("Running migrations")
+    migrate()
+    logger.info("Migrations finished")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,24 @@
+from sqlalchemy import Column, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.orm import backref, relationship
+
+from app.db.base_class import Base
+from app.models.job import Job
+
+
+class ExportedFile(Base):
+    __tablename__ = "exported_file"
+    __table_args__ = (UniqueConstraint("job_id", "path"),)
+
+    id = Column(Integer, primary_key=True)
+    job_id = Column(
+        UUID(as_uuid=True), ForeignKey("job.id", ondelete="CASCADE"), nullable=False
+    )
+    job = relationship(
+        Job, backref=backref("exported_files", cascade="all, delete-orphan")
+    )
+
+    # Relative to the root of the project
+    path = Column(String, nullable=False)
+    # Hash of the file in the export service, to know if it changed since
+    content_hash = Column(String, nullable=False)
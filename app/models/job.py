@@ -4,7 +4,7 @@ import uuid
 from sqlalchemy import Column, Enum, String
 from sqlalchemy.dialects.postgresql import UUID
 from sqlalchemy.ext.hybrid import hybrid_property
-from sqlalchemy.sql.sqltypes import Integer
+from sqlalchemy.sql.sqltypes import BigInteger, Integer
 
 from app.db.base_class import Base
 
@@ -84,6 +84,10 @@ class Job(Base):
     imported_items = Column(Integer, nullable=False, server_default="0")
     exported_items = Column(Integer, nullable=False, server_default="0")
 
+    total_bytes = Column(BigInteger, nullable=False, server_default="0")
+    imported_bytes = Column(BigInteger, nullable=False, server_default="0")
+    exported_bytes = Column(BigInteger, nullable=False, server_default="0")
+
     path = Column(String)
 
     @hybrid_property
@@ -112,6 +116,19 @@ class Job(Base):
 
         return 0
 
+    @hybrid_property
+    def status_bytes_progress(self) -> float:
+        # Same as status_progress, but weighting each item by its size
+        if not self.total_bytes:
+            return self.status_progress
+
+        if self.status in importing_statuses:
+            return self.imported_bytes / self.total_bytes
+        elif self.status in exporting_statuses:
+            return self.exported_bytes / self.total_bytes
+
+        return 0
+
 
 class JobDuplicated(Exception):
     pass
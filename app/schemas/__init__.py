@@ -1,3 +1,4 @@
-from .job import Job, JobCreate, JobUpdate  # noqa
+from .exported_file import ExportedFileInput  # noqa
+from .job import Job, JobCreate, JobMetrics, JobUpdate  # noqa
 from .manifest import Manifest, ManifestInput  # noqa
 from .service import Service, ServiceInput  # noqa
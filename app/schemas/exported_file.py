@@ -0,0 +1,9 @@
+import uuid
+
+from pydantic.main import BaseModel
+
+
+class ExportedFileInput(BaseModel):
+    job_id: uuid.UUID
+    path: str
+    content_hash: str
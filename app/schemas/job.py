@@ -22,11 +22,24 @@ class JobUpdate(BaseModel):
     export_token: Optional[str] = None
 
 
+class JobMetrics(BaseModel):
+    # Seconds spent in each phase, up to now for the running one
+    importing_elapsed: Optional[float] = None
+    exporting_elapsed: Optional[float] = None
+
+    # Throughput and estimated seconds left of the running phase
+    items_per_second: Optional[float] = None
+    bytes_per_second: Optional[float] = None
+    estimated_time_remaining: Optional[float] = None
+
+
 class Job(BaseJob):
     id: uuid.UUID
     status: JobStatus
     general_progress: float
     status_progress: float
+    status_bytes_progress: float
+    metrics: Optional[JobMetrics] = None
 
     class Config:
         orm_mode = True
@@ -1,15 +1,18 @@
 import os
+from datetime import timedelta
 from typing import Any, Dict, Generator, List
 
 import pytest
 import requests
 from fastapi.testclient import TestClient
 from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
 
 from app import crud
 from app.core.celery_app import celery_app
 from app.core.config import settings
 from app.models.job import JobStatus
+from app.models.job_log import JobLog
 from app.schemas.job import JobCreate
 from app.tests.utils import utils
 
@@ -107,18 +110,28 @@ def test_post_job_error(
 @pytest.mark.parametrize(
     "status, item_data, expected_progress",
     [
-        (JobStatus.PENDING, None, {"general": 0, "status": 0}),
-        (JobStatus.IMPORTING, None, {"general": 0.25, "status": 0}),
+        (JobStatus.PENDING, None, {"general": 0, "status": 0, "status_bytes": 0}),
+        (JobStatus.IMPORTING, None, {"general": 0.25, "status": 0, "status_bytes": 0}),
         (
             JobStatus.IMPORTING,
             {"total": 2, "imported": 1},
-            {"general": 0.25, "status": 0.5},
+            {"general": 0.25, "status": 0.5, "status_bytes": 0.5},
         ),
-        (JobStatus.EXPORTING, None, {"general": 0.75, "status": 0}),
+        (
+            JobStatus.IMPORTING,
+            {"total": 2, "imported": 1, "total_bytes": 100, "imported_bytes": 90},
+            {"general": 0.25, "status": 0.5, "status_bytes": 0.9},
+        ),
+        (JobStatus.EXPORTING, None, {"general": 0.75, "status": 0, "status_bytes": 0}),
         (
             JobStatus.EXPORTING,
             {"total": 2, "exported": 1},
-            {"general": 0.75, "status": 0.5},
+            {"general": 0.75, "status": 0.5, "status_bytes": 0.5},
+        ),
+        (
+            JobStatus.EXPORTING,
+            {"total": 2, "exported": 1, "total_bytes": 100, "exported_bytes": 10},
+            {"general": 0.75, "status": 0.5, "status_bytes": 0.1},
         ),
     ],
 )
@@ -137,6 +150,9 @@ def test_get_job(
         db_job.total_items = item_data.get("total", 0)
         db_job.imported_items = item_data.get("imported", 0)
         db_job.exported_items = item_data.get("exported", 0)
+        db_job.total_bytes = item_data.get("total_bytes", 0)
+        db_job.imported_bytes = item_data.get("imported_bytes", 0)
+        db_job.exported_bytes = item_data.get("exported_bytes", 0)
 
     db.add(db_job)
     db.commit()
@@ -153,6 +169,78 @@ def test_get_job(
     if expected_progress:
         assert job.get("general_progress") == expected_progress.get("general")
         assert job.get("status_progress") == expected_progress.get("status")
+        assert job.get("status_bytes_progress") == expected_progress.get("status_bytes")
+
+
+def test_get_job_metrics(db: Session, basic_job: dict, client: TestClient) -> None:
+    db_job = basic_job["db_job"]
+    now = db.query(func.localtimestamp()).scalar()
+
+    # Imported in 10 seconds, exporting for the last 10 seconds
+    for (seconds_ago, from_status, to_status) in [
+        (30, JobStatus.PENDING, JobStatus.IMPORTING),
+        (20, JobStatus.IMPORTING, JobStatus.IMPORTING_SUCCESSFULLY),
+        (10, JobStatus.IMPORTING_SUCCESSFULLY, JobStatus.EXPORTING),
+    ]:
+        db.add(
+            JobLog(
+                job_id=db_job.id,
+                from_status=from_status,
+                to_status=to_status,
+                timestamp=now - timedelta(seconds=seconds_ago),
+            )
+        )
+
+    db_job.status = JobStatus.EXPORTING
+    db_job.total_items = 4
+    db_job.exported_items = 1
+    db_job.total_bytes = 400
+    db_job.exported_bytes = 100
+    db.add(db_job)
+    db.commit()
+
+    response = client.get(f"{settings.API_V1_STR}/job/{db_job.id}")
+    metrics = response.json().get("metrics")
+    assert metrics
+    assert metrics.get("importing_elapsed") == 10
+    assert metrics.get("exporting_elapsed") == pytest.approx(10, abs=1)
+    assert metrics.get("items_per_second") == pytest.approx(0.1, abs=0.01)
+    assert metrics.get("bytes_per_second") == pytest.approx(10, abs=1)
+    assert metrics.get("estimated_time_remaining") == pytest.approx(30, abs=3)
+
+
+def test_get_job_metrics_importing(
+    db: Session, basic_job: dict, client: TestClient
+) -> None:
+    db_job = basic_job["db_job"]
+    now = db.query(func.localtimestamp()).scalar()
+
+    # Importing for the last 10 seconds, with the totals known from the listing
+    db.add(
+        JobLog(
+            job_id=db_job.id,
+            from_status=JobStatus.PENDING,
+            to_status=JobStatus.IMPORTING,
+            timestamp=now - timedelta(seconds=10),
+        )
+    )
+
+    db_job.status = JobStatus.IMPORTING
+    db_job.total_items = 4
+    db_job.imported_items = 1
+    db_job.total_bytes = 400
+    db_job.imported_bytes = 100
+    db.add(db_job)
+    db.commit()
+
+    response = client.get(f"{settings.API_V1_STR}/job/{db_job.id}")
+    metrics = response.json().get("metrics")
+    assert metrics
+    assert metrics.get("importing_elapsed") == pytest.approx(10, abs=1)
+    assert metrics.get("exporting_elapsed") is None
+    assert metrics.get("items_per_second") == pytest.approx(0.1, abs=0.01)
+    assert metrics.get("bytes_per_second") == pytest.approx(10, abs=1)
+    assert metrics.get("estimated_time_remaining") == pytest.approx(30, abs=3)
 
 
 def test_get_job_error(client: TestClient) -> None:
@@ -0,0 +1,67 @@
+import os
+from typing import Any
+
+import py
+import pytest
+
+from app.core import blob_cache
+from app.core.config import settings
+
+
+@pytest.fixture
+def enabled_cache(monkeypatch: Any, tmpdir: py.path.local) -> None:
+    monkeypatch.setattr(settings, "BLOB_CACHE_PATH", str(tmpdir.join("cache")))
+    monkeypatch.setattr(settings, "BLOB_CACHE_MAX_SIZE", 10)
+
+
+def write_file(path: str, content: bytes) -> None:
+    with open(path, "wb") as file_handle:
+        file_handle.write(content)
+
+
+@pytest.mark.usefixtures("enabled_cache")
+def test_fetch_stored_file(tmpdir: py.path.local) -> None:
+    source_path = str(tmpdir.join("source"))
+    target_path = str(tmpdir.join("target"))
+    write_file(source_path, b"content")
+
+    assert not blob_cache.fetch("dropbox", "hash", target_path)
+
+    blob_cache.store("dropbox", "hash", source_path)
+
+    assert blob_cache.fetch("dropbox", "hash", target_path)
+    assert open(target_path, "rb").read() == b"content"
+
+    # Cached by service
+    assert not blob_cache.fetch("google_drive", "hash", target_path)
+
+    # Files without hash are not cached
+    assert not blob_cache.fetch("dropbox", None, target_path)
+
+
+def test_disabled_cache(tmpdir: py.path.local) -> None:
+    source_path = str(tmpdir.join("source"))
+    write_file(source_path, b"content")
+
+    blob_cache.store("dropbox", "hash", source_path)
+
+    assert not blob_cache.fetch("dropbox", "hash", str(tmpdir.join("target")))
+
+
+@pytest.mark.usefixtures("enabled_cache")
+def test_evict_least_recently_used(tmpdir: py.path.local) -> None:
+    for (index, content_hash) in enumerate(["old", "used", "new"]):
+        source_path = str(tmpdir.join(content_hash))
+        write_file(source_path, b"1234")
+        blob_cache.store("dropbox", content_hash, source_path)
+
+        os.utime(blob_cache.get_blob_path("dropbox", content_hash), (index, index))
+
+    # Using a file makes it the most recent one
+    assert blob_cache.fetch("dropbox", "used", str(tmpdir.join("target")))
+
+    blob_cache.evict()
+
+    assert not os.path.exists(blob_cache.get_blob_path("dropbox", "old"))
+    assert os.path.exists(blob_cache.get_blob_path("dropbox", "new"))
+    assert os.path.exists(blob_cache.get_blob_path("dropbox", "used"))
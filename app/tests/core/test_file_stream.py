@@ -0,0 +1,72 @@
+import io
+import threading
+from typing import Any, List
+
+import pytest
+
+from app.core.config import settings
+from app.core.file_stream import StreamedFile, download_ahead, temporary_content
+
+
+def download(name: str) -> StreamedFile:
+    content = name.encode()
+    return StreamedFile(name, io.BytesIO(content), len(content))
+
+
+def test_download_ahead() -> None:
+    names = [f"file-{index}" for index in range(20)]
+
+    streamed_files = list(download_ahead(download, names, max_workers=4))
+
+    assert sorted(streamed_file.path for streamed_file in streamed_files) == sorted(
+        names
+    )
+
+    for streamed_file in streamed_files:
+        assert streamed_file.content.read() == streamed_file.path.encode()
+        assert streamed_file.size == len(streamed_file.path)
+
+
+def test_download_ahead_is_bounded(monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "STREAM_QUEUE_SIZE", 2)
+
+    lock = threading.Lock()
+    downloaded: List[str] = []
+
+    def download_and_count(name: str) -> StreamedFile:
+        with lock:
+            downloaded.append(name)
+        return download(name)
+
+    files = download_ahead(
+        download_and_count, [f"file-{index}" for index in range(10)], max_workers=1
+    )
+
+    next(files)
+
+    # The first file and at most the queue size ahead of it
+    assert len(downloaded) <= 3
+
+    files.close()
+
+    assert len(downloaded) <= 3
+
+
+def test_download_ahead_error() -> None:
+    def download_or_fail(name: str) -> StreamedFile:
+        if name == "broken":
+            raise IOError(name)
+        return download(name)
+
+    with pytest.raises(IOError):
+        list(download_ahead(download_or_fail, ["file", "broken"], max_workers=1))
+
+
+def test_temporary_content(monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "STREAM_SPOOL_MAX_SIZE", 10)
+
+    with temporary_content(10) as content:
+        assert isinstance(content, io.BytesIO)
+
+    with temporary_content(11) as content:
+        assert not isinstance(content, io.BytesIO)
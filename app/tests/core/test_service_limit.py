@@ -0,0 +1,45 @@
+from typing import Any
+
+import pytest
+
+from app.core import service_limit as service_limit_module
+from app.core.config import settings
+from app.core.service_limit import InProcessLimiter, ServiceLimitReached, service_limit
+
+
+@pytest.fixture
+def in_process_limiter(monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "SERVICE_CONCURRENCY_LIMITS", {"dropbox": 1})
+    monkeypatch.setattr(service_limit_module, "limiter", InProcessLimiter())
+
+
+@pytest.mark.usefixtures("in_process_limiter")
+def test_service_limit_per_token() -> None:
+    with service_limit("dropbox", "token"):
+        with pytest.raises(ServiceLimitReached):
+            with service_limit("dropbox", "token"):
+                pass
+
+        # Other tokens have their own slots
+        with service_limit("dropbox", "other-token"):
+            pass
+
+    # The slot is released when leaving the context
+    with service_limit("dropbox", "token"):
+        pass
+
+
+@pytest.mark.usefixtures("in_process_limiter")
+def test_service_without_limit() -> None:
+    with service_limit("git", "token"), service_limit("git", "token"):
+        pass
+
+
+@pytest.mark.usefixtures("in_process_limiter")
+def test_service_limit_released_on_error() -> None:
+    with pytest.raises(RuntimeError):
+        with service_limit("dropbox", "token"):
+            raise RuntimeError()
+
+    with service_limit("dropbox", "token"):
+        pass
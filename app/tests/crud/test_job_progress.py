@@ -0,0 +1,91 @@
+from typing import Any, Dict, Generator
+
+import pytest
+from sqlalchemy.orm import Session
+
+from app import crud
+from app.core.config import settings
+from app.models.job import Job
+from app.schemas import JobCreate
+from app.tests.utils import utils
+
+
+@pytest.fixture(scope="function")
+def basic_job(db: Session) -> Generator[Dict, None, None]:
+    random_project_name = utils.random_lower_string()
+    job_input = JobCreate(
+        import_service="git",
+        import_url=f"https://github.com/wikifactory/{random_project_name}",
+        export_service="wikifactory",
+        export_url=f"https://wikifactory.com/@user/{random_project_name}",
+    )
+    db_job = crud.job.create(db, obj_in=job_input)
+
+    yield {"job_input": job_input, "db_job": db_job}
+    crud.job.remove(db, id=db_job.id)
+
+
+def test_progress_is_buffered_until_flush_count(
+    monkeypatch: Any, db: Session, basic_job: dict
+) -> None:
+    monkeypatch.setattr(settings, "PROGRESS_FLUSH_COUNT", 3)
+    monkeypatch.setattr(settings, "PROGRESS_FLUSH_INTERVAL", 3600)
+
+    job: Job = basic_job["db_job"]
+
+    with crud.job.progress(db, job_id=job.id) as progress:
+        progress.increment_imported_items()
+        progress.increment_imported_items()
+        db.refresh(job)
+        assert job.imported_items == 0
+
+        progress.increment_exported_items()
+        db.refresh(job)
+        assert job.imported_items == 2
+        assert job.exported_items == 1
+
+        progress.increment_exported_items()
+
+    # The remaining items are written when leaving the context
+    db.refresh(job)
+    assert job.exported_items == 2
+
+
+def test_progress_bytes_are_buffered_with_items(
+    monkeypatch: Any, db: Session, basic_job: dict
+) -> None:
+    monkeypatch.setattr(settings, "PROGRESS_FLUSH_COUNT", 2)
+    monkeypatch.setattr(settings, "PROGRESS_FLUSH_INTERVAL", 3600)
+
+    job: Job = basic_job["db_job"]
+
+    with crud.job.progress(db, job_id=job.id) as progress:
+        progress.increment_imported_items()
+        progress.increment_imported_bytes(100)
+        db.refresh(job)
+        assert job.imported_bytes == 0
+
+        progress.increment_imported_items()
+        progress.increment_imported_bytes(50)
+        db.refresh(job)
+        assert job.imported_items == 2
+        assert job.imported_bytes == 100
+
+    db.refresh(job)
+    assert job.imported_bytes == 150
+
+
+def test_progress_is_flushed_on_error(
+    monkeypatch: Any, db: Session, basic_job: dict
+) -> None:
+    monkeypatch.setattr(settings, "PROGRESS_FLUSH_INTERVAL", 3600)
+
+    job: Job = basic_job["db_job"]
+
+    with pytest.raises(RuntimeError):
+        with crud.job.progress(db, job_id=job.id) as progress:
+            progress.increment_imported_items()
+            raise RuntimeError()
+
+    db.refresh(job)
+    assert job.imported_items == 1
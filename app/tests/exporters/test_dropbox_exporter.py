@@ -60,7 +60,7 @@ def dropbox_mock(monkeypatch: Any) -> None:
 @pytest.fixture
 def mocked_files_upload_success(monkeypatch: Any) -> None:
     def mocked_files_upload(
-        self: Any, f: bytes, remote_path: str
+        self: Any, f: bytes, remote_path: str, mode: dropbox.files.WriteMode
     ) -> dropbox.files.Metadata:
         return dropbox.files.Metadata()
 
@@ -122,9 +122,37 @@ def test_dropbox_exporter_success(
     assert retrieved_job.status == JobStatus.FINISHED_SUCCESSFULLY
 
 
+def test_dropbox_exporter_overwrites_previous_upload(
+    monkeypatch: Any, db: Session, basic_job: dict
+) -> None:
+    job = basic_job["db_job"]
+    upload_modes: Dict[str, dropbox.files.WriteMode] = {}
+
+    def mocked_files_upload(
+        self: Any, f: bytes, remote_path: str, mode: dropbox.files.WriteMode
+    ) -> dropbox.files.Metadata:
+        upload_modes[os.path.basename(remote_path)] = mode
+        return dropbox.files.Metadata()
+
+    monkeypatch.setattr(dropbox.Dropbox, "files_upload", mocked_files_upload)
+
+    # A previous attempt uploaded the file with a different content
+    crud.exported_file.update_or_create_many(
+        db, job_id=job.id, content_hashes={"README.md": "0" * 64}
+    )
+
+    exporter = DropboxExporter(db, job_id=job.id)
+    exporter.process()
+
+    assert job.status == JobStatus.FINISHED_SUCCESSFULLY
+    assert upload_modes == {"README.md": dropbox.files.WriteMode.overwrite}
+
+
 @pytest.fixture
 def mocked_files_upload_fail(monkeypatch: Any) -> None:
-    def mocked_files_upload(self: Any, f: bytes, remote_path: str) -> ApiError:
+    def mocked_files_upload(
+        self: Any, f: bytes, remote_path: str, mode: dropbox.files.WriteMode
+    ) -> ApiError:
         raise ApiError("", "", "", "")
 
     monkeypatch.setattr(dropbox.Dropbox, "files_upload", mocked_files_upload)
@@ -65,10 +65,10 @@ def test_remove_files_on_finish(
 
     monkeypatch.setattr(exporter, "get_project_details", mock_get_project_details)
 
-    def mock_on_file_cb(*args: List, **kwargs: Dict) -> None:
-        crud.job.increment_exported_items(db=db, job_id=exporter.job_id)
+    async def mock_export_batch(*args: List, **kwargs: Dict) -> None:
+        pass
 
-    monkeypatch.setattr(exporter, "on_file_cb", mock_on_file_cb)
+    monkeypatch.setattr(exporter, "export_batch", mock_export_batch)
 
     def mock_on_finished_cb(*args: List, **kwargs: Dict) -> None:
         pass
@@ -115,6 +115,12 @@ def test_git_exporter(
 
     assert job
 
+    # The git repository is not counted
+    os.makedirs(os.path.join(job.path, ".git"))
+    for path in ["README.md", ".git/HEAD"]:
+        with open(os.path.join(job.path, path), "w") as file_handle:
+            file_handle.write("content")
+
     exporter = GitExporter(db, job_id=job.id)
 
     exporter.process()
@@ -158,6 +164,8 @@ def test_git_exporter(
         .one()
     )
     assert retrieved_job.status == JobStatus.FINISHED_SUCCESSFULLY
+    assert retrieved_job.exported_items == 1
+    assert retrieved_job.exported_bytes == len("content")
 
 
 # Test what happens if we found an error in the commit step
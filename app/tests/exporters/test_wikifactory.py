@@ -1,24 +1,34 @@
+import asyncio
 import os
 from distutils.dir_util import copy_tree
-from typing import Any, Dict, Generator, List
+from typing import Any, Awaitable, Callable, Dict, Generator, List, Optional
 
+import aiohttp
 import gql
 import py
 import pytest
 import requests
+from aiohttp import hdrs
+from aioresponses import CallbackResult, aioresponses
 from gql import Client
 from sqlalchemy.orm import Session
+from yarl import URL
 
 from app import crud
-from app.exporters.base import AuthRequired
+from app.core.config import settings
+from app.exporters.base import AuthRequired, NotReachable
 from app.exporters.wikifactory import (
+    AsyncWikifactorySession,
     FileUploadFailed,
+    LocalFile,
     NoResult,
     UserErrors,
     WikifactoryExporter,
     space_slug_from_url,
+    wikifactory_api_batch_request,
     wikifactory_api_request,
 )
+from app.exporters.wikifactory_gql import batch_mutation, file_field
 from app.models.job import JobStatus
 from app.models.job_log import JobLog
 from app.schemas import JobCreate
@@ -110,6 +120,50 @@ def mock_gql_response(monkeypatch: Any, response_dict: dict) -> None:
     monkeypatch.setattr(gql.Client, "execute", mock_execute)
 
 
+def generate_mock_async_gql_response(response_dict: Dict) -> CallbackResult:
+    status = response_dict.get("status_code", 200)
+    payload = {
+        key: response_dict[key] for key in ("data", "errors") if key in response_dict
+    }
+
+    return CallbackResult(status=status, payload=payload or None)
+
+
+@pytest.fixture
+def expected_variables() -> Optional[dict]:
+    # Only the tests parametrized with the variables check them
+    return None
+
+
+@pytest.fixture
+def mock_async_gql_response(
+    response_dict: dict, expected_variables: Optional[dict]
+) -> Generator[None, None, None]:
+    def mock_post(url: str, **kwargs: Any) -> CallbackResult:
+        if expected_variables:
+            assert kwargs["json"]["variables"] == expected_variables
+
+        return generate_mock_async_gql_response(response_dict)
+
+    with aioresponses() as mocked:
+        mocked.post(
+            f"{settings.WIKIFACTORY_API_BASE_URL}/api/graphql",
+            callback=mock_post,
+            repeat=True,
+        )
+        yield
+
+
+def run_with_session(
+    coroutine_function: Callable[..., Awaitable[Any]], *args: Any
+) -> Any:
+    async def run() -> Any:
+        async with AsyncWikifactorySession("this-is-a-token") as session:
+            return await coroutine_function(session, *args)
+
+    return asyncio.run(run())
+
+
 @pytest.fixture
 def basic_job(db: Session, tmpdir: py.path.local) -> Generator[Dict, None, None]:
     random_project_name = utils.random_lower_string()
@@ -305,7 +359,7 @@ def test_get_project_details(
             {"space_id": "space-id", "project_id": "project-id"},
             {
                 "data": {
-                    "file": {
+                    "item0": {
                         "file": {
                             "id": "file-id",
                             "uploadUrl": "http://upload-domain/upload-endpoint",
@@ -314,7 +368,7 @@ def test_get_project_details(
                 }
             },
             {
-                "fileInput": {
+                "item0": {
                     "filename": "README.md",
                     "spaceId": "space-id",
                     "size": 54,
@@ -327,8 +381,8 @@ def test_get_project_details(
         ),
     ],
 )
-@pytest.mark.usefixtures("mock_gql_response_assert_variables")
-def test_process_element_mutation_variables(
+@pytest.mark.usefixtures("mock_async_gql_response")
+def test_process_files_mutation_variables(
     basic_job: Dict,
     exporter: WikifactoryExporter,
     project_details: Dict,
@@ -336,7 +390,9 @@ def test_process_element_mutation_variables(
     job = basic_job["db_job"]
 
     exporter.project_details = project_details
-    exporter.process_file(os.path.join(job.path, "README.md"))
+    run_with_session(
+        exporter.process_files, [LocalFile(os.path.join(job.path, "README.md"))]
+    )
 
 
 @pytest.mark.parametrize(
@@ -361,42 +417,45 @@ def test_process_element_mutation_variables(
     ],
 )
 def test_upload_file_headers(
-    monkeypatch: Any,
     exporter: WikifactoryExporter,
     project_details: Dict,
     expected_headers: Dict,
     basic_job: dict,
 ) -> None:
-    def mock_put_assert_headers(*args: List, **kwargs: Dict) -> requests.Response:
+    file_url = "http://upload-domain/upload-endpoint"
+
+    def mock_put_assert_headers(url: URL, **kwargs: Any) -> CallbackResult:
         headers = kwargs.get("headers")
         assert headers == expected_headers
-        response = requests.Response()
-        response.status_code = requests.codes["ok"]
-        return response
 
-    monkeypatch.setattr(requests, "put", mock_put_assert_headers)
+        # The body becomes a payload with its own headers, which are sent too
+        body = aiohttp.payload.get_payload(kwargs.get("data"))
+        assert hdrs.CONTENT_DISPOSITION not in body.headers
+
+        request = aiohttp.ClientRequest("PUT", url, headers=headers, data=body)
+        assert {
+            key: value for (key, value) in request.headers.items() if key in headers
+        } == expected_headers
+        assert hdrs.CONTENT_DISPOSITION not in request.headers
+
+        return CallbackResult()
 
     job = basic_job["db_job"]
 
     exporter.project_details = project_details
 
-    file_url = "http://upload-domain/upload-endpoint"
     file_path = os.path.join(job.path, "README.md")
-    with open(file_path, "rb") as file_handle:
-        exporter.upload_file(file_handle, file_url)
+
+    with aioresponses() as mocked:
+        mocked.put(file_url, callback=mock_put_assert_headers)
+        run_with_session(exporter.upload_file, LocalFile(file_path), file_url)
 
 
 def test_upload_file_error(
-    monkeypatch: Any,
     exporter: WikifactoryExporter,
     basic_job: dict,
 ) -> None:
-    def mock_put_status_error(*args: List, **kwargs: Dict) -> requests.Response:
-        response = requests.Response()
-        response.status_code = requests.codes["expectation_failed"]
-        return response
-
-    monkeypatch.setattr(requests, "put", mock_put_status_error)
+    file_url = "http://upload-domain/upload-endpoint"
 
     job = basic_job["db_job"]
 
@@ -406,11 +465,11 @@ def test_upload_file_error(
         "private": False,
     }
 
-    file_url = "http://upload-domain/upload-endpoint"
     file_path = os.path.join(job.path, "README.md")
 
-    with open(file_path, "rb") as file_handle, pytest.raises(FileUploadFailed):
-        exporter.upload_file(file_handle, file_url)
+    with pytest.raises(FileUploadFailed), aioresponses() as mocked:
+        mocked.put(file_url, status=requests.codes["expectation_failed"])
+        run_with_session(exporter.upload_file, LocalFile(file_path), file_url)
 
 
 @pytest.mark.parametrize(
@@ -421,7 +480,7 @@ def test_upload_file_error(
             "file-id",
             {
                 "data": {
-                    "file": {
+                    "item0": {
                         "file": {
                             "id": "file-id",
                         }
@@ -429,7 +488,7 @@ def test_upload_file_error(
                 }
             },
             {
-                "fileInput": {
+                "item0": {
                     "id": "file-id",
                     "spaceId": "space-id",
                     "completed": True,
@@ -438,12 +497,17 @@ def test_upload_file_error(
         ),
     ],
 )
-@pytest.mark.usefixtures("mock_gql_response_assert_variables")
-def test_complete_file_mutation_variables(
-    exporter: WikifactoryExporter, project_details: Dict, file_id: str
+@pytest.mark.usefixtures("mock_async_gql_response")
+def test_complete_files_mutation_variables(
+    basic_job: Dict,
+    exporter: WikifactoryExporter,
+    project_details: Dict,
+    file_id: str,
 ) -> None:
+    job = basic_job["db_job"]
+    local_file = LocalFile(os.path.join(job.path, "README.md"))
     exporter.project_details = project_details
-    exporter.complete_file(file_id)
+    run_with_session(exporter.complete_files, [(local_file, file_id)])
 
 
 @pytest.mark.parametrize(
@@ -454,7 +518,7 @@ def test_complete_file_mutation_variables(
             "file-id",
             {
                 "data": {
-                    "operation": {
+                    "item0": {
                         "project": {
                             "id": "project-id",
                         }
@@ -462,7 +526,7 @@ def test_complete_file_mutation_variables(
                 }
             },
             {
-                "operationData": {
+                "item0": {
                     "fileId": "file-id",
                     "opType": "ADD",
                     "path": "README.md",
@@ -472,17 +536,17 @@ def test_complete_file_mutation_variables(
         ),
     ],
 )
-@pytest.mark.usefixtures("mock_gql_response_assert_variables")
-def test_perform_mutation_operation_variables(
+@pytest.mark.usefixtures("mock_async_gql_response")
+def test_perform_mutation_operations_variables(
     basic_job: Dict,
     exporter: WikifactoryExporter,
     project_details: Dict,
     file_id: str,
 ) -> None:
     job = basic_job["db_job"]
-    file_path = os.path.join(job.path, "README.md")
+    local_file = LocalFile(os.path.join(job.path, "README.md"))
     exporter.project_details = project_details
-    exporter.perform_mutation_operation(file_path, file_id)
+    run_with_session(exporter.perform_mutation_operations, [(local_file, file_id)])
 
 
 @pytest.mark.parametrize(
@@ -517,26 +581,101 @@ def test_on_finished_cb_mutation_variables(
     exporter.on_finished_cb()
 
 
-def test_on_file_cb_user_errors(
+def test_export_batch_user_errors(
     monkeypatch: Any, exporter: WikifactoryExporter
 ) -> None:
-    def mock_process_file(*args: List, **kwargs: Dict) -> None:
-        raise UserErrors()
+    async def mock_process_files(*args: List, **kwargs: Dict) -> List:
+        return [UserErrors()]
 
-    monkeypatch.setattr(exporter, "process_file", mock_process_file)
+    monkeypatch.setattr(exporter, "process_files", mock_process_files)
 
     with pytest.raises(FileUploadFailed):
-        exporter.on_file_cb("")
+        run_with_session(exporter.export_batch, [LocalFile("")])
 
 
-def test_on_file_cb_no_file_id(monkeypatch: Any, exporter: WikifactoryExporter) -> None:
-    def mock_process_file(*args: List, **kwargs: Dict) -> Dict:
-        return {"id": None, "uploadUrl": None}
+def test_export_batch_no_file_id(
+    monkeypatch: Any, exporter: WikifactoryExporter
+) -> None:
+    async def mock_process_files(*args: List, **kwargs: Dict) -> List:
+        return [{"id": None, "uploadUrl": None}]
 
-    monkeypatch.setattr(exporter, "process_file", mock_process_file)
+    monkeypatch.setattr(exporter, "process_files", mock_process_files)
 
     with pytest.raises(FileUploadFailed):
-        exporter.on_file_cb("")
+        run_with_session(exporter.export_batch, [LocalFile("")])
+
+
+@pytest.mark.parametrize(
+    "response_dict, expected_results",
+    [
+        (
+            {
+                "data": {
+                    "item0": {"file": {"id": "file-id"}},
+                    "item1": {
+                        "userErrors": [
+                            {
+                                "key": 0,
+                                "code": "UNHANDLED_ERROR",
+                                "message": "Backend exception",
+                            }
+                        ]
+                    },
+                    "item2": {},
+                }
+            },
+            [{"id": "file-id"}, UserErrors, NoResult],
+        ),
+        (
+            {
+                "data": {"item0": {"file": {"id": "file-id"}}, "item1": None},
+                "errors": [
+                    {
+                        "message": "Invalid file input",
+                        "path": ["item1"],
+                    }
+                ],
+            },
+            [{"id": "file-id"}, NotReachable],
+        ),
+    ],
+)
+@pytest.mark.usefixtures("mock_async_gql_response")
+def test_api_batch_request(expected_results: List) -> None:
+    document = batch_mutation("File", "FileInput", file_field, len(expected_results))
+    results = run_with_session(
+        wikifactory_api_batch_request,
+        document,
+        [{}] * len(expected_results),
+        "file.file",
+    )
+
+    assert len(results) == len(expected_results)
+    for (result, expected_result) in zip(results, expected_results):
+        if isinstance(expected_result, dict):
+            assert result == expected_result
+        else:
+            assert isinstance(result, expected_result)
+
+
+@pytest.mark.parametrize(
+    "response_dict",
+    [
+        {"status_code": requests.codes["unauthorized"]},
+        {"errors": [{"message": "unauthorized request"}]},
+        {"errors": [{"message": "token is invalid"}]},
+        {
+            "data": {"item0": None},
+            "errors": [{"message": "unauthorized request", "path": ["item0"]}],
+        },
+    ],
+)
+@pytest.mark.usefixtures("mock_async_gql_response")
+def test_api_batch_request_auth_error() -> None:
+    document = batch_mutation("File", "FileInput", file_field, 1)
+
+    with pytest.raises(AuthRequired):
+        run_with_session(wikifactory_api_batch_request, document, [{}], "file.file")
 
 
 @pytest.mark.parametrize(
@@ -556,10 +695,10 @@ def test_wikifactory_exporter(
 
     monkeypatch.setattr(exporter, "get_project_details", mock_get_project_details)
 
-    def mock_on_file_cb(*args: List, **kwargs: Dict) -> None:
-        crud.job.increment_exported_items(db=db, job_id=exporter.job_id)
+    async def mock_export_batch(*args: List, **kwargs: Dict) -> None:
+        pass
 
-    monkeypatch.setattr(exporter, "on_file_cb", mock_on_file_cb)
+    monkeypatch.setattr(exporter, "export_batch", mock_export_batch)
 
     def mock_on_finished_cb(*args: List, **kwargs: Dict) -> None:
         pass
@@ -570,7 +709,7 @@ def test_wikifactory_exporter(
 
     exporter.process()
 
-    # TODO check that on_file_cb has been called for each file
+    # TODO check that export_batch has been called for each batch
 
     # TODO check that on_finished_cb has been called
 
@@ -600,3 +739,75 @@ def test_wikifactory_exporter(
     )
     assert finished_successfully_status_log
     assert items_count == job.exported_items
+
+    # The files are recorded, so a retry can skip them
+    assert list(crud.exported_file.get_content_hashes(db, job_id=job.id)) == [
+        "README.md"
+    ]
+
+
+def test_wikifactory_exporter_skips_exported_files(
+    monkeypatch: Any, db: Session, basic_job: dict, exporter: WikifactoryExporter
+) -> None:
+    job = basic_job["db_job"]
+
+    # Added to the project by a previous attempt
+    local_file = LocalFile(os.path.join(job.path, "README.md"))
+    crud.exported_file.update_or_create_many(
+        db, job_id=job.id, content_hashes={"README.md": local_file.git_hash}
+    )
+
+    exported_files: List[LocalFile] = []
+
+    async def mock_export_batch(
+        session: AsyncWikifactorySession, local_files: List[LocalFile]
+    ) -> None:
+        exported_files.extend(local_files)
+
+    def mock_get_project_details(*args: List, **kwargs: Dict) -> Dict:
+        return {"project_id": "project-id", "private": True, "space_id": "space-id"}
+
+    def mock_on_finished_cb(*args: List, **kwargs: Dict) -> None:
+        pass
+
+    monkeypatch.setattr(exporter, "export_batch", mock_export_batch)
+    monkeypatch.setattr(exporter, "get_project_details", mock_get_project_details)
+    monkeypatch.setattr(exporter, "on_finished_cb", mock_on_finished_cb)
+
+    exporter.process()
+
+    assert not exported_files
+
+    # Still counted as exported
+    db.refresh(job)
+    assert job.status is JobStatus.FINISHED_SUCCESSFULLY
+    assert job.exported_items == 1
+
+
+def test_export_files_limits_batches(
+    monkeypatch: Any, basic_job: dict, exporter: WikifactoryExporter
+) -> None:
+    monkeypatch.setattr(settings, "WIKIFACTORY_BATCH_SIZE", 1)
+    monkeypatch.setattr(settings, "WIKIFACTORY_MAX_BATCHES", 2)
+
+    local_files = [LocalFile(f"file-{index}.txt") for index in range(10)]
+    exported_files: List[LocalFile] = []
+    running_batches = 0
+    max_running_batches = 0
+
+    async def mock_export_and_record(
+        session: AsyncWikifactorySession, progress: Any, batch: List[LocalFile]
+    ) -> None:
+        nonlocal running_batches, max_running_batches
+        running_batches += 1
+        max_running_batches = max(max_running_batches, running_batches)
+        await asyncio.sleep(0)
+        exported_files.extend(batch)
+        running_batches -= 1
+
+    monkeypatch.setattr(exporter, "export_and_record", mock_export_and_record)
+
+    asyncio.run(exporter.export_files(local_files))
+
+    assert max_running_batches == 2
+    assert exported_files == local_files
@@ -1,18 +1,27 @@
 import datetime
+import hashlib
+import io
 import os
 import pathlib
-from typing import Any, Dict, Generator, List, Optional
+import zipfile
+from concurrent.futures import Future
+from typing import Any, Dict, Generator, List, Optional, Set, Tuple
 
 import pytest
+import requests
 from dropbox.dropbox_client import Dropbox
 from dropbox.exceptions import ApiError, AuthError
-from dropbox.files import FileMetadata, FolderMetadata
+from dropbox.files import FileMetadata, FolderMetadata, SharedLink
+from dropbox.sharing import FolderLinkMetadata
 from sqlalchemy.orm import Session
 
 from app import crud
+from app.core import blob_cache
 from app.core.config import settings
+from app.crud.crud_job import JobProgress
 from app.importers import dropbox
-from app.importers.dropbox import DropboxImporter
+from app.importers.dropbox import DropboxImporter, get_zip_url, use_zip_download
+from app.importers.file_tree import TreeNode
 from app.models.job import Job, JobStatus
 from app.schemas import JobCreate
 from app.tests.utils import utils
@@ -48,14 +57,27 @@ def basic_job(db: Session) -> Generator[Dict, None, None]:
 @pytest.fixture
 def dropbox_mock(monkeypatch: Any, remote_data: dict) -> None:
     def mock_files_list_folder(
-        self: Any, path: str, shared_link: str = None
+        self: Any,
+        path: str,
+        shared_link: SharedLink = None,
+        recursive: bool = False,
+        include_mounted_folders: bool = False,
     ) -> DropbboxListFolderMock:
         files_list = DropbboxListFolderMock()
 
-        if path != "":
+        if recursive:
+            # Every entry under the folder, as a flat list
+            files_list.entries = [
+                entry
+                for folder in remote_data.values()
+                if isinstance(folder, dict)
+                for entry in folder.get("children", [])
+                if entry.path_lower.startswith(path.lower() + "/")
+            ]
+        elif path != "":
             files_list.entries = remote_data[path].get("children", [])
         else:
-            files_list.entries = remote_data[shared_link].get("children", [])
+            files_list.entries = remote_data[shared_link.url].get("children", [])
         return files_list
 
     def mock_dropbox_handler(self: Any, oauth2_access_token: str) -> dropbox.Dropbox:
@@ -67,13 +89,43 @@ def dropbox_mock(monkeypatch: Any, remote_data: dict) -> None:
 
 @pytest.fixture
 def download_mock(monkeypatch: Any, basic_job: dict) -> None:
-    def mock_files_download_to_file(self: Any, download_path: str, path: str) -> None:
+    def mock_files_download_to_file(
+        self: Any, download_path: str, path: str
+    ) -> FileMetadata:
         with open(download_path, "wb") as file_handle:
             file_handle.write(b"dummycontent")
 
+        return FileMetadata(
+            name=os.path.basename(download_path),
+            path_lower=path,
+            size=len(b"dummycontent"),
+            content_hash=dropbox.dropbox_content_hash(download_path),
+        )
+
     monkeypatch.setattr(Dropbox, "files_download_to_file", mock_files_download_to_file)
 
 
+@pytest.fixture
+def shared_link_download_mock(monkeypatch: Any) -> None:
+    def mock_sharing_get_shared_link_file_to_file(
+        self: Any, download_path: str, url: str, path: str
+    ) -> None:
+        assert download_path.endswith(path)
+        with open(download_path, "wb") as file_handle:
+            file_handle.write(b"dummycontent")
+
+    monkeypatch.setattr(
+        Dropbox,
+        "sharing_get_shared_link_file_to_file",
+        mock_sharing_get_shared_link_file_to_file,
+    )
+
+
+def folder_node(node: TreeNode, children: Dict[str, TreeNode]) -> TreeNode:
+    node.children = children
+    return node
+
+
 @pytest.mark.parametrize(
     "remote_data, expected_tree",
     [
@@ -85,12 +137,19 @@ def download_mock(monkeypatch: Any, basic_job: dict) -> None:
                         FileMetadata(
                             id="root-file-1",
                             name="README.md",
+                            path_lower="root-folder/readme.md",
+                            path_display="root-folder/README.md",
                             size=0,
                             server_modified=datetime.datetime(2020, 1, 1),
                             client_modified=datetime.datetime(2020, 1, 1),
                             rev="123456789",
                         ),
-                        FolderMetadata(id="subfolder-1", name="Subfolder"),
+                        FolderMetadata(
+                            id="subfolder-1",
+                            name="Subfolder",
+                            path_lower="root-folder/subfolder",
+                            path_display="root-folder/Subfolder",
+                        ),
                     ],
                 },
                 "subfolder-1": {
@@ -98,6 +157,8 @@ def download_mock(monkeypatch: Any, basic_job: dict) -> None:
                         FileMetadata(
                             id="nested-file-1",
                             name="test.txt",
+                            path_lower="root-folder/subfolder/test.txt",
+                            path_display="root-folder/Subfolder/test.txt",
                             size=0,
                             server_modified=datetime.datetime(2020, 1, 1),
                             client_modified=datetime.datetime(2020, 1, 1),
@@ -107,50 +168,99 @@ def download_mock(monkeypatch: Any, basic_job: dict) -> None:
                 },
             },
             {
-                "README.md": {
-                    "entry": FileMetadata(
-                        id="root-file-1",
-                        name="README.md",
-                        size=0,
-                        server_modified=datetime.datetime(2020, 1, 1),
-                        client_modified=datetime.datetime(2020, 1, 1),
-                        rev="123456789",
+                "README.md": TreeNode(
+                    "README.md", id="root-file-1", path="root-folder/readme.md"
+                ),
+                "Subfolder": folder_node(
+                    TreeNode(
+                        "Subfolder",
+                        id="subfolder-1",
+                        path="root-folder/subfolder",
+                        is_folder=True,
                     ),
-                    "children": {},
-                    "path": "root-folder/README.md",
-                },
-                "Subfolder": {
-                    "entry": FolderMetadata(id="subfolder-1", name="Subfolder"),
-                    "children": {
-                        "test.txt": {
-                            "entry": FileMetadata(
-                                id="nested-file-1",
-                                name="test.txt",
-                                size=0,
-                                server_modified=datetime.datetime(2020, 1, 1),
-                                client_modified=datetime.datetime(2020, 1, 1),
-                                rev="123456789",
-                            ),
-                            "children": {},
-                            "path": "subfolder-1/test.txt",
-                        }
+                    {
+                        "test.txt": TreeNode(
+                            "test.txt",
+                            id="nested-file-1",
+                            path="root-folder/subfolder/test.txt",
+                        )
                     },
-                    "path": "root-folder/Subfolder",
-                },
+                ),
             },
         )
     ],
 )
 @pytest.mark.usefixtures("dropbox_mock")
-def test_build_tree_recursively(
-    db: Session, basic_job: dict, expected_tree: dict
-) -> None:
+def test_walk_user_folder(db: Session, basic_job: dict, expected_tree: dict) -> None:
     importer = DropboxImporter(db, basic_job["db_job"].id)
     importer.url_type = "user_folder"
     importer.dropbox_handler = Dropbox(oauth2_access_token="sadas")
     tree: Dict = {}
-    importer.build_tree_recursively(tree, "root-folder")
+    relative_paths = [
+        relative_path
+        for (_, relative_path) in importer.walk_user_folder(tree, "root-folder")
+    ]
+    assert tree == expected_tree
+    assert relative_paths == ["README.md", "Subfolder", "Subfolder/test.txt"]
+
+
+@pytest.mark.parametrize(
+    "remote_data, expected_tree",
+    [
+        (
+            {
+                "https://www.dropbox.com/sh/shared-folder": {
+                    "children": [
+                        FileMetadata(
+                            id="root-file-1",
+                            name="README.md",
+                            size=0,
+                            server_modified=datetime.datetime(2020, 1, 1),
+                            client_modified=datetime.datetime(2020, 1, 1),
+                            rev="123456789",
+                        ),
+                        FolderMetadata(id="subfolder-1", name="Subfolder"),
+                    ],
+                },
+                "/Subfolder": {
+                    "children": [
+                        FileMetadata(
+                            id="nested-file-1",
+                            name="test.txt",
+                            size=0,
+                            server_modified=datetime.datetime(2020, 1, 1),
+                            client_modified=datetime.datetime(2020, 1, 1),
+                            rev="123456789",
+                        ),
+                    ],
+                },
+            },
+            {
+                "README.md": TreeNode("README.md", id="root-file-1"),
+                "Subfolder": folder_node(
+                    TreeNode(
+                        "Subfolder", id="subfolder-1", path="/Subfolder", is_folder=True
+                    ),
+                    {"test.txt": TreeNode("test.txt", id="nested-file-1")},
+                ),
+            },
+        )
+    ],
+)
+@pytest.mark.usefixtures("dropbox_mock")
+def test_walk_shared_folder(db: Session, basic_job: dict, expected_tree: dict) -> None:
+    importer = DropboxImporter(db, basic_job["db_job"].id)
+    importer.url_type = "shared"
+    importer.dropbox_handler = Dropbox(oauth2_access_token="sadas")
+    tree: Dict = {}
+    relative_paths = [
+        relative_path
+        for (_, relative_path) in importer.walk(
+            tree, "https://www.dropbox.com/sh/shared-folder"
+        )
+    ]
     assert tree == expected_tree
+    assert relative_paths == ["README.md", "Subfolder", "Subfolder/test.txt"]
 
 
 @pytest.fixture
@@ -163,12 +273,19 @@ def remote_data(basic_job: Dict) -> Dict:
                 FileMetadata(
                     id="root-file-1",
                     name="README.md",
+                    path_lower="/user_folder/readme.md",
+                    path_display="/user_folder/README.md",
                     size=0,
                     server_modified=datetime.datetime(2020, 1, 1),
                     client_modified=datetime.datetime(2020, 1, 1),
                     rev="123456789",
                 ),
-                FolderMetadata(id="subfolder-1", name="Subfolder"),
+                FolderMetadata(
+                    id="subfolder-1",
+                    name="Subfolder",
+                    path_lower="/user_folder/subfolder",
+                    path_display="/user_folder/Subfolder",
+                ),
             ],
         },
         "subfolder-1": {
@@ -176,6 +293,8 @@ def remote_data(basic_job: Dict) -> Dict:
                 FileMetadata(
                     id="nested-file-1",
                     name="test.txt",
+                    path_lower="/user_folder/subfolder/test.txt",
+                    path_display="/user_folder/Subfolder/test.txt",
                     size=0,
                     server_modified=datetime.datetime(2020, 1, 1),
                     client_modified=datetime.datetime(2020, 1, 1),
@@ -190,11 +309,9 @@ def remote_data(basic_job: Dict) -> Dict:
 def assert_tree_directory_recursive(current_level: Dict, accumulated_path: str) -> None:
     for (name, node) in current_level.items():
         check_path = os.path.join(accumulated_path, name)
-        entry = node.get("entry")
-        if isinstance(entry, FolderMetadata):
+        if node.children is not None:
             assert os.path.isdir(check_path)
-            children = node.get("children")
-            assert_tree_directory_recursive(children, check_path)
+            assert_tree_directory_recursive(node.children, check_path)
         else:
             assert os.path.isfile(check_path)
 
@@ -209,10 +326,9 @@ def test_dropbox_importer_success(
     importer = DropboxImporter(db, job.id)
     importer.process()
 
-    importer.tree_root["entry"] = None
-
+    assert importer.tree_root.children is not None
     assert_tree_directory_recursive(
-        importer.tree_root["children"], basic_job["db_job"].path
+        importer.tree_root.children, basic_job["db_job"].path
     )
 
     assert job.imported_items == remote_data["total_items"]
@@ -267,3 +383,309 @@ def test_dropbox_importer_api_error(
     with pytest.raises(exception.__class__):
         importer.process()
     assert job.status is job_status
+
+
+@pytest.mark.parametrize("url_type", ["user_folder", "id"])
+@pytest.mark.usefixtures("download_mock", "shared_link_download_mock")
+def test_download_tree_in_parallel(
+    tmpdir: pathlib.Path, db: Session, basic_job: dict, url_type: str
+) -> None:
+    job: Job = basic_job["db_job"]
+
+    importer = DropboxImporter(db, job.id)
+    importer.url_type = url_type
+    importer.shared_link = SharedLink(url="https://www.dropbox.com/sh/shared-folder")
+    importer.dropbox_handler = Dropbox(oauth2_access_token="token")
+
+    tree = {
+        "README.md": TreeNode("README.md", id="root-file-1"),
+        "Subfolder": folder_node(
+            TreeNode("Subfolder", id="subfolder-1", is_folder=True),
+            {"test.txt": TreeNode("test.txt", id="nested-file-1")},
+        ),
+    }
+
+    importer.download_tree_in_parallel(tree, str(tmpdir))
+
+    assert_tree_directory_recursive(tree, str(tmpdir))
+    assert job.imported_items == 2
+
+
+def test_dropbox_content_hash(tmpdir: pathlib.Path) -> None:
+    empty_path = os.path.join(tmpdir, "empty")
+    with open(empty_path, "wb"):
+        pass
+
+    assert (
+        dropbox.dropbox_content_hash(empty_path)
+        == "e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855"
+    )
+
+    # Hash of the hashes of each block
+    blocks = [b"a" * dropbox.CONTENT_HASH_BLOCK_SIZE, b"b"]
+    file_path = os.path.join(tmpdir, "blocks")
+    with open(file_path, "wb") as file_handle:
+        file_handle.write(b"".join(blocks))
+
+    block_hashes = b"".join(hashlib.sha256(block).digest() for block in blocks)
+    assert (
+        dropbox.dropbox_content_hash(file_path)
+        == hashlib.sha256(block_hashes).hexdigest()
+    )
+
+
+@pytest.mark.usefixtures("download_mock")
+def test_download_file_already_downloaded(
+    tmpdir: pathlib.Path, db: Session, basic_job: dict
+) -> None:
+    importer = DropboxImporter(db, basic_job["db_job"].id)
+    importer.url_type = "user_folder"
+    importer.dropbox_handler = Dropbox(oauth2_access_token="token")
+
+    download_path = os.path.join(tmpdir, "README.md")
+    with open(download_path, "wb") as file_handle:
+        file_handle.write(b"local content")
+
+    node = TreeNode(
+        "README.md",
+        id="root-file-1",
+        size=len(b"local content"),
+        content_hash=dropbox.dropbox_content_hash(download_path),
+        path="/readme.md",
+    )
+
+    # The file left by a previous attempt is kept
+    assert importer.download_file(node, download_path, "README.md") == node.size
+    with open(download_path, "rb") as file_handle:
+        assert file_handle.read() == b"local content"
+
+    # The file changed in Dropbox
+    node.content_hash = "0" * 64
+    importer.download_file(node, download_path, "README.md")
+    with open(download_path, "rb") as file_handle:
+        assert file_handle.read() == b"dummycontent"
+
+
+@pytest.mark.usefixtures("download_mock")
+def test_download_file_changed_after_listing(
+    monkeypatch: Any, tmpdir: pathlib.Path, db: Session, basic_job: dict
+) -> None:
+    monkeypatch.setattr(settings, "BLOB_CACHE_PATH", os.path.join(tmpdir, "cache"))
+    monkeypatch.setattr(settings, "BLOB_CACHE_MAX_SIZE", 1024)
+
+    importer = DropboxImporter(db, basic_job["db_job"].id)
+    importer.url_type = "user_folder"
+    importer.dropbox_handler = Dropbox(oauth2_access_token="token")
+
+    download_path = os.path.join(tmpdir, "README.md")
+
+    # The hash of the listing doesn't match the downloaded content
+    listed_hash = "0" * 64
+    node = TreeNode(
+        "README.md",
+        id="root-file-1",
+        size=len(b"dummycontent"),
+        content_hash=listed_hash,
+        path="/readme.md",
+    )
+    importer.download_file(node, download_path, "README.md")
+
+    assert not blob_cache.fetch("dropbox", listed_hash, download_path)
+    assert blob_cache.fetch(
+        "dropbox", dropbox.dropbox_content_hash(download_path), download_path
+    )
+
+
+@pytest.mark.usefixtures("download_mock")
+def test_download_file_keeps_cached_content(
+    monkeypatch: Any, tmpdir: pathlib.Path, db: Session, basic_job: dict
+) -> None:
+    monkeypatch.setattr(settings, "BLOB_CACHE_PATH", os.path.join(tmpdir, "cache"))
+    monkeypatch.setattr(settings, "BLOB_CACHE_MAX_SIZE", 1024)
+
+    importer = DropboxImporter(db, basic_job["db_job"].id)
+    importer.url_type = "user_folder"
+    importer.dropbox_handler = Dropbox(oauth2_access_token="token")
+
+    # A previous attempt got the file from the cache
+    cached_path = os.path.join(tmpdir, "cached.md")
+    with open(cached_path, "wb") as file_handle:
+        file_handle.write(b"cached content")
+    cached_hash = dropbox.dropbox_content_hash(cached_path)
+    blob_cache.store("dropbox", cached_hash, cached_path)
+
+    download_path = os.path.join(tmpdir, "README.md")
+    assert blob_cache.fetch("dropbox", cached_hash, download_path)
+
+    # The file changed in Dropbox before the retry
+    node = TreeNode(
+        "README.md",
+        id="root-file-1",
+        size=len(b"dummycontent"),
+        content_hash="0" * 64,
+        path="/readme.md",
+    )
+    importer.download_file(node, download_path, "README.md")
+
+    with open(download_path, "rb") as file_handle:
+        assert file_handle.read() == b"dummycontent"
+    with open(blob_cache.get_blob_path("dropbox", cached_hash), "rb") as file_handle:
+        assert file_handle.read() == b"cached content"
+
+
+@pytest.mark.parametrize(
+    "url, zip_url",
+    [
+        (
+            "https://www.dropbox.com/sh/shared-folder?dl=0",
+            "https://www.dropbox.com/sh/shared-folder?dl=1",
+        ),
+        (
+            "https://www.dropbox.com/sh/shared-folder",
+            "https://www.dropbox.com/sh/shared-folder?dl=1",
+        ),
+    ],
+)
+def test_get_zip_url(url: str, zip_url: str) -> None:
+    assert get_zip_url(url) == zip_url
+
+
+@pytest.mark.parametrize(
+    "file_count, file_size, expected",
+    [(100, 1024, True), (100, 10 * 1024 * 1024, False), (2, 1024, False)],
+)
+def test_use_zip_download(
+    monkeypatch: Any, file_count: int, file_size: int, expected: bool
+) -> None:
+    monkeypatch.setattr(settings, "DROPBOX_ZIP_MIN_FILES", 50)
+    monkeypatch.setattr(settings, "DROPBOX_ZIP_MAX_AVERAGE_SIZE", 1024 * 1024)
+
+    files = [TreeNode(f"{i}.txt", size=file_size) for i in range(file_count)]
+
+    assert use_zip_download(files) is expected
+
+
+def list_downloaded_files(path: str) -> List[str]:
+    return sorted(
+        os.path.relpath(os.path.join(dirpath, name), path)
+        for (dirpath, _, filenames) in os.walk(path)
+        for name in filenames
+    )
+
+
+@pytest.mark.parametrize(
+    "archived_path",
+    ["Shared folder/Subfolder/test.txt", "Subfolder/test.txt"],
+)
+@pytest.mark.usefixtures("shared_link_download_mock")
+def test_download_zip_same_tree(
+    monkeypatch: Any,
+    tmpdir: pathlib.Path,
+    db: Session,
+    basic_job: dict,
+    archived_path: str,
+) -> None:
+    url = "https://www.dropbox.com/sh/shared-folder"
+
+    importer = DropboxImporter(db, basic_job["db_job"].id)
+    importer.url_type = "id"
+    importer.shared_link = SharedLink(url=url)
+    importer.dropbox_handler = Dropbox(oauth2_access_token="token")
+
+    # The only child of the shared folder is a folder
+    tree = {
+        "Subfolder": folder_node(
+            TreeNode("Subfolder", id="subfolder-1", path="/Subfolder", is_folder=True),
+            {"test.txt": TreeNode("test.txt", id="nested-file-1")},
+        ),
+    }
+
+    # Archived inside the shared folder, or at the root
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, "w") as zip_file:
+        zip_file.writestr(archived_path, b"dummycontent")
+    zip_content = archive.getvalue()
+
+    def mock_get_zip(self: Any, zip_url: str, **kwargs: Any) -> requests.Response:
+        assert zip_url == get_zip_url(url)
+
+        response = requests.Response()
+        response.status_code = 200
+        response.url = zip_url
+        response.raw = io.BytesIO(zip_content)
+        return response
+
+    def mock_get_shared_link_metadata(self: Any, url: str) -> FolderLinkMetadata:
+        return FolderLinkMetadata(url=url, name="Shared folder")
+
+    monkeypatch.setattr(requests.Session, "get", mock_get_zip)
+    monkeypatch.setattr(
+        Dropbox, "sharing_get_shared_link_metadata", mock_get_shared_link_metadata
+    )
+
+    files_path = os.path.join(tmpdir, "files")
+    importer.download_tree_in_parallel(tree, files_path)
+
+    zip_path = os.path.join(tmpdir, "zip")
+    importer.download_zip(url, zip_path)
+
+    assert list_downloaded_files(zip_path) == ["Subfolder/test.txt"]
+    assert list_downloaded_files(zip_path) == list_downloaded_files(files_path)
+
+
+def test_download_tree_pipelined_queue_size(
+    monkeypatch: Any, tmpdir: pathlib.Path, db: Session, basic_job: dict
+) -> None:
+    monkeypatch.setattr(settings, "DROPBOX_MAX_WORKERS", 2)
+    monkeypatch.setattr(settings, "DROPBOX_DOWNLOAD_QUEUE_SIZE", 3)
+
+    job: Job = basic_job["db_job"]
+    importer = DropboxImporter(db, job.id)
+
+    file_count = 10
+    listed_files = 0
+    downloaded_files = 0
+    max_pending_downloads = 0
+
+    def mock_walk(
+        current_level: Dict[str, TreeNode], folder_url: str
+    ) -> Generator[Tuple[TreeNode, str], None, None]:
+        nonlocal listed_files, max_pending_downloads
+        yield (TreeNode("Subfolder", is_folder=True), "Subfolder")
+
+        for index in range(file_count):
+            # Every file listed so far was queued for download
+            max_pending_downloads = max(
+                max_pending_downloads, listed_files - downloaded_files
+            )
+            listed_files += 1
+            yield (TreeNode(f"{index}.txt"), f"Subfolder/{index}.txt")
+
+    def mock_download_file(
+        node: TreeNode, download_path: str, relative_path: str
+    ) -> int:
+        with open(download_path, "wb") as file_handle:
+            file_handle.write(b"dummycontent")
+
+        return len(b"dummycontent")
+
+    on_downloads_done = importer.on_downloads_done
+
+    def mock_on_downloads_done(done: Set[Future], progress: JobProgress) -> None:
+        nonlocal downloaded_files
+        downloaded_files += len(done)
+        on_downloads_done(done, progress)
+
+    monkeypatch.setattr(importer, "walk", mock_walk)
+    monkeypatch.setattr(importer, "download_file", mock_download_file)
+    monkeypatch.setattr(importer, "on_downloads_done", mock_on_downloads_done)
+
+    importer.download_tree_pipelined({}, "/user_folder", str(tmpdir))
+
+    # The listing waited for downloads to finish, instead of queueing them all
+    assert max_pending_downloads == settings.DROPBOX_DOWNLOAD_QUEUE_SIZE
+    assert downloaded_files == file_count
+    assert len(os.listdir(os.path.join(tmpdir, "Subfolder"))) == file_count
+
+    db.refresh(job)
+    assert job.imported_items == file_count
@@ -1,17 +1,27 @@
 import os
 import shutil
-from re import search
+from re import findall
 from typing import Any, Dict, Generator, List, Optional
 
 import pytest
+from googleapiclient.http import HttpMockSequence, HttpRequest
 from pydrive.auth import GoogleAuth
 from pydrive.drive import GoogleDrive
 from pydrive.files import ApiRequestError, FileNotDownloadableError, GoogleDriveFile
 from sqlalchemy.orm import Session
 
 from app import crud
+from app.core import blob_cache
 from app.core.config import settings
-from app.importers.google_drive import GoogleDriveImporter, folder_mimetype, is_folder
+from app.importers import google_drive
+from app.importers.file_tree import TreeNode
+from app.importers.google_drive import (
+    GoogleDriveImporter,
+    batch_folder_ids,
+    folder_mimetype,
+    md5_checksum,
+    parents_query,
+)
 from app.models.job import JobStatus
 from app.models.job_log import JobLog
 from app.models.manifest import Manifest
@@ -44,12 +54,19 @@ def pydrive_mock(monkeypatch: Any, remote_data: dict) -> None:
         if not files_query:
             raise ApiRequestError
 
+        # Without the token, only the first page would be listed
+        assert "nextPageToken" in param.get("fields", "")
+
         list_object = GoogleDriveFileListMock()
 
-        match = search(r"'(?P<item_id>[-\w]+)' in parents", files_query)
-        assert match
-        item_id = match.group("item_id")
-        list_object.mocked_list = remote_data[item_id].get("children", [])
+        # Several folders can be listed with the same query
+        item_ids = findall(r"'([-\w]+)' in parents", files_query)
+        assert item_ids
+        list_object.mocked_list = [
+            {**child, "parents": [{"id": item_id}]}
+            for item_id in item_ids
+            for child in remote_data[item_id].get("children", [])
+        ]
 
         return list_object
 
@@ -95,6 +112,11 @@ def basic_job(db: Session) -> Generator[Dict, None, None]:
     crud.job.remove(db, id=db_job.id)
 
 
+def folder_node(node: TreeNode, children: Dict[str, TreeNode]) -> TreeNode:
+    node.children = children
+    return node
+
+
 @pytest.mark.parametrize(
     "remote_data, expected_tree",
     [
@@ -113,6 +135,11 @@ def basic_job(db: Session) -> Generator[Dict, None, None]:
                             "title": "Subfolder",
                             "mimeType": folder_mimetype,
                         },
+                        {
+                            "id": "subfolder-2",
+                            "title": "Other subfolder",
+                            "mimeType": folder_mimetype,
+                        },
                     ],
                 },
                 "subfolder-1": {
@@ -125,56 +152,48 @@ def basic_job(db: Session) -> Generator[Dict, None, None]:
                         },
                     ],
                 },
+                "subfolder-2": {
+                    "item": {"mimeType": folder_mimetype},
+                    "children": [
+                        {
+                            "id": "nested-file-2",
+                            "title": "test.txt",
+                            "mimeType": "text/plain",
+                        },
+                    ],
+                },
             },
             {
-                "README.md": {
-                    "item": {
-                        "id": "root-file-1",
-                        "title": "README.md",
-                        "mimeType": "text/plain",
-                    },
-                    "children": {},
-                },
-                "Subfolder": {
-                    "item": {
-                        "id": "subfolder-1",
-                        "title": "Subfolder",
-                        "mimeType": folder_mimetype,
-                    },
-                    "children": {
-                        "test.txt": {
-                            "item": {
-                                "id": "nested-file-1",
-                                "title": "test.txt",
-                                "mimeType": "text/plain",
-                            },
-                            "children": {},
-                        }
-                    },
-                },
+                "README.md": TreeNode("README.md", id="root-file-1"),
+                "Subfolder": folder_node(
+                    TreeNode("Subfolder", id="subfolder-1", is_folder=True),
+                    {"test.txt": TreeNode("test.txt", id="nested-file-1")},
+                ),
+                "Other subfolder": folder_node(
+                    TreeNode("Other subfolder", id="subfolder-2", is_folder=True),
+                    {"test.txt": TreeNode("test.txt", id="nested-file-2")},
+                ),
             },
         )
     ],
 )
 @pytest.mark.usefixtures("pydrive_mock")
-def test_build_tree_recursively(
+def test_build_tree_concurrently(
     db: Session, basic_job: dict, expected_tree: dict
 ) -> None:
     importer = GoogleDriveImporter(db, basic_job["db_job"].id)
     importer.drive = GoogleDrive()
     tree: Dict = {}
-    importer.build_tree_recursively(tree, "root-folder")
+    importer.build_tree_concurrently(tree, "root-folder")
     assert tree == expected_tree
 
 
 def assert_tree_directory_recursive(current_level: Dict, accumulated_path: str) -> None:
     for (name, node) in current_level.items():
         check_path = os.path.join(accumulated_path, name)
-        item = node.get("item")
-        if is_folder(item):
+        if node.children is not None:
             assert os.path.isdir(check_path)
-            children = node.get("children")
-            assert_tree_directory_recursive(children, check_path)
+            assert_tree_directory_recursive(node.children, check_path)
         else:
             assert os.path.isfile(check_path)
 
@@ -183,49 +202,26 @@ def assert_tree_directory_recursive(current_level: Dict, accumulated_path: str)
     "tree",
     [
         {
-            "README.md": {
-                "item": GoogleDriveFile(
-                    metadata={
-                        "id": "root-file-1",
-                        "title": "README.md",
-                        "mimeType": "text/plain",
-                    },
-                    uploaded=True,
-                ),
-                "children": {},
-            },
-            "Subfolder": {
-                "item": GoogleDriveFile(
-                    metadata={
-                        "id": "subfolder-1",
-                        "title": "Subfolder",
-                        "mimeType": folder_mimetype,
-                    },
-                    uploaded=True,
-                ),
-                "children": {
-                    "test.txt": {
-                        "item": GoogleDriveFile(
-                            metadata={
-                                "id": "nested-file-1",
-                                "title": "test.txt",
-                                "mimeType": "text/plain",
-                            },
-                            uploaded=True,
-                        ),
-                        "children": {},
-                    }
-                },
-            },
+            "README.md": TreeNode("README.md", id="root-file-1"),
+            "Subfolder": folder_node(
+                TreeNode("Subfolder", id="subfolder-1", is_folder=True),
+                {"test.txt": TreeNode("test.txt", id="nested-file-1")},
+            ),
         },
     ],
 )
 @pytest.mark.usefixtures("download_mock")
-def test_download_tree_recursively(db: Session, basic_job: dict, tree: dict) -> None:
-    importer = GoogleDriveImporter(db, basic_job["db_job"].id)
+def test_download_tree_in_parallel(db: Session, basic_job: dict, tree: dict) -> None:
+    job = basic_job["db_job"]
+    importer = GoogleDriveImporter(db, job.id)
     importer.drive = GoogleDrive()
-    importer.download_tree_recursively(tree, basic_job["db_job"].path)
-    assert_tree_directory_recursive(tree, basic_job["db_job"].path)
+    importer.download_tree_in_parallel(tree, job.path)
+    assert_tree_directory_recursive(tree, job.path)
+
+    # The progress is recorded from the thread of the db session
+    db.refresh(job)
+    assert job.imported_items == 2
+    assert job.imported_bytes == 2 * len(b"dummy")
 
 
 @pytest.fixture
@@ -276,8 +272,9 @@ def test_google_drive_importer(db: Session, basic_job: dict, remote_data: dict)
     job = basic_job["db_job"]
     importer = GoogleDriveImporter(db, basic_job["db_job"].id)
     importer.process()
+    assert importer.tree_root.children is not None
     assert_tree_directory_recursive(
-        importer.tree_root["children"], basic_job["db_job"].path
+        importer.tree_root.children, basic_job["db_job"].path
     )
     importing_status_log = (
         db.query(JobLog).filter_by(job_id=job.id, to_status=JobStatus.IMPORTING).one()
@@ -317,3 +314,84 @@ def test_google_drive_importer_api_error(db: Session, basic_job: dict) -> None:
     importer = GoogleDriveImporter(db, basic_job["db_job"].id)
     importer.process()
     assert job.status is JobStatus.IMPORTING_ERROR_DATA_UNREACHABLE
+
+
+def test_batch_folder_ids(monkeypatch: Any) -> None:
+    monkeypatch.setattr(settings, "GOOGLE_DRIVE_QUERY_MAX_LENGTH", 100)
+
+    folder_ids = ["folder-1", "folder-2", "folder-3", "folder-4"]
+    batches = batch_folder_ids(folder_ids)
+
+    assert batches == [["folder-1", "folder-2", "folder-3"], ["folder-4"]]
+    assert all(
+        len(parents_query(batch)) <= settings.GOOGLE_DRIVE_QUERY_MAX_LENGTH
+        for batch in batches
+    )
+
+
+@pytest.mark.usefixtures("download_mock")
+def test_download_file_changed_after_listing(
+    monkeypatch: Any, db: Session, basic_job: dict
+) -> None:
+    job_path = basic_job["db_job"].path
+    monkeypatch.setattr(settings, "BLOB_CACHE_PATH", os.path.join(job_path, "cache"))
+    monkeypatch.setattr(settings, "BLOB_CACHE_MAX_SIZE", 1024)
+
+    importer = GoogleDriveImporter(db, basic_job["db_job"].id)
+    importer.drive = GoogleDrive()
+
+    os.makedirs(job_path, exist_ok=True)
+    download_path = os.path.join(job_path, "README.md")
+
+    # The hash of the listing doesn't match the downloaded content
+    listed_hash = "0" * 32
+    node = TreeNode("README.md", id="root-file-1", size=5, content_hash=listed_hash)
+    importer.download_file(node, download_path)
+
+    assert not blob_cache.fetch("google_drive", listed_hash, download_path)
+
+    # The same file, listed with its hash
+    node.content_hash = md5_checksum(download_path)
+    os.remove(download_path)
+    importer.download_file(node, download_path)
+
+    assert blob_cache.fetch("google_drive", node.content_hash, download_path)
+
+
+class GoogleDriveServiceMock:
+    def files(self) -> "GoogleDriveServiceMock":
+        return self
+
+    def get_media(self, fileId: str) -> HttpRequest:
+        return HttpRequest(
+            None,
+            lambda response, content: content,
+            f"https://www.googleapis.com/drive/v2/files/{fileId}?alt=media",
+        )
+
+
+def test_download_content_in_chunks(
+    monkeypatch: Any, db: Session, basic_job: dict
+) -> None:
+    monkeypatch.setattr(google_drive, "DOWNLOAD_CHUNK_SIZE", 5)
+
+    # Each chunk is requested with its own range
+    http = HttpMockSequence(
+        [
+            ({"status": "206", "content-range": "bytes 0-4/10"}, b"dummy"),
+            ({"status": "206", "content-range": "bytes 5-9/10"}, b"dummy"),
+        ]
+    )
+    auth = GoogleAuth()
+    auth.service = GoogleDriveServiceMock()
+    monkeypatch.setattr(auth, "Get_Http_Object", lambda: http)
+
+    importer = GoogleDriveImporter(db, basic_job["db_job"].id)
+    importer.drive = GoogleDrive(auth)
+
+    node = TreeNode("README.md", id="root-file-1", size=10)
+    streamed_file = importer.download_content((node, "folder/README.md"))
+
+    assert streamed_file.path == "folder/README.md"
+    assert streamed_file.size == 10
+    assert streamed_file.content.read() == b"dummydummy"
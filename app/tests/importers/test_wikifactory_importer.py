@@ -1,16 +1,18 @@
+import io
 import os
-import pathlib
-import shutil
-from typing import Any, Dict, Generator, List
+import zipfile
+from typing import Any, Dict, Generator, List, Optional
 
 import gql
 import py
 import pytest
 import requests
 from gql import Client
+from requests import Response
 from sqlalchemy.orm import Session
 
 from app import crud
+from app.core.config import settings
 from app.importers.wikifactory import WikifactoryImporter, space_slug_from_url
 from app.models.job import JobStatus
 from app.models.job_log import JobLog
@@ -130,6 +132,49 @@ def test_get_project_details(
     assert project_details == expected_details
 
 
+def read_test_zip() -> bytes:
+    # Instead of performing the network request, we return the content
+    # of the test_zip_project file inside the test_files folder
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    test_zip_file_path = os.path.normpath(
+        os.path.join(current_dir, "..", "test_files", "test_zip_project.zip")
+    )
+
+    with open(test_zip_file_path, mode="rb") as file:  # b is important -> binary
+        return file.read()
+
+
+def mock_zip_download(
+    monkeypatch: Any,
+    zip_content: bytes,
+    supports_ranges: bool,
+    failing_offset: Optional[int] = None,
+) -> None:
+    # Mock the request for the zip file. The range requests that start
+    # at `failing_offset` fail, after the archive is opened
+    def mock_get_zip_from_url(*args: List, **kwargs: Any) -> Response:
+        resp: Response = Response()
+        resp.status_code = 200
+        resp.url = str(args[1])
+        resp._content = zip_content
+
+        range_header = (kwargs.get("headers") or {}).get("Range")
+        if supports_ranges and range_header:
+            start, end = map(int, range_header[len("bytes=") :].split("-"))
+
+            if start == failing_offset and end > start:
+                raise requests.ConnectionError("Connection reset")
+
+            resp.status_code = 206
+            resp.headers["Content-Range"] = f"bytes {start}-{end}/{len(zip_content)}"
+            resp._content = zip_content[start : end + 1]
+
+        resp.raw = io.BytesIO(resp._content)
+        return resp
+
+    monkeypatch.setattr(requests.Session, "get", mock_get_zip_from_url)
+
+
 @pytest.mark.parametrize(
     "project_details, items_count",
     [
@@ -143,6 +188,7 @@ def test_get_project_details(
         )
     ],
 )
+@pytest.mark.parametrize("supports_ranges", [True, False])
 def test_wikifactory_importer(
     monkeypatch: Any,
     db: Session,
@@ -150,51 +196,17 @@ def test_wikifactory_importer(
     basic_job: dict,
     importer: WikifactoryImporter,
     items_count: int,
+    supports_ranges: bool,
 ) -> None:
     def mock_get_project_details(*args: List, **kwargs: Dict) -> Dict:
         return project_details
 
     monkeypatch.setattr(importer, "get_project_details", mock_get_project_details)
 
-    # Mock the request for the zip file
-    # Instead of performing the network request, we return the content
-    # of the test_zip_project file inside the test_files folder
-    """def mock_get_zip_from_url(*args: List, **kwargs: Dict) -> Response:
-        resp: Response = Response()
-        resp.status_code = 200
-
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        test_zip_file_path = os.path.normpath(
-            os.path.join(current_dir, "..", "test_files", "test_zip_project.zip")
-        )
-
-        with open(test_zip_file_path, mode="rb") as file:  # b is important -> binary
-            resp._content = file.read()
-        return resp
-
-    monkeypatch.setattr(requests, "get", mock_get_zip_from_url)"""
+    mock_zip_download(monkeypatch, read_test_zip(), supports_ranges)
 
     job = basic_job["db_job"]
 
-    def download_zip(*args: List, **kwargs: Dict) -> None:
-
-        tmp_job_name = "tmp_" + os.path.basename(job.path)
-        tmp_job_path = os.path.join(os.path.dirname(job.path), tmp_job_name)
-
-        # Copy the test zip file to mimic the download
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-
-        pathlib.Path(tmp_job_path).mkdir(parents=True, exist_ok=True)
-
-        shutil.copyfile(
-            os.path.normpath(
-                os.path.join(current_dir, "..", "test_files", "test_zip_project.zip")
-            ),
-            os.path.join(tmp_job_path, "zipfile.zip"),
-        )
-
-    monkeypatch.setattr(importer, "download_zip_file", download_zip)
-
     importer.process()
 
     # Test the logs in the database
@@ -233,9 +245,65 @@ def test_wikifactory_importer(
     assert nested_file.read() == "Nested file"
 
     # Test manifest content
+    assert job.total_items == items_count
     assert job.imported_items == items_count
 
     manifest = db.query(Manifest).filter_by(job_id=job.id).one()
 
     assert manifest
     assert manifest.project_description == ""
+
+
+@pytest.mark.parametrize("supports_ranges", [True, False])
+def test_wikifactory_importer_broken_archive(
+    monkeypatch: Any,
+    basic_job: dict,
+    importer: WikifactoryImporter,
+    supports_ranges: bool,
+) -> None:
+    def mock_get_project_details(*args: List, **kwargs: Dict) -> Dict:
+        return {"zip_url": "https://wikifactory.com/zipurl"}
+
+    monkeypatch.setattr(importer, "get_project_details", mock_get_project_details)
+
+    zip_content = read_test_zip()
+
+    if supports_ranges:
+        # The connection is lost while the first file is extracted
+        with zipfile.ZipFile(io.BytesIO(zip_content)) as zip_file:
+            first_file = next(
+                entry for entry in zip_file.infolist() if not entry.is_dir()
+            )
+
+        mock_zip_download(
+            monkeypatch, zip_content, True, failing_offset=first_file.header_offset
+        )
+    else:
+        # The archive is truncated
+        mock_zip_download(monkeypatch, zip_content[: len(zip_content) // 2], False)
+
+    importer.process()
+
+    job = basic_job["db_job"]
+    assert job.status is JobStatus.IMPORTING_ERROR_DATA_UNREACHABLE
+
+
+def test_record_download_progress(
+    monkeypatch: Any, db: Session, basic_job: dict, importer: WikifactoryImporter
+) -> None:
+    monkeypatch.setattr(settings, "ZIP_PROGRESS_LOG_STEP", 100)
+    job = basic_job["db_job"]
+
+    # The archive is being downloaded before extracting it
+    importer.record_download_progress(100, 400)
+    db.refresh(job)
+
+    assert job.total_bytes == 400
+    assert job.imported_bytes == 100
+
+    # The extracted files are counted instead
+    importer.extracting = True
+    importer.record_download_progress(400, 400)
+    db.refresh(job)
+
+    assert job.imported_bytes == 100
@@ -1,12 +1,18 @@
+from contextlib import closing, contextmanager
+from typing import Iterator
+
 import sentry_sdk
+from celery import Task, chain
 from celery.utils.log import get_task_logger
 
 from app import crud
 from app.core.celery_app import celery_app
 from app.core.config import settings
+from app.core.service_limit import ServiceLimitReached, service_limit
 from app.db.session import SessionLocal
 from app.exporters import service_map as exporters_map
 from app.importers import service_map as importers_map
+from app.models.job import Job
 
 logger = get_task_logger(__name__)
 client_sentry = sentry_sdk.init(settings.SENTRY_DSN)
@@ -14,24 +20,136 @@ client_sentry = sentry_sdk.init(settings.SENTRY_DSN)
 # TODO - add support for retry (?)
 
 
+def job_queue(phase: str, service: str) -> str:
+    # worker-start.sh consumes every queue by default,
+    # so its list has to be updated when a service is added
+    return f"{phase}.{service}"
+
+
+def is_streamed(job: Job) -> bool:
+    # The files go from the importer to the exporter without being
+    # written to the job folder
+    return (
+        settings.STREAM_JOBS
+        and importers_map[job.import_service].supports_streaming
+        and exporters_map[job.export_service].supports_streaming
+    )
+
+
+@contextmanager
+def retry_if_service_busy(task: Task, job_id: str) -> Iterator[None]:
+    try:
+        yield
+    except ServiceLimitReached as limit_reached:
+        # The job keeps its status, so it continues from the same phase
+        logger.info(f"Job {job_id} is waiting for {limit_reached}")
+        raise task.retry(countdown=settings.SERVICE_LIMIT_RETRY_DELAY)
+
+
+# Each task uses its own db session, so several tasks can run at the same
+# time in a worker, with any pool (prefork, threads or gevent)
 @celery_app.task
 def process_job(job_id: str) -> None:
-    # FIXME - teardown (?)
+    # Entry point of a job. Its import and export run as separate tasks,
+    # in the queues of their services
+    db = SessionLocal()
+
+    try:
+        job = crud.job.get(db, job_id)
+        assert job
+
+        if not crud.job.is_active(job):
+            return
+
+        if is_streamed(job):
+            # The job folder is empty until the import is done again,
+            # so a streamed job always starts from the import
+            if crud.job.can_import(job) or crud.job.can_export(job):
+                stream_job.si(job_id).set(
+                    queue=job_queue("import", job.import_service)
+                ).apply_async()
+            return
+
+        export_task = export_job.si(job_id).set(
+            queue=job_queue("export", job.export_service)
+        )
+
+        if crud.job.can_import(job):
+            import_task = import_job.si(job_id).set(
+                queue=job_queue("import", job.import_service)
+            )
+            chain(import_task, export_task).apply_async()
+        elif crud.job.can_export(job):
+            export_task.apply_async()
+    finally:
+        db.close()
+
+
+@celery_app.task(bind=True, max_retries=None)
+def import_job(self: Task, job_id: str) -> None:
     db = SessionLocal()
-    job = crud.job.get(db, job_id)
-    assert job
 
-    if not crud.job.is_active(job):
-        return
+    try:
+        job = crud.job.get(db, job_id)
+        assert job
+
+        if not crud.job.can_import(job):
+            return
 
-    if crud.job.can_import(job):
         Importer = importers_map[job.import_service]
         assert Importer
         importer = Importer(db, job.id)
-        importer.process()
 
-    if crud.job.can_export(job):
+        with retry_if_service_busy(self, job_id):
+            with service_limit(job.import_service, job.import_token):
+                importer.process()
+    finally:
+        db.close()
+
+
+@celery_app.task(bind=True, max_retries=None)
+def export_job(self: Task, job_id: str) -> None:
+    # It also runs when the import failed, and then the job can't be exported
+    db = SessionLocal()
+
+    try:
+        job = crud.job.get(db, job_id)
+        assert job
+
+        if not crud.job.can_export(job):
+            return
+
         Exporter = exporters_map[job.export_service]
         assert Exporter
         exporter = Exporter(db, job.id)
-        exporter.process()
+
+        with retry_if_service_busy(self, job_id):
+            with service_limit(job.export_service, job.export_token):
+                exporter.process()
+    finally:
+        db.close()
+
+
+@celery_app.task(bind=True, max_retries=None)
+def stream_job(self: Task, job_id: str) -> None:
+    # Both phases run together, holding the limits of both services
+    db = SessionLocal()
+
+    try:
+        job = crud.job.get(db, job_id)
+        assert job
+
+        if not crud.job.can_import(job) and not crud.job.can_export(job):
+            return
+
+        importer = importers_map[job.import_service](db, job.id)
+        exporter = exporters_map[job.export_service](db, job.id)
+
+        with retry_if_service_busy(self, job_id):
+            with service_limit(job.import_service, job.import_token):
+                with service_limit(job.export_service, job.export_token):
+                    with closing(importer.stream_files()) as files:
+                        if crud.job.can_export(job):
+                            exporter.process_stream(files)
+    finally:
+        db.close()
@@ -4,7 +4,7 @@
 python app/backend_pre_start.py
 
 # Run migrations
-# alembic upgrade head
+python app/migrate_db.py
 
 # Create initial data in DB
 python app/initial_data.py
@@ -3,9 +3,17 @@ set -e
 
 python app/celeryworker_pre_start.py
 
+# Number of jobs processed at the same time by the worker, and the pool running them
+CELERY_CONCURRENCY=${CELERY_CONCURRENCY:-1}
+CELERY_POOL=${CELERY_POOL:-prefork}
+
+# Queues consumed by the worker. Imports and exports go to a queue per phase and
+# service (see app.worker.job_queue), so workers can be dedicated to some of them
+CELERY_QUEUES=${CELERY_QUEUES:-celery,import.git,import.google_drive,import.dropbox,import.wikifactory,export.git,export.dropbox,export.wikifactory}
+
 if [ $DAP_PORT ] ; then
     echo " * DAP is running!"
-    python -m debugpy --listen 0.0.0.0:$DAP_PORT -m celery -A app.worker worker -l info -c 1
+    python -m debugpy --listen 0.0.0.0:$DAP_PORT -m celery -A app.worker worker -l info -c $CELERY_CONCURRENCY -P $CELERY_POOL -Q $CELERY_QUEUES
 else
-    celery -A app.worker worker -l info -c 1
+    celery -A app.worker worker -l info -c $CELERY_CONCURRENCY -P $CELERY_POOL -Q $CELERY_QUEUES
 fi